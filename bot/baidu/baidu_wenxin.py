@@ -1,10 +1,12 @@
 # encoding:utf-8
 
-import requests, json
+import json
 from bot.bot import Bot
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import http_client
+from common.credential_cache import get_baidu_access_token
 from common.log import logger
 from config import conf
 from bot.baidu.baidu_wenxin_session import BaiduWenxinSession
@@ -39,6 +41,7 @@ class BaiduWenxinBot(Bot):
                         result["completion_tokens"],
                         result["content"],
                     )
+                    context["total_tokens"] = total_tokens
                     logger.debug(
                         "[BAIDU] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(session.messages, session_id, reply_content, completion_tokens)
                     )
@@ -58,10 +61,10 @@ class BaiduWenxinBot(Bot):
                     reply = Reply(ReplyType.ERROR, retstring)
                 return reply
 
-    def reply_text(self, session: BaiduWenxinSession, retry_count=0):
+    def reply_text(self, session: BaiduWenxinSession, retry_count=0, refresh_token=False):
         try:
             logger.info("[BAIDU] model={}".format(session.model))
-            access_token = self.get_access_token()
+            access_token = self.get_access_token(refresh_token)
             if access_token == 'None':
                 logger.warn("[BAIDU] access token 获取失败")
                 return {
@@ -74,9 +77,12 @@ class BaiduWenxinBot(Bot):
                 'Content-Type': 'application/json'
             }
             payload = {'messages': session.messages}
-            response = requests.request("POST", url, headers=headers, data=json.dumps(payload))
+            response = http_client.request("POST", url, headers=headers, data=json.dumps(payload))
             response_text = json.loads(response.text)
             logger.info(f"[BAIDU] response text={response_text}")
+            if response_text.get("error_code") in [110, 111] and not refresh_token:
+                # access token无效或已过期，刷新后重试一次
+                return self.reply_text(session, retry_count, refresh_token=True)
             res_content = response_text["result"]
             total_tokens = response_text["usage"]["total_tokens"]
             completion_tokens = response_text["usage"]["completion_tokens"]
@@ -94,11 +100,13 @@ class BaiduWenxinBot(Bot):
             result = {"completion_tokens": 0, "content": "出错了: {}".format(e)}
             return result
 
-    def get_access_token(self):
+    def get_access_token(self, refresh=False):
         """
-        使用 AK，SK 生成鉴权签名（Access Token）
+        使用 AK，SK 生成鉴权签名（Access Token），token在有效期内缓存复用
         :return: access_token，或是None(如果错误)
         """
-        url = "https://aip.baidubce.com/oauth/2.0/token"
-        params = {"grant_type": "client_credentials", "client_id": BAIDU_API_KEY, "client_secret": BAIDU_SECRET_KEY}
-        return str(requests.post(url, params=params).json().get("access_token"))
+        try:
+            return get_baidu_access_token(BAIDU_API_KEY, BAIDU_SECRET_KEY, refresh)
+        except Exception as e:
+            logger.warn("[BAIDU] get access token failed: {}".format(e))
+            return "None"
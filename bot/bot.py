@@ -5,6 +5,7 @@ Auto-replay chat robot abstract class
 
 from bridge.context import Context
 from bridge.reply import Reply
+from common.async_utils import run_sync
 
 
 class Bot(object):
@@ -15,3 +16,11 @@ class Bot(object):
         :return: reply content
         """
         raise NotImplementedError
+
+    async def reply_async(self, query, context: Context = None) -> Reply:
+        """
+        async version of reply, bots without native async support run reply in the sync executor
+        :param req: received message
+        :return: reply content
+        """
+        return await run_sync(self.reply, query, context)
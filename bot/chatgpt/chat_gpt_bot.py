@@ -1,18 +1,21 @@
 # encoding:utf-8
 
+import asyncio
 import time
 
 import openai
 import openai.error
-import requests
 
 from bot.bot import Bot
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
+from bot.openai.backend_pool import get_backend_pool
 from bot.openai.open_ai_image import OpenAIImage
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import http_client
 from common.log import logger
+from common.retry import RetryLater, RetryPolicy, retry_after_seconds
 from common.token_bucket import TokenBucket
 from config import conf, load_config
 
@@ -30,8 +33,10 @@ class ChatGPTBot(Bot, OpenAIImage):
             openai.proxy = proxy
         if conf().get("rate_limit_chatgpt"):
             self.tb4chatgpt = TokenBucket(conf().get("rate_limit_chatgpt", 20))
+        self.backend_pool = get_backend_pool()
+        self.retry_policy = RetryPolicy()
 
-        self.sessions = SessionManager(ChatGPTSession, model=conf().get("model") or "gpt-3.5-turbo")
+        self.sessions = SessionManager(ChatGPTSession, model=conf().get("model") or "gpt-3.5-turbo", summary_func=self.summarize)
         self.args = {
             "model": conf().get("model") or "gpt-3.5-turbo",  # 对话模型的名称
             "temperature": conf().get("temperature", 0.9),  # 值在[0,1]之间，越大表示回复越具有不确定性
@@ -49,53 +54,34 @@ class ChatGPTBot(Bot, OpenAIImage):
             logger.info("[CHATGPT] query={}".format(query))
 
             session_id = context["session_id"]
-            reply = None
-            clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
-            if query in clear_memory_commands:
-                self.sessions.clear_session(session_id)
-                reply = Reply(ReplyType.INFO, "记忆已清除")
-            elif query == "#清除所有":
-                self.sessions.clear_all_session()
-                reply = Reply(ReplyType.INFO, "所有人记忆已清除")
-            elif query == "#更新配置":
-                load_config()
-                reply = Reply(ReplyType.INFO, "配置已更新")
+            reply = self._reply_command(query, session_id)
             if reply:
                 return reply
             session = self.sessions.session_query(query, session_id)
             logger.debug("[CHATGPT] session query={}".format(session.messages))
 
-            api_key = context.get("openai_api_key")
-            model = context.get("gpt_model")
-            new_args = None
-            if model:
-                new_args = self.args.copy()
-                new_args["model"] = model
-            # if context.get('stream'):
-            #     # reply in stream
-            #     return self.reply_text_stream(query, new_query, session_id)
-
-            reply_content = self.reply_text(session, api_key, args=new_args)
-            logger.debug(
-                "[CHATGPT] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
-                    session.messages,
-                    session_id,
-                    reply_content["content"],
-                    reply_content["completion_tokens"],
-                )
-            )
-            if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-            elif reply_content["completion_tokens"] > 0:
-                self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
-                reply = Reply(ReplyType.TEXT, reply_content["content"])
-            else:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-                logger.debug("[CHATGPT] reply {} used 0 tokens.".format(reply_content))
-            return reply
+            api_key, new_args = self._request_args(context)
+            if context.get("stream"):
+                # reply in stream
+                try:
+                    return Reply(ReplyType.STREAM, self.reply_text_stream(session, api_key, args=new_args, context=context))
+                except RetryLater:
+                    self.sessions.session_rollback(query, session_id)
+                    raise
+                except Exception as e:
+                    logger.warn("[CHATGPT] stream request failed, fallback to normal request: {}".format(e))
+
+            try:
+                reply_content = self.reply_text(session, api_key, args=new_args, retry_count=context.get("retry_count", 0), context=context)
+            except RetryLater:
+                # 消息重新调度后会再次加入会话，先撤销本次的提问
+                self.sessions.session_rollback(query, session_id)
+                raise
+            context["total_tokens"] = reply_content["total_tokens"]
+            return self._build_reply(session, reply_content)
 
         elif context.type == ContextType.IMAGE_CREATE:
-            ok, retstring = self.create_img(query, 0)
+            ok, retstring = self.create_img(query, context.get("retry_count", 0), context=context)
             reply = None
             if ok:
                 reply = Reply(ReplyType.IMAGE_URL, retstring)
@@ -106,61 +92,190 @@ class ChatGPTBot(Bot, OpenAIImage):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def reply_text(self, session: ChatGPTSession, api_key=None, args=None, retry_count=0) -> dict:
+    async def reply_async(self, query, context=None):
+        if context.type != ContextType.TEXT or context.get("stream"):
+            return await super().reply_async(query, context)
+        logger.info("[CHATGPT] query={}".format(query))
+        session_id = context["session_id"]
+        reply = self._reply_command(query, session_id)
+        if reply:
+            return reply
+        session = self.sessions.session_query(query, session_id)
+        logger.debug("[CHATGPT] session query={}".format(session.messages))
+        api_key, new_args = self._request_args(context)
+        reply_content = await self.reply_text_async(session, api_key, args=new_args, context=context)
+        context["total_tokens"] = reply_content["total_tokens"]
+        return self._build_reply(session, reply_content)
+
+    def _reply_command(self, query, session_id):
+        clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
+        if query in clear_memory_commands:
+            self.sessions.clear_session(session_id)
+            return Reply(ReplyType.INFO, "记忆已清除")
+        elif query == "#清除所有":
+            self.sessions.clear_all_session()
+            return Reply(ReplyType.INFO, "所有人记忆已清除")
+        elif query == "#更新配置":
+            load_config()
+            return Reply(ReplyType.INFO, "配置已更新")
+        return None
+
+    def _request_args(self, context):
+        api_key = context.get("openai_api_key")
+        model = context.get("gpt_model")
+        new_args = None
+        if model:
+            new_args = self.args.copy()
+            new_args["model"] = model
+        return api_key, new_args
+
+    def summarize(self, messages) -> str:
+        """
+        用session_compaction_model生成会话摘要，与对话请求使用同一个后端池(azure时为azure的部署)
+        """
+        args = self.args.copy()
+        args["model"] = conf().get("session_compaction_model") or "gpt-3.5-turbo"
+        args["temperature"] = 0
+        response = self.backend_pool.request(openai.ChatCompletion.create, messages=messages, **args)
+        return response.choices[0]["message"]["content"]
+
+    def _build_reply(self, session: ChatGPTSession, reply_content: dict) -> Reply:
+        session_id = session.session_id
+        logger.debug(
+            "[CHATGPT] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
+                session.messages,
+                session_id,
+                reply_content["content"],
+                reply_content["completion_tokens"],
+            )
+        )
+        if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+        elif reply_content["completion_tokens"] > 0:
+            self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
+            reply = Reply(ReplyType.TEXT, reply_content["content"])
+        else:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+            logger.debug("[CHATGPT] reply {} used 0 tokens.".format(reply_content))
+        return reply
+
+    def reply_text(self, session: ChatGPTSession, api_key=None, args=None, retry_count=0, context=None) -> dict:
         """
         call openai's ChatCompletion to get the answer
         :param session: a conversation session
         :param session_id: session id
         :param retry_count: retry count
+        :param context: the message context, raises RetryLater instead of sleeping when the channel can reschedule it
         :return: {}
         """
         try:
-            if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
+            if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.acquire(context):
                 raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
-            # if api_key == None, the default openai.api_key will be used
+            # if api_key == None, the request is sent by the backend pool
             if args is None:
                 args = self.args
-            response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
+            response = self.backend_pool.request(openai.ChatCompletion.create, api_key=api_key, messages=session.messages, **args)
             # logger.debug("[CHATGPT] response={}".format(response))
             # logger.info("[ChatGPT] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            return {
-                "total_tokens": response["usage"]["total_tokens"],
-                "completion_tokens": response["usage"]["completion_tokens"],
-                "content": response.choices[0]["message"]["content"],
-            }
+            return self._parse_response(response)
+        except RetryLater:
+            raise
         except Exception as e:
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
-                logger.warn("[CHATGPT] RateLimitError: {}".format(e))
-                result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
-            elif isinstance(e, openai.error.Timeout):
-                logger.warn("[CHATGPT] Timeout: {}".format(e))
-                result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
-            elif isinstance(e, openai.error.APIError):
-                logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
-                result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
-            elif isinstance(e, openai.error.APIConnectionError):
-                logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
-                need_retry = False
-                result["content"] = "我连接不到你的网络"
+            result, retry_delay = self._handle_exception(e, session, retry_count, context)
+            if retry_delay is not None:
+                logger.warn("[CHATGPT] 第{}次重试, {:.1f}s后".format(retry_count + 1, retry_delay))
+                self.retry_policy.wait(retry_delay, retry_count + 1, context)
+                return self.reply_text(session, api_key, args, retry_count + 1, context)
             else:
-                logger.exception("[CHATGPT] Exception: {}".format(e))
-                need_retry = False
-                self.sessions.clear_session(session.session_id)
+                return result
 
-            if need_retry:
-                logger.warn("[CHATGPT] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, api_key, args, retry_count + 1)
+    def reply_text_stream(self, session: ChatGPTSession, api_key=None, args=None, context=None):
+        """
+        call openai's ChatCompletion in stream mode
+        :param session: a conversation session
+        :param context: the message context, raises RetryLater instead of waiting for the rate limit when the channel can reschedule it
+        :return: generator of content deltas, the reply is saved to the session when the stream ends
+        """
+        if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.acquire(context):
+            raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
+        if args is None:
+            args = self.args
+        response = self.backend_pool.request(openai.ChatCompletion.create, api_key=api_key, messages=session.messages, stream=True, **args)
+
+        def generate():
+            content = ""
+            try:
+                for chunk in response:
+                    delta = chunk.choices[0]["delta"].get("content")
+                    if delta:
+                        content += delta
+                        yield delta
+            except Exception as e:
+                logger.warn("[CHATGPT] stream interrupted: {}".format(e))
+                if not content:
+                    yield "我现在有点累了，等会再来吧"
+            finally:
+                if content:
+                    logger.debug("[CHATGPT] session_id={}, stream reply={}".format(session.session_id, content))
+                    self.sessions.session_reply(content, session.session_id)
+
+        return generate()
+
+    async def reply_text_async(self, session: ChatGPTSession, api_key=None, args=None, retry_count=0, context=None) -> dict:
+        """
+        async version of reply_text, awaits openai's ChatCompletion without occupying a thread
+        """
+        try:
+            if conf().get("rate_limit_chatgpt") and not await self.tb4chatgpt.get_token_async():
+                raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
+            if args is None:
+                args = self.args
+            response = await self.backend_pool.arequest(openai.ChatCompletion.acreate, api_key=api_key, messages=session.messages, **args)
+            return self._parse_response(response)
+        except Exception as e:
+            result, retry_delay = self._handle_exception(e, session, retry_count, context)
+            if retry_delay is not None:
+                logger.warn("[CHATGPT] 第{}次重试, {:.1f}s后".format(retry_count + 1, retry_delay))
+                await asyncio.sleep(retry_delay)
+                return await self.reply_text_async(session, api_key, args, retry_count + 1, context)
             else:
                 return result
 
+    @staticmethod
+    def _parse_response(response) -> dict:
+        return {
+            "total_tokens": response["usage"]["total_tokens"],
+            "completion_tokens": response["usage"]["completion_tokens"],
+            "content": response.choices[0]["message"]["content"],
+        }
+
+    def _handle_exception(self, e, session: ChatGPTSession, retry_count, context=None):
+        """
+        :return: (失败时的返回结果, 重试前等待的秒数，不需要重试时为None)
+        """
+        need_retry = True
+        result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+        if isinstance(e, openai.error.RateLimitError):
+            logger.warn("[CHATGPT] RateLimitError: {}".format(e))
+            result["content"] = "提问太快啦，请休息一下再问我吧"
+        elif isinstance(e, openai.error.Timeout):
+            logger.warn("[CHATGPT] Timeout: {}".format(e))
+            result["content"] = "我没有收到你的消息"
+        elif isinstance(e, openai.error.APIError):
+            logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
+            result["content"] = "请再问我一次"
+        elif isinstance(e, openai.error.APIConnectionError):
+            logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
+            need_retry = False
+            result["content"] = "我连接不到你的网络"
+        else:
+            logger.exception("[CHATGPT] Exception: {}".format(e))
+            need_retry = False
+            self.sessions.clear_session(session.session_id)
+        if not need_retry:
+            return result, None
+        return result, self.retry_policy.next_delay(retry_count, retry_after_seconds(getattr(e, "headers", None)), context)
+
 
 class AzureChatGPTBot(ChatGPTBot):
     def __init__(self):
@@ -168,15 +283,19 @@ class AzureChatGPTBot(ChatGPTBot):
         openai.api_type = "azure"
         openai.api_version = conf().get("azure_api_version", "2023-06-01-preview")
         self.args["deployment_id"] = conf().get("azure_deployment_id")
+        self.backend_pool = get_backend_pool(azure=True)
 
-    def create_img(self, query, retry_count=0, api_key=None):
+    def create_img(self, query, retry_count=0, api_key=None, context=None):
         api_version = "2022-08-03-preview"
-        url = "{}dalle/text-to-image?api-version={}".format(openai.api_base, api_version)
-        api_key = api_key or openai.api_key
+        backend = None if api_key else self.backend_pool.acquire()
+        api_base = backend.api_base if backend and backend.api_base else openai.api_base
+        url = "{}dalle/text-to-image?api-version={}".format(api_base, api_version)
+        api_key = api_key or backend.api_key
         headers = {"api-key": api_key, "Content-Type": "application/json"}
+        start = time.monotonic()
         try:
             body = {"caption": query, "resolution": conf().get("image_create_size", "256x256")}
-            submission = requests.post(url, headers=headers, json=body)
+            submission = http_client.post(url, headers=headers, json=body, use_proxy=True)
             operation_location = submission.headers["Operation-Location"]
             retry_after = submission.headers["Retry-after"]
             status = ""
@@ -184,10 +303,14 @@ class AzureChatGPTBot(ChatGPTBot):
             while status != "Succeeded":
                 logger.info("waiting for image create..., " + status + ",retry after " + retry_after + " seconds")
                 time.sleep(int(retry_after))
-                response = requests.get(operation_location, headers=headers)
+                response = http_client.get(operation_location, headers=headers, use_proxy=True)
                 status = response.json()["status"]
             image_url = response.json()["result"]["contentUrl"]
+            if backend:
+                self.backend_pool.release(backend, time.monotonic() - start)
             return True, image_url
         except Exception as e:
             logger.error("create image error: {}".format(e))
+            if backend:
+                self.backend_pool.release(backend, error=e)
             return False, "图片生成失败"
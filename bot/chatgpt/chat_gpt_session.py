@@ -1,5 +1,9 @@
+import functools
+
+from bot.chatgpt.session_summarizer import SUMMARY_PREFIX, SessionSummarizer
 from bot.session_manager import Session
 from common.log import logger
+from config import conf
 
 """
     e.g.  [
@@ -12,12 +16,17 @@ from common.log import logger
 
 
 class ChatGPTSession(Session):
-    def __init__(self, session_id, system_prompt=None, model="gpt-3.5-turbo"):
+    def __init__(self, session_id, system_prompt=None, model="gpt-3.5-turbo", summary_func=None):
         super().__init__(session_id, system_prompt)
         self.model = model
+        self.summary_func = summary_func  # 生成摘要的函数，由所属的bot用自己的接口实现，参数为消息列表，返回回复内容；为None时不压缩
+        self.token_cache = {}  # id(message) -> (message, content, tokens)，每条消息只编码一次
+        self.compacting = False  # 是否正在后台生成摘要
+        self.pending_summary = None  # 后台生成的摘要 (被压缩的消息, 摘要)，在下次处理消息时替换
         self.reset()
 
     def discard_exceeding(self, max_tokens, cur_tokens=None):
+        self._apply_summary()
         precise = True
         try:
             cur_tokens = self.calc_tokens()
@@ -27,12 +36,15 @@ class ChatGPTSession(Session):
                 raise e
             logger.debug("Exception when counting tokens precisely for query: {}".format(e))
         while cur_tokens > max_tokens:
-            if len(self.messages) > 2:
-                self.messages.pop(1)
+            start = self._history_start()
+            if len(self.messages) > start + 1:
+                message = self.messages.pop(start)
+            elif start == 2:
+                message = self.messages.pop(1)  # 只剩摘要和最后一条消息时丢弃摘要
             elif len(self.messages) == 2 and self.messages[1]["role"] == "assistant":
-                self.messages.pop(1)
+                message = self.messages.pop(1)
                 if precise:
-                    cur_tokens = self.calc_tokens()
+                    cur_tokens -= self._pop_cached_tokens(message)
                 else:
                     cur_tokens = cur_tokens - max_tokens
                 break
@@ -43,35 +55,118 @@ class ChatGPTSession(Session):
                 logger.debug("max_tokens={}, total_tokens={}, len(messages)={}".format(max_tokens, cur_tokens, len(self.messages)))
                 break
             if precise:
-                cur_tokens = self.calc_tokens()
+                cur_tokens -= self._pop_cached_tokens(message)
             else:
                 cur_tokens = cur_tokens - max_tokens
+        if precise:
+            self._compact(max_tokens, cur_tokens)
         return cur_tokens
 
+    def _history_start(self):
+        """
+        历史消息的起始位置，跳过system prompt和摘要
+        """
+        if len(self.messages) > 1 and self.messages[1]["role"] == "system" and self.messages[1]["content"].startswith(SUMMARY_PREFIX):
+            return 2
+        return 1
+
+    def _compact(self, max_tokens, cur_tokens):
+        """
+        token数超过conversation_max_tokens的session_compaction_threshold时，在后台将较早的消息压缩为摘要，
+        只保留最近的session_compaction_keep_messages条消息原文
+        """
+        if not conf().get("session_compaction", False) or self.summary_func is None or self.compacting or self.pending_summary is not None:
+            return
+        if cur_tokens < max_tokens * conf().get("session_compaction_threshold", 0.7):
+            return
+        start = self._history_start()
+        end = len(self.messages) - conf().get("session_compaction_keep_messages", 4)
+        if end - start < 2:
+            return
+        summary = self.messages[1]["content"][len(SUMMARY_PREFIX) :] if start == 2 else None
+        self.compacting = True
+        SessionSummarizer().submit(self, summary, self.messages[start:end])
+
+    def _apply_summary(self):
+        """
+        用后台生成的摘要替换被压缩的消息(以及旧的摘要)，会话在此期间被重置或修改时放弃
+        """
+        if self.pending_summary is None:
+            return
+        messages, summary = self.pending_summary
+        self.pending_summary = None
+        start = self._history_start()
+        current = self.messages[start : start + len(messages)]
+        if len(current) != len(messages) or any(a is not b for a, b in zip(current, messages)):
+            logger.debug("[ChatGPTSession] session {} changed during compaction, discard summary".format(self.session_id))
+            return
+        self.messages[1 : start + len(messages)] = [{"role": "system", "content": SUMMARY_PREFIX + summary}]
+
     def calc_tokens(self):
-        return num_tokens_from_messages(self.messages, self.model)
+        """
+        计算当前会话的token数，已编码过且内容未变的消息直接使用缓存的token数
+        """
+        cache = {}
+        num_tokens = 0
+        for message in self.messages:
+            entry = self.token_cache.get(id(message))
+            if entry is None or entry[0] is not message or entry[1] != message.get("content"):
+                entry = (message, message.get("content"), num_tokens_from_message(message, self.model))
+            cache[id(message)] = entry
+            num_tokens += entry[2]
+        # 只保留当前消息的缓存，被外部移除的消息随之清理
+        self.token_cache = cache
+        return num_tokens + num_tokens_for_reply_priming(self.model)
+
+    def _pop_cached_tokens(self, message):
+        entry = self.token_cache.pop(id(message), None)
+        if entry is None or entry[0] is not message:
+            return num_tokens_from_message(message, self.model)
+        return entry[2]
 
 
 # refer to https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
 def num_tokens_from_messages(messages, model):
     """Returns the number of tokens used by a list of messages."""
+    num_tokens = 0
+    for message in messages:
+        num_tokens += num_tokens_from_message(message, model)
+    return num_tokens + num_tokens_for_reply_priming(model)
+
+
+def num_tokens_from_message(message, model):
+    """Returns the number of tokens used by a single message, excluding the reply priming."""
+    if model in ["wenxin", "xunfei"]:
+        return len(message["content"])
+    encoding, tokens_per_message, tokens_per_name = get_token_encoder(model)
+    num_tokens = tokens_per_message
+    for key, value in message.items():
+        num_tokens += len(encoding.encode(value))
+        if key == "name":
+            num_tokens += tokens_per_name
+    return num_tokens
+
 
+def num_tokens_for_reply_priming(model):
     if model in ["wenxin", "xunfei"]:
-        return num_tokens_by_character(messages)
+        return 0
+    return 3  # every reply is primed with <|start|>assistant<|message|>
 
+
+@functools.lru_cache(maxsize=None)
+def get_token_encoder(model):
+    """
+    Returns (encoding, tokens_per_message, tokens_per_name) for the model.
+    Cached per model so that tiktoken.encoding_for_model only runs once.
+    """
     import tiktoken
 
     if model in ["gpt-3.5-turbo-0301", "gpt-35-turbo"]:
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
+        return get_token_encoder("gpt-3.5-turbo")
     elif model in ["gpt-4-0314", "gpt-4-0613", "gpt-4-32k", "gpt-4-32k-0613", "gpt-3.5-turbo-0613",
                    "gpt-3.5-turbo-16k", "gpt-3.5-turbo-16k-0613", "gpt-35-turbo-16k"]:
-        return num_tokens_from_messages(messages, model="gpt-4")
+        return get_token_encoder("gpt-4")
 
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        logger.debug("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
     if model == "gpt-3.5-turbo":
         tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
         tokens_per_name = -1  # if there's a name, the role is omitted
@@ -80,16 +175,13 @@ def num_tokens_from_messages(messages, model):
         tokens_per_name = 1
     else:
         logger.warn(f"num_tokens_from_messages() is not implemented for model {model}. Returning num tokens assuming gpt-3.5-turbo.")
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
-    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
-    return num_tokens
+        return get_token_encoder("gpt-3.5-turbo")
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        logger.debug("Warning: model not found. Using cl100k_base encoding.")
+        encoding = tiktoken.get_encoding("cl100k_base")
+    return encoding, tokens_per_message, tokens_per_name
 
 
 def num_tokens_by_character(messages):
@@ -98,3 +190,48 @@ def num_tokens_by_character(messages):
     for msg in messages:
         tokens += len(msg["content"])
     return tokens
+
+
+if __name__ == "__main__":
+    # 裁剪长会话的基准测试: python -m bot.chatgpt.chat_gpt_session [model]
+    # 对比每次pop后重新编码全部消息(原实现)与使用缓存token数的耗时
+    import sys
+    import time
+
+    model = sys.argv[1] if len(sys.argv) > 1 else "gpt-3.5-turbo"
+    turns = 1000
+
+    def build_session():
+        session = ChatGPTSession("bench", system_prompt="You are a helpful assistant.", model=model)
+        for i in range(turns):
+            session.add_query("第{}轮提问：请介绍一下token是如何计算的，并举几个例子。".format(i))
+            session.add_reply("第{}轮回答：token是模型处理文本的基本单位，英文单词通常对应一到多个token，中文每个字大约对应一到两个token。".format(i))
+        return session
+
+    def discard_full_recount(session, max_tokens):
+        cur_tokens = num_tokens_from_messages(session.messages, model)
+        while cur_tokens > max_tokens and len(session.messages) > 2:
+            session.messages.pop(1)
+            cur_tokens = num_tokens_from_messages(session.messages, model)
+        return cur_tokens
+
+    max_tokens = 1000
+    session = build_session()
+    start = time.perf_counter()
+    expected = discard_full_recount(session, max_tokens)
+    full_cost = time.perf_counter() - start
+
+    session = build_session()
+    start = time.perf_counter()
+    actual = session.discard_exceeding(max_tokens)
+    cached_cost = time.perf_counter() - start
+    # 会话持续对话时，只有新增的消息需要编码
+    session.add_query("新的提问")
+    start = time.perf_counter()
+    session.discard_exceeding(max_tokens)
+    next_cost = time.perf_counter() - start
+
+    assert actual == expected, (actual, expected)
+    print("{} turns, model={}, tokens after trimming={}".format(turns, model, actual))
+    print("recount after every pop: {:.3f}s".format(full_cost))
+    print("cached incremental: {:.3f}s, next turn: {:.3f}ms".format(cached_cost, next_cost * 1000))
@@ -0,0 +1,49 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from common.log import logger
+from common.metrics import Metrics
+from common.singleton import singleton
+from config import conf
+
+SUMMARY_PREFIX = "以下是之前对话的摘要：\n"
+
+SUMMARY_PROMPT = "你负责压缩对话历史。请将已有的摘要和新的对话内容合并为一段简洁的摘要，" "保留用户的身份、偏好、提到的重要事实、已得出的结论和未完成的事项，不超过{}字。只输出摘要内容。"
+
+
+@singleton
+class SessionSummarizer(object):
+    """
+    在后台用较便宜的模型把会话中较早的消息压缩为摘要，结果交给会话在下次处理消息时替换原消息
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="session_summarizer")
+
+    def submit(self, session, summary, messages):
+        """
+        :param session: 需要压缩的会话，通过session.summary_func调用所属bot的接口生成摘要
+        :param summary: 已有的摘要，没有时为None
+        :param messages: 需要压缩的消息
+        """
+        self.executor.submit(self._summarize, session, summary, messages)
+
+    def _summarize(self, session, summary, messages):
+        try:
+            content = "已有摘要：\n{}\n\n新的对话：\n{}".format(
+                summary or "无",
+                "\n".join("{}: {}".format(m["role"], m["content"]) for m in messages),
+            )
+            result = session.summary_func(
+                [
+                    {"role": "system", "content": SUMMARY_PROMPT.format(conf().get("session_compaction_summary_length", 500))},
+                    {"role": "user", "content": content},
+                ]
+            )
+            session.pending_summary = (messages, result.strip())
+            Metrics().incr("session_compaction")
+            logger.debug("[SessionSummarizer] session {} summarized {} messages".format(session.session_id, len(messages)))
+        except Exception as e:
+            Metrics().incr("session_compaction_failed")
+            logger.warn("[SessionSummarizer] summarize session {} failed: {}".format(session.session_id, e))
+        finally:
+            session.compacting = False
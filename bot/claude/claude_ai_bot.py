@@ -2,13 +2,13 @@ import re
 import time
 import json
 import uuid
-from curl_cffi import requests
 from bot.bot import Bot
 from bot.claude.claude_ai_session import ClaudeAiSession
 from bot.openai.open_ai_image import OpenAIImage
 from bot.session_manager import SessionManager
 from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
+from common import http_client
 from common.log import logger
 from config import conf
 
@@ -65,7 +65,7 @@ class ClaudeAIBot(Bot, OpenAIImage):
             'Cookie': f'{self.claude_api_cookie}'
         }
         try:
-            response = requests.get(url, headers=headers, impersonate="chrome110", proxies =self.proxies, timeout=400)
+            response = http_client.get(url, headers=headers, impersonate="chrome110", proxies=self.proxies, timeout=400)
             res = json.loads(response.text)
             uuid = res[0]['uuid']
         except:
@@ -114,7 +114,7 @@ class ClaudeAIBot(Bot, OpenAIImage):
             'Sec-Fetch-Site': 'same-origin',
             'TE': 'trailers'
         }
-        response = requests.post(url, headers=headers, data=payload, impersonate="chrome110", proxies=self.proxies, timeout=400)
+        response = http_client.post(url, headers=headers, data=payload, impersonate="chrome110", proxies=self.proxies, timeout=400)
         # Returns JSON of the newly created conversation information
         return response.json()
         
@@ -176,7 +176,7 @@ class ClaudeAIBot(Bot, OpenAIImage):
                 'TE': 'trailers'
             }
 
-            res = requests.post(base_url + "/api/append_message", headers=headers, data=payload,impersonate="chrome110",proxies= self.proxies,timeout=400)
+            res = http_client.post(base_url + "/api/append_message", headers=headers, data=payload, impersonate="chrome110", proxies=self.proxies, timeout=400)
             if res.status_code == 200 or "pemission" in res.text:
                 # execute success
                 decoded_data = res.content.decode("utf-8")
@@ -1,17 +1,15 @@
 # access LinkAI knowledge base platform
 # docs: https://link-ai.tech/platform/link-app/wechat
 
-import time
-
-import requests
-
 from bot.bot import Bot
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
 from bot.openai.open_ai_image import OpenAIImage
 from bot.session_manager import SessionManager
 from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
+from common import http_client
 from common.log import logger
+from common.retry import RetryLater, RetryPolicy, retry_after_seconds
 from config import conf
 
 
@@ -22,14 +20,15 @@ class LinkAIBot(Bot, OpenAIImage):
 
     def __init__(self):
         super().__init__()
-        self.sessions = SessionManager(ChatGPTSession, model=conf().get("model") or "gpt-3.5-turbo")
+        self.sessions = SessionManager(ChatGPTSession, model=conf().get("model") or "gpt-3.5-turbo", summary_func=self.summarize)
         self.args = {}
+        self.retry_policy = RetryPolicy()
 
     def reply(self, query, context: Context = None) -> Reply:
         if context.type == ContextType.TEXT:
-            return self._chat(query, context)
+            return self._chat(query, context, context.get("retry_count", 0))
         elif context.type == ContextType.IMAGE_CREATE:
-            ok, res = self.create_img(query, 0)
+            ok, res = self.create_img(query, context.get("retry_count", 0), context=context)
             if ok:
                 reply = Reply(ReplyType.IMAGE_URL, res)
             else:
@@ -47,11 +46,6 @@ class LinkAIBot(Bot, OpenAIImage):
         :param retry_count: 当前递归重试次数
         :return: 回复
         """
-        if retry_count >= 2:
-            # exit from retry 2 times
-            logger.warn("[LINKAI] failed after maximum number of retry times")
-            return Reply(ReplyType.ERROR, "请再问我一次吧")
-
         try:
             # load config
             if context.get("generate_breaked_by"):
@@ -84,14 +78,14 @@ class LinkAIBot(Bot, OpenAIImage):
 
             # do http request
             base_url = conf().get("linkai_api_base", "https://api.link-ai.chat")
-            res = requests.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
-                                timeout=conf().get("request_timeout", 180))
+            res = http_client.post(url=base_url + "/v1/chat/completions", json=body, headers=headers, timeout=conf().get("request_timeout", 180))
             if res.status_code == 200:
                 # execute success
                 response = res.json()
                 reply_content = response["choices"][0]["message"]["content"]
                 total_tokens = response["usage"]["total_tokens"]
                 logger.info(f"[LINKAI] reply={reply_content}, total_tokens={total_tokens}")
+                context["total_tokens"] = total_tokens
                 self.sessions.session_reply(reply_content, session_id, total_tokens)
                 return Reply(ReplyType.TEXT, reply_content)
 
@@ -101,22 +95,46 @@ class LinkAIBot(Bot, OpenAIImage):
                 logger.error(f"[LINKAI] chat failed, status_code={res.status_code}, "
                              f"msg={error.get('message')}, type={error.get('type')}")
 
-                if res.status_code >= 500:
-                    # server error, need retry
-                    time.sleep(2)
-                    logger.warn(f"[LINKAI] do retry, times={retry_count}")
-                    return self._chat(query, context, retry_count + 1)
+                if res.status_code >= 500 or res.status_code == 429:
+                    # server error or rate limit, need retry
+                    return self._retry_chat(query, context, retry_count, retry_after_seconds(res.headers))
 
                 return Reply(ReplyType.ERROR, "提问太快啦，请休息一下再问我吧")
 
+        except RetryLater:
+            raise
         except Exception as e:
             logger.exception(e)
             # retry
-            time.sleep(2)
-            logger.warn(f"[LINKAI] do retry, times={retry_count}")
-            return self._chat(query, context, retry_count + 1)
+            return self._retry_chat(query, context, retry_count)
 
-    def reply_text(self, session: ChatGPTSession, app_code="", retry_count=0) -> dict:
+    def _retry_chat(self, query, context, retry_count, retry_after=None) -> Reply:
+        retry_delay = self.retry_policy.next_delay(retry_count, retry_after, context)
+        # 重试时会重新加入提问，先撤销本次的提问
+        self.sessions.session_rollback(query, context["session_id"])
+        if retry_delay is None:
+            logger.warn("[LINKAI] failed after maximum number of retry times")
+            return Reply(ReplyType.ERROR, "请再问我一次吧")
+        logger.warn(f"[LINKAI] do retry, times={retry_count}, delay={retry_delay:.1f}s")
+        self.retry_policy.wait(retry_delay, retry_count + 1, context)
+        return self._chat(query, context, retry_count + 1)
+
+    def summarize(self, messages) -> str:
+        """
+        用session_compaction_model生成会话摘要，通过LinkAI接口请求，不使用应用的知识库
+        """
+        body = {
+            "messages": messages,
+            "model": conf().get("session_compaction_model") or "gpt-3.5-turbo",
+            "temperature": 0,
+        }
+        headers = {"Authorization": "Bearer " + conf().get("linkai_api_key")}
+        base_url = conf().get("linkai_api_base", "https://api.link-ai.chat")
+        res = http_client.post(url=base_url + "/v1/chat/completions", json=body, headers=headers, timeout=conf().get("request_timeout", 180))
+        res.raise_for_status()
+        return res.json()["choices"][0]["message"]["content"]
+
+    def reply_text(self, session: ChatGPTSession, app_code="", retry_count=0, context=None) -> dict:
         if retry_count >= 2:
             # exit from retry 2 times
             logger.warn("[LINKAI] failed after maximum number of retry times")
@@ -142,8 +160,7 @@ class LinkAIBot(Bot, OpenAIImage):
 
             # do http request
             base_url = conf().get("linkai_api_base", "https://api.link-ai.chat")
-            res = requests.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
-                                timeout=conf().get("request_timeout", 180))
+            res = http_client.post(url=base_url + "/v1/chat/completions", json=body, headers=headers, timeout=conf().get("request_timeout", 180))
             if res.status_code == 200:
                 # execute success
                 response = res.json()
@@ -164,9 +181,11 @@ class LinkAIBot(Bot, OpenAIImage):
 
                 if res.status_code >= 500:
                     # server error, need retry
-                    time.sleep(2)
-                    logger.warn(f"[LINKAI] do retry, times={retry_count}")
-                    return self.reply_text(session, app_code, retry_count + 1)
+                    retry_delay = self.retry_policy.next_delay(retry_count, retry_after_seconds(res.headers), context)
+                    if retry_delay is not None:
+                        logger.warn(f"[LINKAI] do retry, times={retry_count}")
+                        self.retry_policy.wait(retry_delay, retry_count + 1, context)
+                        return self.reply_text(session, app_code, retry_count + 1, context)
 
                 return {
                     "total_tokens": 0,
@@ -174,9 +193,14 @@ class LinkAIBot(Bot, OpenAIImage):
                     "content": "提问太快啦，请休息一下再问我吧"
                 }
 
+        except RetryLater:
+            raise
         except Exception as e:
             logger.exception(e)
             # retry
-            time.sleep(2)
+            retry_delay = self.retry_policy.next_delay(retry_count, context=context)
+            if retry_delay is None:
+                return {"total_tokens": 0, "completion_tokens": 0, "content": "请再问我一次吧"}
             logger.warn(f"[LINKAI] do retry, times={retry_count}")
-            return self.reply_text(session, app_code, retry_count + 1)
+            self.retry_policy.wait(retry_delay, retry_count + 1, context)
+            return self.reply_text(session, app_code, retry_count + 1, context)
@@ -0,0 +1,319 @@
+"""
+OpenAI兼容接口的后端池，在多个api key和endpoint(包括azure部署)之间分配请求
+    - 按剩余的rpm/tpm额度选择后端，额度由本地滑动窗口统计，并根据429返回的headers调整
+    - 连续失败的后端暂时摘除，摘除时间指数增长，到期后先放行一个试探请求
+    - 可选后台健康检查，定期探测已摘除的后端
+    - 每个后端的请求延迟记录到Metrics
+配置示例:
+    "open_ai_backends": [
+        {"name": "key1", "api_key": "sk-xxx", "rpm": 3500, "tpm": 90000},
+        {"name": "azure-east", "api_type": "azure", "api_key": "xxx", "api_base": "https://xxx.openai.azure.com/",
+         "api_version": "2023-06-01-preview", "deployment_id": "gpt-35-turbo", "rpm": 300, "tpm": 120000}
+    ]
+"""
+import re
+import threading
+import time
+from collections import deque
+
+import openai
+import openai.error
+
+from common.log import logger
+from common.metrics import Metrics
+from common.retry import retry_after_seconds
+from config import conf
+
+EJECT_AFTER_FAILURES = 3  # 连续失败多少次后摘除
+EJECT_BASE_SECONDS = 30
+EJECT_MAX_SECONDS = 600
+
+
+class Backend(object):
+    def __init__(self, api_key, api_base=None, api_type=None, api_version=None, deployment_id=None, rpm=0, tpm=0, weight=1, name=None):
+        self.api_key = api_key
+        self.api_base = api_base
+        self.api_type = api_type
+        self.api_version = api_version
+        self.deployment_id = deployment_id
+        self.rpm = rpm  # 每分钟请求数上限，0表示不限制
+        self.tpm = tpm  # 每分钟token数上限，0表示不限制
+        self.weight = weight
+        self.name = name or "{}#{}".format(api_base or "openai", (api_key or "")[-4:])
+        self.requests = deque()  # 最近一分钟的请求时间
+        self.tokens = deque()  # 最近一分钟的(时间, token数)
+        self.token_total = 0
+        self.inflight = 0
+        self.failures = 0  # 连续失败次数
+        self.ejections = 0  # 连续摘除次数，用于计算摘除时间
+        self.unavailable_until = 0  # 摘除或限流的截止时间(monotonic)
+        self.trial = False  # 摘除到期后是否已放行试探请求
+        self.latency = None  # 请求延迟的指数移动平均(秒)
+
+    def request_args(self) -> dict:
+        """
+        调用openai接口时传入的参数
+        """
+        args = {"api_key": self.api_key}
+        if self.api_base:
+            args["api_base"] = self.api_base
+        if self.api_type:
+            args["api_type"] = self.api_type
+        if self.api_version:
+            args["api_version"] = self.api_version
+        if self.deployment_id:
+            args["deployment_id"] = self.deployment_id
+        return args
+
+    def _expire(self, now):
+        while self.requests and now - self.requests[0] > 60:
+            self.requests.popleft()
+        while self.tokens and now - self.tokens[0][0] > 60:
+            self.token_total -= self.tokens.popleft()[1]
+
+    def remaining(self, now) -> float:
+        """
+        剩余额度的比例，取rpm和tpm中较紧张的一个，请求在acquire时已计入requests，进行中的请求不再重复计算
+        """
+        self._expire(now)
+        ratio = 1.0
+        if self.rpm:
+            ratio = min(ratio, 1 - len(self.requests) / self.rpm)
+        if self.tpm:
+            ratio = min(ratio, 1 - self.token_total / self.tpm)
+        return ratio
+
+    def available(self, now) -> bool:
+        return now >= self.unavailable_until
+
+
+class BackendPool(object):
+    """
+    后端池，线程安全，acquire选择后端，请求结束后调用release报告结果
+    """
+
+    def __init__(self, backends):
+        if not backends:
+            raise ValueError("BackendPool needs at least one backend")
+        self.backends = backends
+        self.lock = threading.Lock()
+
+    def acquire(self) -> Backend:
+        """
+        选择剩余额度最多的可用后端，额度相同时选择延迟较低的；全部不可用时选择最早恢复的后端
+        """
+        with self.lock:
+            now = time.monotonic()
+            candidates = [b for b in self.backends if b.available(now) and not b.trial]
+            if not candidates:
+                backend = min(self.backends, key=lambda b: b.unavailable_until)
+            else:
+                backend = max(candidates, key=lambda b: (b.remaining(now) * b.weight, -(b.latency or 0)))
+            if backend.failures >= EJECT_AFTER_FAILURES:
+                backend.trial = True  # 摘除到期后只放行一个试探请求，结果返回前不再分配
+            backend.requests.append(now)
+            backend.inflight += 1
+            return backend
+
+    def release(self, backend: Backend, latency=None, tokens=0, error=None):
+        """
+        报告请求结果
+        :param latency: 请求耗时(秒)
+        :param tokens: 实际消耗的token数，用于tpm统计
+        :param error: 请求失败时的异常
+        """
+        with self.lock:
+            now = time.monotonic()
+            backend.inflight -= 1
+            backend.trial = False
+            if tokens:
+                backend.tokens.append((now, tokens))
+                backend.token_total += tokens
+            if error is None:
+                backend.failures = 0
+                backend.ejections = 0
+                if latency is not None:
+                    backend.latency = latency if backend.latency is None else backend.latency * 0.8 + latency * 0.2
+            elif isinstance(error, openai.error.RateLimitError):
+                # 429只说明额度用尽，按返回的headers暂停使用，不计入失败
+                cooldown = rate_limit_cooldown(getattr(error, "headers", None) or {})
+                backend.unavailable_until = max(backend.unavailable_until, now + cooldown)
+                logger.warn("[BackendPool] backend {} rate limited, cooldown {:.1f}s".format(backend.name, cooldown))
+            elif is_backend_error(error):
+                backend.failures += 1
+                if backend.failures >= EJECT_AFTER_FAILURES:
+                    seconds = min(EJECT_BASE_SECONDS * 2**backend.ejections, EJECT_MAX_SECONDS)
+                    if isinstance(error, (openai.error.AuthenticationError, openai.error.PermissionError)):
+                        seconds = EJECT_MAX_SECONDS
+                    backend.ejections += 1
+                    backend.unavailable_until = now + seconds
+                    Metrics().incr("openai_backend_ejected", label=backend.name)
+                    logger.warn("[BackendPool] eject backend {} for {}s after {} failures: {}".format(backend.name, seconds, backend.failures, error))
+        if latency is not None:
+            Metrics().observe("openai_backend_latency_seconds", latency, label=backend.name)
+        if error is not None:
+            Metrics().incr("openai_backend_errors", label=backend.name)
+
+    def request(self, func, api_key=None, **kwargs):
+        """
+        通过后端池调用openai接口，如 pool.request(openai.ChatCompletion.create, messages=messages, model=model)
+        :param api_key: 用户自己的api key，指定时不经过后端池
+        """
+        if api_key:
+            return func(api_key=api_key, **kwargs)
+        backend = self.acquire()
+        start = time.monotonic()
+        try:
+            response = func(**{**kwargs, **backend.request_args()})
+        except Exception as e:
+            self.release(backend, error=e)
+            raise
+        self.release(backend, time.monotonic() - start, usage_tokens(response))
+        return response
+
+    async def arequest(self, func, api_key=None, **kwargs):
+        """
+        request的异步版本，func为openai的异步接口，如openai.ChatCompletion.acreate
+        """
+        if api_key:
+            return await func(api_key=api_key, **kwargs)
+        backend = self.acquire()
+        start = time.monotonic()
+        try:
+            response = await func(**{**kwargs, **backend.request_args()})
+        except Exception as e:
+            self.release(backend, error=e)
+            raise
+        self.release(backend, time.monotonic() - start, usage_tokens(response))
+        return response
+
+    def check_health(self):
+        """
+        探测已摘除的后端，探测成功则立即恢复
+        """
+        now = time.monotonic()
+        for backend in self.backends:
+            if backend.failures < EJECT_AFTER_FAILURES or backend.available(now):
+                continue
+            try:
+                openai.Model.list(request_timeout=10, **backend.request_args())
+            except Exception as e:
+                logger.debug("[BackendPool] health check failed for {}: {}".format(backend.name, e))
+                continue
+            with self.lock:
+                backend.failures = 0
+                backend.ejections = 0
+                backend.unavailable_until = 0
+            logger.info("[BackendPool] backend {} recovered".format(backend.name))
+
+    def start_health_check(self, interval):
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.check_health()
+                except Exception as e:
+                    logger.exception("[BackendPool] health check error: {}".format(e))
+
+        threading.Thread(target=run, name="openai_backend_health_check", daemon=True).start()
+
+    def report(self) -> str:
+        now = time.monotonic()
+        lines = []
+        with self.lock:
+            for b in self.backends:
+                lines.append(
+                    "{}: {}, remaining={:.0%}, latency={}".format(
+                        b.name,
+                        "available" if b.available(now) else "unavailable for {:.0f}s".format(b.unavailable_until - now),
+                        max(b.remaining(now), 0),
+                        "{:.3f}s".format(b.latency) if b.latency is not None else "-",
+                    )
+                )
+        return "\n".join(lines)
+
+
+def usage_tokens(response) -> int:
+    """
+    返回结果中的token用量，流式返回没有usage时为0
+    """
+    try:
+        return response["usage"]["total_tokens"]
+    except (KeyError, TypeError):
+        return 0
+
+
+def is_backend_error(error) -> bool:
+    """
+    是否为后端自身的故障，请求内容错误(如超出上下文长度)不计入
+    """
+    return isinstance(
+        error,
+        (
+            openai.error.APIError,
+            openai.error.Timeout,
+            openai.error.APIConnectionError,
+            openai.error.ServiceUnavailableError,
+            openai.error.AuthenticationError,
+            openai.error.PermissionError,
+        ),
+    )
+
+
+def parse_duration(value) -> float:
+    """
+    解析x-ratelimit-reset-*中的时间，如 "1s"、"6m0s"、"20ms"
+    """
+    seconds = 0.0
+    for number, unit in re.findall(r"([\d.]+)(ms|s|m|h)", value or ""):
+        seconds += float(number) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return seconds
+
+
+def rate_limit_cooldown(headers) -> float:
+    """
+    根据429返回的headers计算需要暂停的秒数，优先使用retry-after，其次是耗尽的额度的重置时间
+    """
+    retry_after = retry_after_seconds(headers)
+    if retry_after is not None:
+        return retry_after
+    cooldown = 0
+    for kind in ["requests", "tokens"]:
+        if headers.get("x-ratelimit-remaining-{}".format(kind)) == "0":
+            cooldown = max(cooldown, parse_duration(headers.get("x-ratelimit-reset-{}".format(kind))))
+    return cooldown or 20
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_backend_pool(azure=False) -> BackendPool:
+    """
+    获取按配置创建的后端池，同一进程中的ChatGPTBot和OpenAIImage共用，额度统一计算
+    azure的后端池只使用open_ai_backends中api_type为azure的后端，否则只使用其余的后端，
+    没有对应的后端时，使用open_ai_api_key和open_ai_api_base(azure时加上azure_deployment_id等)作为唯一的后端
+    """
+    with _pools_lock:
+        pool = _pools.get(azure)
+        if pool is None:
+            configs = [c for c in conf().get("open_ai_backends") or [] if (c.get("api_type") == "azure") == azure]
+            if configs:
+                backends = [Backend(**c) for c in configs]
+            elif azure:
+                backends = [
+                    Backend(
+                        conf().get("open_ai_api_key"),
+                        conf().get("open_ai_api_base"),
+                        "azure",
+                        conf().get("azure_api_version") or "2023-06-01-preview",
+                        conf().get("azure_deployment_id"),
+                    )
+                ]
+            else:
+                backends = [Backend(conf().get("open_ai_api_key"), conf().get("open_ai_api_base"))]
+            pool = _pools[azure] = BackendPool(backends)
+            interval = conf().get("open_ai_backend_health_check_interval", 0)
+            if interval and len(backends) > 1:
+                pool.start_health_check(interval)
+        return pool
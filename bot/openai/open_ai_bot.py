@@ -62,6 +62,7 @@ class OpenAIBot(Bot, OpenAIImage):
                         result["completion_tokens"],
                         result["content"],
                     )
+                    context["total_tokens"] = total_tokens
                     logger.debug(
                         "[OPEN_AI] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(str(session), session_id, reply_content, completion_tokens)
                     )
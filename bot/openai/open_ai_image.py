@@ -1,9 +1,9 @@
-import time
-
 import openai
 import openai.error
 
+from bot.openai.backend_pool import get_backend_pool
 from common.log import logger
+from common.retry import RetryLater, RetryPolicy, retry_after_seconds
 from common.token_bucket import TokenBucket
 from config import conf
 
@@ -15,12 +15,13 @@ class OpenAIImage(object):
         if conf().get("rate_limit_dalle"):
             self.tb4dalle = TokenBucket(conf().get("rate_limit_dalle", 50))
 
-    def create_img(self, query, retry_count=0, api_key=None):
+    def create_img(self, query, retry_count=0, api_key=None, context=None):
         try:
-            if conf().get("rate_limit_dalle") and not self.tb4dalle.get_token():
+            if conf().get("rate_limit_dalle") and not self.tb4dalle.acquire(context):
                 return False, "请求太快了，请休息一下再问我吧"
             logger.info("[OPEN_AI] image_query={}".format(query))
-            response = openai.Image.create(
+            response = get_backend_pool().request(
+                openai.Image.create,
                 api_key=api_key,
                 prompt=query,  # 图片描述
                 n=1,  # 每次生成图片的数量
@@ -29,12 +30,16 @@ class OpenAIImage(object):
             image_url = response["data"][0]["url"]
             logger.info("[OPEN_AI] image_url={}".format(image_url))
             return True, image_url
+        except RetryLater:
+            raise
         except openai.error.RateLimitError as e:
             logger.warn(e)
-            if retry_count < 1:
-                time.sleep(5)
-                logger.warn("[OPEN_AI] ImgCreate RateLimit exceed, 第{}次重试".format(retry_count + 1))
-                return self.create_img(query, retry_count + 1)
+            retry_policy = RetryPolicy(max_retries=1)
+            retry_delay = retry_policy.next_delay(retry_count, retry_after_seconds(e.headers), context)
+            if retry_delay is not None:
+                logger.warn("[OPEN_AI] ImgCreate RateLimit exceed, 第{}次重试, {:.1f}s后".format(retry_count + 1, retry_delay))
+                retry_policy.wait(retry_delay, retry_count + 1, context)
+                return self.create_img(query, retry_count + 1, api_key, context)
             else:
                 return False, "提问太快啦，请休息一下再问我吧"
         except Exception as e:
@@ -1,4 +1,4 @@
-from common.expired_dict import ExpiredDict
+from bot.session_store import create_session_store
 from common.log import logger
 from config import conf
 
@@ -29,6 +29,16 @@ class Session(object):
         assistant_item = {"role": "assistant", "content": reply}
         self.messages.append(assistant_item)
 
+    def dump(self) -> dict:
+        """
+        会话中需要持久化的内容
+        """
+        return {"system_prompt": self.system_prompt, "messages": self.messages}
+
+    def load(self, data: dict):
+        self.system_prompt = data["system_prompt"]
+        self.messages = data["messages"]
+
     def discard_exceeding(self, max_tokens=None, cur_tokens=None):
         raise NotImplementedError
 
@@ -38,13 +48,12 @@ class Session(object):
 
 class SessionManager(object):
     def __init__(self, sessioncls, **session_args):
-        if conf().get("expires_in_seconds"):
-            sessions = ExpiredDict(conf().get("expires_in_seconds"))
-        else:
-            sessions = dict()
-        self.sessions = sessions
         self.sessioncls = sessioncls
         self.session_args = session_args
+        self.sessions = create_session_store(self._create_session, on_evict=self.on_session_evicted)
+
+    def _create_session(self, session_id, system_prompt=None):
+        return self.sessioncls(session_id, system_prompt, **self.session_args)
 
     def build_session(self, session_id, system_prompt=None):
         """
@@ -52,13 +61,15 @@ class SessionManager(object):
         如果system_prompt不会空，会更新session的system_prompt并重置session
         """
         if session_id is None:
-            return self.sessioncls(session_id, system_prompt, **self.session_args)
+            return self._create_session(session_id, system_prompt)
 
-        if session_id not in self.sessions:
-            self.sessions[session_id] = self.sessioncls(session_id, system_prompt, **self.session_args)
+        session = self.sessions.get(session_id)
+        if session is None:
+            session = self._create_session(session_id, system_prompt)
+            self.sessions.save(session_id, session)
         elif system_prompt is not None:  # 如果有新的system_prompt，更新并重置session
-            self.sessions[session_id].set_system_prompt(system_prompt)
-        session = self.sessions[session_id]
+            session.set_system_prompt(system_prompt)
+            self.sessions.save(session_id, session)
         return session
 
     def session_query(self, query, session_id):
@@ -70,6 +81,7 @@ class SessionManager(object):
             logger.debug("prompt tokens used={}".format(total_tokens))
         except Exception as e:
             logger.debug("Exception when counting tokens precisely for prompt: {}".format(str(e)))
+        self.sessions.save(session_id, session)
         return session
 
     def session_reply(self, reply, session_id, total_tokens=None):
@@ -81,8 +93,45 @@ class SessionManager(object):
             logger.debug("raw total_tokens={}, savesession tokens={}".format(total_tokens, tokens_cnt))
         except Exception as e:
             logger.debug("Exception when counting tokens precisely for session: {}".format(str(e)))
+        self.sessions.save(session_id, session)
         return session
 
+    def session_rollback(self, query, session_id):
+        """
+        撤销session_query加入的提问，用于请求失败后消息将被重新处理的情况
+        """
+        session = self.sessions.get(session_id)
+        if session is None:
+            return
+        for i in range(len(session.messages) - 1, -1, -1):
+            message = session.messages[i]
+            if message["role"] == "user" and message["content"] == query:
+                del session.messages[i]
+                break
+        self.sessions.save(session_id, session)
+
+    def session_overwrite(self, query, reply, session_id):
+        """
+        用reply替换本轮提问后的内容(包括自己的回复)，用于对冲请求中未被采用的bot，使各bot的会话保持一致
+        """
+        if session_id is None:
+            return None
+        session = self.build_session(session_id)
+        # 本轮提问只可能是最后一条或倒数第二条消息，不能删除更早的同样的提问
+        for i in range(len(session.messages) - 1, max(len(session.messages) - 3, -1), -1):
+            message = session.messages[i]
+            if message["role"] == "user" and message["content"] == query:
+                del session.messages[i:]
+                break
+        session.add_query(query)
+        return self.session_reply(reply, session_id)
+
+    def on_session_evicted(self, session_id, session, reason):
+        """
+        会话因过期或超出max_sessions被移除时调用，子类可在此保存或归档会话
+        """
+        logger.debug("[SessionManager] session evicted, session_id={}, reason={}".format(session_id, reason))
+
     def clear_session(self, session_id):
         if session_id in self.sessions:
             del self.sessions[session_id]
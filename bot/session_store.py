@@ -0,0 +1,281 @@
+"""
+会话存储，SessionManager通过SessionStore读写会话，可替换为持久化的实现
+    memory: 保存在进程内存中，重启后丢失(默认)
+    sqlite: 内存缓存 + SQLite(WAL模式)持久化，首次访问时从数据库加载，修改后由后台线程批量写入
+"""
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from common.expired_dict import ExpiredDict
+from common.log import logger
+from config import conf, get_appdata_dir
+
+
+class SessionStore(object):
+    """
+    会话存储接口，按session_id读写Session对象
+    会话内容在原对象上修改，修改后需调用save通知存储，持久化的实现据此写回
+    """
+
+    def get(self, session_id):
+        raise NotImplementedError
+
+    def save(self, session_id, session):
+        raise NotImplementedError
+
+    def __delitem__(self, session_id):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+    def __getitem__(self, session_id):
+        session = self.get(session_id)
+        if session is None:
+            raise KeyError(session_id)
+        return session
+
+    def __setitem__(self, session_id, session):
+        self.save(session_id, session)
+
+    def __contains__(self, session_id):
+        return self.get(session_id) is not None
+
+
+class MemorySessionStore(SessionStore):
+    def __init__(self, expires_in_seconds=None, max_size=None, on_evict=None):
+        if expires_in_seconds or max_size:
+            self.sessions = ExpiredDict(expires_in_seconds, max_size=max_size, on_evict=on_evict)
+        else:
+            self.sessions = dict()
+
+    def get(self, session_id):
+        return self.sessions.get(session_id)
+
+    def save(self, session_id, session):
+        self.sessions[session_id] = session
+
+    def __delitem__(self, session_id):
+        del self.sessions[session_id]
+
+    def clear(self):
+        self.sessions.clear()
+
+
+class SqliteSessionStore(SessionStore):
+    """
+    读写都经过内存缓存，缓存未命中时从数据库加载，save只标记为脏数据，
+    后台线程每flush_interval秒把脏会话批量写入数据库，并定期删除过期会话、截断WAL文件
+    :param factory: 创建空会话的函数 factory(session_id, system_prompt)，加载时用于恢复会话对象
+    """
+
+    def __init__(self, path, factory, expires_in_seconds=None, max_size=None, on_evict=None, flush_interval=1, compact_interval=3600):
+        self.path = path
+        self.factory = factory
+        self.expires_in_seconds = expires_in_seconds
+        self.flush_interval = flush_interval
+        self.compact_interval = compact_interval
+        self.on_evict = on_evict
+        self.cache = ExpiredDict(expires_in_seconds, max_size=max_size, on_evict=self._on_cache_evict)
+        self.dirty = {}  # session_id -> session，等待写入数据库
+        self.flushing = {}  # 正在写入数据库的会话，写入完成前加载时以此为准
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)")
+        self.closed = threading.Event()
+        self.last_compact = time.time()
+        threading.Thread(target=self._flush_loop, name="session_store_flush", daemon=True).start()
+        atexit.register(self.close)
+
+    def get(self, session_id):
+        session = self.cache.get(session_id)
+        if session is not None:
+            return session
+        with self.lock:
+            session = self.dirty.get(session_id) or self.flushing.get(session_id)
+            if session is None:
+                session = self._load(session_id)
+            if session is not None:
+                self.cache[session_id] = session
+            return session
+
+    def save(self, session_id, session):
+        self.cache[session_id] = session
+        with self.lock:
+            self.dirty[session_id] = session
+
+    def __delitem__(self, session_id):
+        with self.lock:
+            self.cache.pop(session_id, None)
+            self.dirty.pop(session_id, None)
+            self.flushing.pop(session_id, None)  # 正在进行的flush不再写入该会话
+            self.conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.dirty.clear()
+            self.flushing.clear()
+            self.conn.execute("DELETE FROM sessions")
+
+    def _load(self, session_id):
+        row = self.conn.execute("SELECT data, updated_at FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        if row is None:
+            return None
+        data, updated_at = row
+        if self.expires_in_seconds and time.time() - updated_at > self.expires_in_seconds:
+            return None
+        try:
+            data = json.loads(data)
+            session = self.factory(session_id, data.get("system_prompt"))
+            session.load(data)
+            return session
+        except Exception as e:
+            logger.warn("[SessionStore] load session {} failed: {}".format(session_id, e))
+            return None
+
+    def _on_cache_evict(self, session_id, session, reason):
+        # 缓存淘汰的脏会话仍保存在dirty中，下次flush时写入，不会丢失
+        if self.on_evict is not None:
+            self.on_evict(session_id, session, reason)
+
+    def flush(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            dirty, self.dirty = self.dirty, {}
+            self.flushing = dirty
+        # 序列化在锁外进行，不阻塞save
+        now = time.time()
+        rows = []
+        for session_id, session in list(dirty.items()):
+            try:
+                rows.append((session_id, json.dumps(session.dump(), ensure_ascii=False), now))
+            except Exception as e:
+                logger.warn("[SessionStore] dump session {} failed: {}".format(session_id, e))
+                with self.lock:
+                    if session_id in self.flushing:
+                        self.dirty.setdefault(session_id, session)
+        with self.lock:
+            # 序列化期间被删除或清空的会话不再写入，否则重启后会重新出现
+            rows = [row for row in rows if row[0] in self.flushing]
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany("INSERT OR REPLACE INTO sessions (session_id, data, updated_at) VALUES (?, ?, ?)", rows)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                # 写入失败的会话放回dirty，下次重试，已有更新的会话以新的为准
+                for session_id, session in dirty.items():
+                    self.dirty.setdefault(session_id, session)
+                raise
+            finally:
+                self.flushing = {}
+        logger.debug("[SessionStore] flushed {} sessions".format(len(rows)))
+
+    def compact(self):
+        """
+        删除过期会话并截断WAL文件
+        """
+        with self.lock:
+            if self.expires_in_seconds:
+                cursor = self.conn.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - self.expires_in_seconds,))
+                logger.debug("[SessionStore] compact removed {} expired sessions".format(cursor.rowcount))
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.last_compact = time.time()
+
+    def _flush_loop(self):
+        while not self.closed.wait(self.flush_interval):
+            try:
+                self.flush()
+                if time.time() - self.last_compact > self.compact_interval:
+                    self.compact()
+            except Exception as e:
+                logger.exception("[SessionStore] flush error: {}".format(e))
+
+    def close(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        try:
+            self.flush()
+        finally:
+            with self.lock:
+                self.conn.close()
+
+
+def create_session_store(factory, on_evict=None) -> SessionStore:
+    """
+    根据配置创建会话存储
+    :param factory: 创建空会话的函数 factory(session_id, system_prompt)
+    :param on_evict: 会话从内存中移除时的回调 on_evict(session_id, session, reason)
+    """
+    store_type = conf().get("session_store", "memory")
+    expires_in_seconds = conf().get("expires_in_seconds")
+    max_size = conf().get("max_sessions") or None
+    if store_type == "sqlite":
+        path = conf().get("session_store_path") or os.path.join(get_appdata_dir(), "sessions.db")
+        flush_interval = conf().get("session_store_flush_interval", 1)
+        return SqliteSessionStore(path, factory, expires_in_seconds, max_size, on_evict, flush_interval)
+    if store_type != "memory":
+        logger.warn("[SessionStore] unknown session_store {}, fallback to memory".format(store_type))
+    return MemorySessionStore(expires_in_seconds, max_size, on_evict)
+
+
+if __name__ == "__main__":
+    # 热路径开销基准测试: python -m bot.session_store
+    # 模拟多个用户轮流对话(读取会话、追加消息、保存)，对比内存存储与sqlite存储的耗时
+    import tempfile
+
+    from bot.baidu.baidu_wenxin_session import BaiduWenxinSession
+    from bot.chatgpt.chat_gpt_session import ChatGPTSession
+
+    users, rounds = 1000, 20
+    for session_cls in [ChatGPTSession, BaiduWenxinSession]:
+
+        def factory(session_id, system_prompt=None):
+            return session_cls(session_id, system_prompt or "You are a helpful assistant.", model="wenxin")
+
+        tmp = tempfile.mkdtemp()
+        stores = [
+            ("memory", MemorySessionStore(3600)),
+            ("sqlite", SqliteSessionStore(os.path.join(tmp, "sessions.db"), factory, 3600)),
+        ]
+        for name, store in stores:
+            start = time.perf_counter()
+            for i in range(rounds):
+                for u in range(users):
+                    session_id = "user_{}".format(u)
+                    session = store.get(session_id)
+                    if session is None:
+                        session = factory(session_id)
+                    session.add_query("第{}轮提问".format(i))
+                    session.add_reply("第{}轮回答".format(i))
+                    session.discard_exceeding(200)
+                    store.save(session_id, session)
+            cost = time.perf_counter() - start
+            print("{} {}: {:.2f}us per turn".format(session_cls.__name__, name, cost / (users * rounds) * 1e6))
+
+        # 重新打开数据库，验证会话可以在重启后恢复
+        sqlite_store = stores[1][1]
+        expected = sqlite_store.get("user_0").messages
+        start = time.perf_counter()
+        sqlite_store.close()
+        print("{} flush on close: {:.3f}s".format(session_cls.__name__, time.perf_counter() - start))
+        reopened = SqliteSessionStore(os.path.join(tmp, "sessions.db"), factory, 3600)
+        start = time.perf_counter()
+        assert reopened.get("user_0").messages == expected
+        print("{} lazy load after restart: {:.3f}ms".format(session_cls.__name__, (time.perf_counter() - start) * 1000))
+        reopened.close()
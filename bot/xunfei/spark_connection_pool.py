@@ -0,0 +1,192 @@
+# encoding:utf-8
+
+import base64
+import hashlib
+import hmac
+import json
+import ssl
+import threading
+import time
+from datetime import datetime
+from time import mktime
+from urllib.parse import urlencode, urlparse
+from wsgiref.handlers import format_date_time
+
+import websocket
+
+from common.log import logger
+from common.metrics import Metrics
+
+URL_TTL = 240  # 签名url的复用时间(秒)，讯飞要求date与服务器时间相差不超过300秒
+IDLE_SECONDS = 60  # 空闲连接的最长保留时间(秒)
+MAX_REUSE_FAILURES = 3  # 复用的连接连续多少次已被服务端关闭后不再复用连接
+
+
+class SparkError(Exception):
+    def __init__(self, code, message):
+        super().__init__("spark error {}: {}".format(code, message))
+        self.code = code
+
+
+class SparkConnectionPool(object):
+    """
+    讯飞星火websocket连接池，线程安全
+        - 签名的url在有效期内复用，不必每次请求都重新计算hmac
+        - 请求在调用方线程中直接收发，按帧阻塞读取，不需要额外的线程和轮询
+        - 一个连接同时只处理一个请求(星火的协议不支持在同一连接上交错多个请求)，并发请求使用池中不同的连接，
+          请求结束后连接仍可用时放回池中复用，服务端已关闭的连接在下次使用时丢弃并重新建立，
+          服务端总是在回复后关闭连接时自动停止复用
+        - 进行中的请求按request_id记录，无论成功、失败还是超时都会在结束时移除
+    """
+
+    def __init__(self, spark_url, api_key, api_secret, max_idle=4, timeout=60):
+        self.spark_url = spark_url
+        self.host = urlparse(spark_url).netloc
+        self.path = urlparse(spark_url).path
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = []  # [(ws, 放回池中的时间)]
+        self.inflight = {}  # request_id -> 开始时间
+        self.signed_url = None
+        self.signed_at = 0
+        self.reuse = max_idle > 0
+        self.reuse_failures = 0
+
+    # 生成url
+    def create_url(self):
+        # 生成RFC1123格式的时间戳
+        now = datetime.now()
+        date = format_date_time(mktime(now.timetuple()))
+
+        # 拼接字符串
+        signature_origin = "host: " + self.host + "\n"
+        signature_origin += "date: " + date + "\n"
+        signature_origin += "GET " + self.path + " HTTP/1.1"
+
+        # 进行hmac-sha256进行加密
+        signature_sha = hmac.new(self.api_secret.encode("utf-8"), signature_origin.encode("utf-8"), digestmod=hashlib.sha256).digest()
+
+        signature_sha_base64 = base64.b64encode(signature_sha).decode(encoding="utf-8")
+
+        authorization_origin = f'api_key="{self.api_key}", algorithm="hmac-sha256", headers="host date request-line", ' f'signature="{signature_sha_base64}"'
+
+        authorization = base64.b64encode(authorization_origin.encode("utf-8")).decode(encoding="utf-8")
+
+        # 将请求的鉴权参数组合为字典
+        v = {"authorization": authorization, "date": date, "host": self.host}
+        # 拼接鉴权参数，生成url
+        return self.spark_url + "?" + urlencode(v)
+
+    def get_url(self):
+        """
+        在有效期内复用签名的url
+        """
+        with self.lock:
+            now = time.monotonic()
+            if self.signed_url is None or now - self.signed_at > URL_TTL:
+                self.signed_url = self.create_url()
+                self.signed_at = now
+            return self.signed_url
+
+    def _acquire(self):
+        """
+        :return: (ws, 是否为复用的连接)
+        """
+        with self.lock:
+            now = time.monotonic()
+            while self.idle:
+                ws, released_at = self.idle.pop()
+                if ws.connected and now - released_at < IDLE_SECONDS:
+                    return ws, True
+                self._close(ws)
+        ws = websocket.create_connection(self.get_url(), timeout=self.timeout, sslopt={"cert_reqs": ssl.CERT_NONE})
+        Metrics().incr("xunfei_ws_connect")
+        return ws, False
+
+    def _release(self, ws):
+        if self.reuse and ws.connected:
+            with self.lock:
+                if len(self.idle) < self.max_idle:
+                    self.idle.append((ws, time.monotonic()))
+                    return
+        self._close(ws)
+
+    @staticmethod
+    def _close(ws):
+        try:
+            ws.close(timeout=0)
+        except Exception:
+            pass
+
+    def request(self, request_id, data: dict, on_delta=None):
+        """
+        发送一次对话请求并等待完整的回复
+        :param data: 请求参数，见gen_params
+        :param on_delta: 收到每段回复时的回调 on_delta(content)
+        :return: (回复内容, usage)
+        """
+        deadline = time.monotonic() + self.timeout
+        with self.lock:
+            self.inflight[request_id] = time.monotonic()
+        try:
+            while True:
+                ws, reused = self._acquire()
+                try:
+                    result = self._request(ws, data, deadline, on_delta)
+                    if reused:
+                        self.reuse_failures = 0
+                    return result
+                except (websocket.WebSocketConnectionClosedException, ConnectionError) as e:
+                    self._close(ws)
+                    if not reused:
+                        raise
+                    # 复用的连接已被服务端关闭，使用新连接重试
+                    logger.debug("[XunFei] pooled connection closed, reconnect: {}".format(e))
+                    self.reuse_failures += 1
+                    if self.reuse and self.reuse_failures >= MAX_REUSE_FAILURES:
+                        logger.info("[XunFei] server closes connections after each reply, disable connection reuse")
+                        self.reuse = False
+                except BaseException:
+                    self._close(ws)
+                    raise
+        finally:
+            with self.lock:
+                self.inflight.pop(request_id, None)
+
+    def _request(self, ws, data, deadline, on_delta):
+        ws.send(json.dumps(data))
+        content = ""
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise websocket.WebSocketTimeoutException("spark request timeout")
+            ws.settimeout(remaining)
+            message = ws.recv()
+            if not message:
+                raise websocket.WebSocketConnectionClosedException("connection closed by server")
+            frame = json.loads(message)
+            code = frame["header"]["code"]
+            if code != 0:
+                raise SparkError(code, frame["header"].get("message"))
+            choices = frame["payload"]["choices"]
+            delta = choices["text"][0]["content"]
+            content += delta
+            if delta and on_delta is not None:
+                on_delta(delta)
+            if choices["status"] == 2:
+                usage = frame["payload"].get("usage") or {}
+                self._release(ws)
+                return content, usage.get("text", usage)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for ws, _ in idle:
+            self._close(ws)
+
+    def report(self) -> str:
+        with self.lock:
+            return "idle={}, inflight={}".format(len(self.idle), len(self.inflight))
@@ -0,0 +1,142 @@
+# encoding:utf-8
+"""
+本地的星火websocket模拟服务，按星火的协议分段返回回复，用于测试和对比连接池的性能
+运行 python -m bot.xunfei.spark_stub_server 进行基准测试
+"""
+import base64
+import hashlib
+import json
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+class SparkStubHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        if not self._handshake():
+            return
+        while True:
+            message = self._read_frame()
+            if message is None:
+                return
+            request = json.loads(message)
+            question = request["payload"]["message"]["text"][-1]["content"]
+            chunks = [question[i : i + 4] for i in range(0, len(question), 4)] or [""]
+            for i, chunk in enumerate(chunks):
+                if self.server.delay:
+                    time.sleep(self.server.delay)
+                last = i == len(chunks) - 1
+                frame = {
+                    "header": {"code": 0, "message": "Success", "sid": "stub", "status": 2 if last else 1},
+                    "payload": {"choices": {"status": 2 if last else 1, "seq": i, "text": [{"content": chunk, "role": "assistant", "index": 0}]}},
+                }
+                if last:
+                    frame["payload"]["usage"] = {"text": {"prompt_tokens": len(question), "completion_tokens": len(question), "total_tokens": 2 * len(question)}}
+                self._send_frame(json.dumps(frame, ensure_ascii=False).encode("utf-8"))
+            if self.server.close_after_reply:
+                self._send_frame(b"", opcode=0x8)
+                return
+
+    def _handshake(self):
+        headers = {}
+        line = self.rfile.readline()
+        if not line:
+            return False
+        while True:
+            line = self.rfile.readline().decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        accept = base64.b64encode(hashlib.sha1((headers["sec-websocket-key"] + WS_GUID).encode()).digest()).decode()
+        self.wfile.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: {}\r\n\r\n".format(accept)).encode())
+        return True
+
+    def _read_frame(self):
+        """
+        :return: 文本消息，连接关闭时返回None
+        """
+        header = self.rfile.read(2)
+        if len(header) < 2:
+            return None
+        opcode = header[0] & 0x0F
+        length = header[1] & 0x7F
+        if length == 126:
+            length = struct.unpack(">H", self.rfile.read(2))[0]
+        elif length == 127:
+            length = struct.unpack(">Q", self.rfile.read(8))[0]
+        mask = self.rfile.read(4) if header[1] & 0x80 else b"\0\0\0\0"
+        payload = bytes(b ^ mask[i % 4] for i, b in enumerate(self.rfile.read(length)))
+        if opcode == 0x8:
+            return None
+        return payload.decode("utf-8")
+
+    def _send_frame(self, payload, opcode=0x1):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack(">BB", 0x80 | opcode, length)
+        elif length < 1 << 16:
+            header = struct.pack(">BBH", 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack(">BBQ", 0x80 | opcode, 127, length)
+        self.wfile.write(header + payload)
+
+
+class SparkStubServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, delay=0.0, close_after_reply=False):
+        """
+        :param delay: 每段回复之间的间隔(秒)
+        :param close_after_reply: 回复后是否关闭连接
+        """
+        super().__init__(("127.0.0.1", port), SparkStubHandler)
+        self.delay = delay
+        self.close_after_reply = close_after_reply
+
+    def server_bind(self):
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        super().server_bind()
+
+    @property
+    def url(self):
+        return "ws://127.0.0.1:{}/v2.1/chat".format(self.server_address[1])
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+if __name__ == "__main__":
+    from concurrent.futures import ThreadPoolExecutor
+
+    from bot.xunfei.spark_connection_pool import SparkConnectionPool
+    from bot.xunfei.xunfei_spark_bot import gen_params
+
+    messages = [{"role": "user", "content": "讯飞星火连接池的基准测试问题，" * 4}]
+    data = gen_params("appid", "generalv2", messages)
+
+    def bench(pool, n, workers):
+        start = time.time()
+        with ThreadPoolExecutor(workers) as executor:
+            results = list(executor.map(lambda i: pool.request("bench_{}".format(i), data), range(n)))
+        assert all(content == messages[-1]["content"] for content, _ in results)
+        return (time.time() - start) / n * 1000
+
+    for close_after_reply in [False, True]:
+        server = SparkStubServer(close_after_reply=close_after_reply).start()
+        for max_idle in [0, 8]:
+            pool = SparkConnectionPool(server.url, "key", "secret", max_idle=max_idle)
+            bench(pool, 20, 1)
+            print(
+                "close_after_reply={}, max_idle={}: sequential {:.2f}ms/req, 8 threads {:.2f}ms/req".format(
+                    close_after_reply, max_idle, bench(pool, 500, 1), bench(pool, 2000, 8)
+                )
+            )
+            pool.close()
+        server.shutdown()
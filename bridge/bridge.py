@@ -1,8 +1,19 @@
+import asyncio
+import time
+
+from bot.bot import Bot
 from bot.bot_factory import create_bot
-from bridge.context import Context
-from bridge.reply import Reply
+from bridge.circuit_breaker import CircuitBreaker
+from bridge.context import Context, ContextType
+from bridge.hedging import LatencyTracker, hedged_call, hedged_call_async, is_good_reply
+from bridge.rate_limiter import TokenRateLimiter
+from bridge.reply import Reply, ReplyType
+from bridge.response_cache import ResponseCache, make_cache_key
+from bridge.single_flight import SingleFlight
 from common import const
 from common.log import logger
+from common.metrics import Metrics
+from common.retry import RetryLater
 from common.singleton import singleton
 from config import conf
 from translate.factory import create_translator
@@ -32,6 +43,9 @@ class Bridge(object):
         if model_type in ["claude"]:
             self.btype["chat"] = const.CLAUDEAI
         self.bots = {}
+        self.fallback_bots = {}  # 熔断或对冲时使用的备用bot，bot_type -> bot
+        self.breakers = {}  # bot_type -> CircuitBreaker
+        self.latencies = {}  # bot_type -> LatencyTracker
 
     def get_bot(self, typename):
         if self.bots.get(typename) is None:
@@ -49,8 +63,317 @@ class Bridge(object):
     def get_bot_type(self, typename):
         return self.btype[typename]
 
+    def get_breaker(self, bot_type) -> CircuitBreaker:
+        if bot_type not in self.breakers:
+            self.breakers[bot_type] = CircuitBreaker(bot_type)
+        return self.breakers[bot_type]
+
+    def get_latency_tracker(self, bot_type) -> LatencyTracker:
+        if bot_type not in self.latencies:
+            self.latencies[bot_type] = LatencyTracker(conf().get("hedge_latency_window", 100))
+        return self.latencies[bot_type]
+
+    def _get_fallback_bot(self, bot_type):
+        if bot_type not in self.fallback_bots:
+            logger.info("create fallback bot {} for chat".format(bot_type))
+            self.fallback_bots[bot_type] = create_bot(bot_type)
+        return self.fallback_bots[bot_type]
+
+    def _select_chat_bot(self, query):
+        """
+        选择处理对话的bot，主bot熔断时使用circuit_breaker_fallback配置的备用bot
+        :return: (bot_type, bot, breaker)，都已熔断时返回(None, None, None)
+        """
+        bot_type = self.btype["chat"]
+        if not conf().get("circuit_breaker", True) or query.startswith("#"):  # 管理命令不经过熔断器
+            return bot_type, self.get_bot("chat"), None
+        breaker = self.get_breaker(bot_type)
+        if breaker.allow():
+            return bot_type, self.get_bot("chat"), breaker
+        fallback_type = conf().get("circuit_breaker_fallback")
+        if fallback_type and fallback_type != bot_type:
+            fallback_breaker = self.get_breaker(fallback_type)
+            if fallback_breaker.allow():
+                return fallback_type, self._get_fallback_bot(fallback_type), fallback_breaker
+        return None, None, None
+
+    def _hedge_enabled(self, bot_type, query, context: Context) -> bool:
+        hedge_type = conf().get("hedge_bot")
+        if not hedge_type or hedge_type == bot_type or bot_type != self.btype["chat"]:
+            return False
+        return context is not None and context.type == ContextType.TEXT and not query.startswith("#")
+
+    def _hedge_delay(self, bot_type):
+        """
+        对冲前等待的秒数，为主bot近期延迟的hedge_percentile分位数，延迟记录不足时返回None
+        """
+        tracker = self.get_latency_tracker(bot_type)
+        if tracker.count() < conf().get("hedge_min_samples", 20):
+            return None
+        return max(tracker.percentile(conf().get("hedge_percentile", 95)), conf().get("hedge_min_delay", 2))
+
+    def _breaker_reply(self) -> Reply:
+        return Reply(ReplyType.ERROR, conf().get("circuit_breaker_reply", "服务暂时不可用，请稍后再试"))
+
+    def _record_call(self, bot_type, breaker, reply, start):
+        latency = time.monotonic() - start
+        self.get_latency_tracker(bot_type).observe(latency)
+        if breaker is not None:
+            breaker.record(reply is not None and reply.type != ReplyType.ERROR, latency)
+
+    def _call_bot(self, bot_type, bot, breaker, query, context: Context) -> Reply:
+        start = time.monotonic()
+        try:
+            reply = bot.reply(query, context)
+        except RetryLater:
+            # 消息重新调度后再重试，不是失败的请求，不计入熔断统计
+            if breaker is not None:
+                breaker.release()
+            raise
+        except BaseException:
+            self._record_call(bot_type, breaker, None, start)
+            raise
+        self._record_call(bot_type, breaker, reply, start)
+        return reply
+
+    async def _call_bot_async(self, bot_type, bot, breaker, query, context: Context) -> Reply:
+        start = time.monotonic()
+        try:
+            reply = await bot.reply_async(query, context)
+        except asyncio.CancelledError:
+            # 被对冲请求取消，耗时作为延迟的下限记录，不计入熔断统计
+            self.get_latency_tracker(bot_type).observe(time.monotonic() - start)
+            if breaker is not None:
+                breaker.release()
+            raise
+        except RetryLater:
+            if breaker is not None:
+                breaker.release()
+            raise
+        except BaseException:
+            self._record_call(bot_type, breaker, None, start)
+            raise
+        self._record_call(bot_type, breaker, reply, start)
+        return reply
+
+    def _hedge_context(self, context: Context) -> Context:
+        """
+        备用bot使用的context副本，避免两个bot同时修改同一个context
+        """
+        hedge_context = Context(context.type, context.content, dict(context.kwargs))
+        hedge_context["retry_reschedulable"] = False
+        return hedge_context
+
+    def _hedge_bot(self):
+        hedge_type = conf().get("hedge_bot")
+        breaker = self.get_breaker(hedge_type) if conf().get("circuit_breaker", True) else None
+        return hedge_type, self._get_fallback_bot(hedge_type), breaker
+
+    def _on_hedge_done(self, winner, reply, loser, query, contexts, bots):
+        """
+        记录对冲结果，并用采用的回复覆盖另一个bot会话中的本轮对话，使两个bot的会话保持一致
+        未发起对冲时也写入备用bot的会话，以便之后对冲时备用bot有完整的上下文
+        :param loser: 未采用的请求的future，在其结束后再覆盖会话；未发起对冲时为None
+        """
+        if not is_good_reply(reply):
+            return
+        if loser is not None:
+            Metrics().incr("hedge_won", label=bots[winner][0])
+        if winner == 1:
+            total_tokens = contexts[1].get("total_tokens")
+            if total_tokens is not None:
+                contexts[0]["total_tokens"] = total_tokens
+        sessions = getattr(bots[1 - winner][1], "sessions", None)
+        session_id = contexts[0].get("session_id")
+        if sessions is None or session_id is None or reply.type != ReplyType.TEXT:
+            return
+
+        def sync_session(_=None):
+            try:
+                sessions.session_overwrite(query, reply.content, session_id)
+            except Exception as e:
+                logger.warn("[Bridge] sync hedged session failed: {}".format(e))
+
+        if loser is None:
+            sync_session()
+        else:
+            loser.add_done_callback(sync_session)
+
+    def _fingerprint(self, query, context: Context, history_size=None):
+        """
+        按会话的system prompt、历史消息、问题、模型等计算请求的指纹，不支持的请求返回None
+        :param history_size: 只考虑最近多少条历史消息，None表示全部，0表示不考虑历史
+        """
+        if query.startswith("#") or context.get("stream"):
+            return None
+        sessions = getattr(self.get_bot("chat"), "sessions", None)
+        session_id = context.get("session_id")
+        if sessions is None or session_id is None:
+            return None
+        session = sessions.sessions.get(session_id)
+        system_prompt = session.system_prompt if session is not None else conf().get("character_desc", "")
+        history = []
+        if session is not None and history_size != 0:
+            history = [m for m in session.messages if m["role"] != "system"]
+            if history and history[-1]["role"] == "user" and history[-1]["content"] == query:
+                history = history[:-1]  # 相同的提问正在处理中，已加入会话但还没有回复
+            if history_size:
+                history = history[-history_size:]
+        model = "{}:{}".format(self.btype["chat"], context.get("gpt_model") or conf().get("model"))
+        return make_cache_key(query, system_prompt, history, model, conf().get("temperature"))
+
+    def _cache_key(self, query, context: Context):
+        """
+        回复缓存的key，不使用缓存时返回None
+        """
+        if not ResponseCache().enabled() or context is None or context.type != ContextType.TEXT:
+            return None
+        history_size = 0 if conf().get("response_cache_stateless", False) else conf().get("response_cache_history_size", 4)
+        return self._fingerprint(query, context, history_size)
+
+    def _flight_key(self, query, context: Context):
+        """
+        合并并发请求的key，包含完整的历史消息，不合并时返回None
+        """
+        if not conf().get("single_flight", True) or context is None or context.get("openai_api_key"):
+            return None
+        if context.type == ContextType.TEXT:
+            cache_key = self._fingerprint(query, context)
+        elif context.type == ContextType.IMAGE_CREATE:
+            cache_key = make_cache_key(query, None, [], "image:{}".format(self.btype["chat"]), None)
+        else:
+            return None
+        return cache_key.key if cache_key is not None else None
+
+    def _on_shared_reply(self, query, context: Context, reply: Reply) -> Reply:
+        """
+        使用了缓存或其他请求的回复时，将本轮对话加入会话，对冲的备用bot也同步加入
+        :return: 回复的副本，channel会修改回复的内容
+        """
+        reply = Reply(reply.type, reply.content)
+        if reply.type != ReplyType.TEXT or context.get("session_id") is None:
+            return reply
+        session_id = context["session_id"]
+        bots = [self.get_bot("chat")]
+        if self._hedge_enabled(self.btype["chat"], query, context):
+            bots.append(self._get_fallback_bot(conf().get("hedge_bot")))
+        for bot in bots:
+            sessions = getattr(bot, "sessions", None)
+            if sessions is not None:
+                sessions.session_query(query, session_id)
+                sessions.session_reply(reply.content, session_id)
+        return reply
+
     def fetch_reply_content(self, query, context: Context) -> Reply:
-        return self.get_bot("chat").reply(query, context)
+        cache_key = self._cache_key(query, context)
+        if cache_key is not None:
+            reply = ResponseCache().get(cache_key)
+            if reply is not None:
+                return self._on_shared_reply(query, context, reply)
+        flight_key = self._flight_key(query, context)
+        if flight_key is None:
+            reply = self._fetch_chat_reply(query, context)
+        else:
+            reply, shared = SingleFlight().do(flight_key, lambda: self._fetch_chat_reply(query, context))
+            if shared:
+                Metrics().incr("single_flight_shared", label=str(context.type))
+                return self._on_shared_reply(query, context, reply) if reply is not None else None
+        if cache_key is not None:
+            ResponseCache().put(cache_key, reply)
+        return self._record_tokens(query, context, reply)
+
+    async def fetch_reply_content_async(self, query, context: Context) -> Reply:
+        cache_key = self._cache_key(query, context)
+        if cache_key is not None:
+            reply = ResponseCache().get(cache_key)
+            if reply is not None:
+                return self._on_shared_reply(query, context, reply)
+        flight_key = self._flight_key(query, context)
+        if flight_key is None:
+            reply = await self._fetch_chat_reply_async(query, context)
+        else:
+            reply, shared = await SingleFlight().do_async(flight_key, lambda: self._fetch_chat_reply_async(query, context))
+            if shared:
+                Metrics().incr("single_flight_shared", label=str(context.type))
+                return self._on_shared_reply(query, context, reply) if reply is not None else None
+        if cache_key is not None:
+            ResponseCache().put(cache_key, reply)
+        return self._record_tokens(query, context, reply)
+
+    def _fetch_chat_reply(self, query, context: Context) -> Reply:
+        bot_type, bot, breaker = self._select_chat_bot(query)
+        if bot is None:
+            return self._breaker_reply()
+        if not self._hedge_enabled(bot_type, query, context):
+            reply = self._call_bot(bot_type, bot, breaker, query, context)
+            return reply
+
+        hedge_type, hedge_bot, hedge_breaker = self._hedge_bot()
+        hedge_context = self._hedge_context(context)
+
+        def secondary():
+            if hedge_breaker is not None and not hedge_breaker.allow():
+                return None
+            return self._call_bot(hedge_type, hedge_bot, hedge_breaker, query, hedge_context)
+
+        delay = self._hedge_delay(bot_type)
+        if delay is None:
+            winner, reply, loser = 0, self._call_bot(bot_type, bot, breaker, query, context), None
+        else:
+            winner, reply, loser = hedged_call(lambda: self._call_bot(bot_type, bot, breaker, query, context), secondary, delay)
+        self._on_hedge_done(winner, reply, loser, query, [context, hedge_context], [(bot_type, bot), (hedge_type, hedge_bot)])
+        return reply
+
+    async def _fetch_chat_reply_async(self, query, context: Context) -> Reply:
+        bot_type, bot, breaker = self._select_chat_bot(query)
+        if bot is None:
+            return self._breaker_reply()
+        if not self._hedge_enabled(bot_type, query, context):
+            reply = await self._call_bot_async(bot_type, bot, breaker, query, context)
+            return reply
+
+        hedge_type, hedge_bot, hedge_breaker = self._hedge_bot()
+        hedge_context = self._hedge_context(context)
+
+        async def secondary():
+            if hedge_breaker is not None and not hedge_breaker.allow():
+                return None
+            return await self._call_bot_async(hedge_type, hedge_bot, hedge_breaker, query, hedge_context)
+
+        delay = self._hedge_delay(bot_type)
+        if delay is None:
+            winner, reply, loser = 0, await self._call_bot_async(bot_type, bot, breaker, query, context), None
+        else:
+            # 未实现原生异步接口的bot在线程中执行，取消后仍会继续执行并写入会话，不取消
+            cancellable = [type(b).reply_async is not Bot.reply_async for b in [bot, hedge_bot]]
+            winner, reply, loser = await hedged_call_async(lambda: self._call_bot_async(bot_type, bot, breaker, query, context), secondary, delay, cancellable)
+        self._on_hedge_done(winner, reply, loser, query, [context, hedge_context], [(bot_type, bot), (hedge_type, hedge_bot)])
+        return reply
+
+    def _record_tokens(self, query, context: Context, reply: Reply) -> Reply:
+        """
+        按bot返回的usage记录token用量，bot未提供时按字符数估算
+        """
+        limiter = TokenRateLimiter()
+        if not limiter.enabled() or reply is None or context is None:
+            return reply
+        total_tokens = context.get("total_tokens")
+        if total_tokens is not None:
+            del context["total_tokens"]
+        if reply.type == ReplyType.STREAM:
+            reply.content = self._count_stream_tokens(query, context, reply.content)
+        elif total_tokens:
+            limiter.record(context, total_tokens)
+        elif reply.type == ReplyType.TEXT:
+            limiter.record(context, len(query) + len(reply.content))
+        return reply
+
+    def _count_stream_tokens(self, query, context: Context, deltas):
+        length = len(query)
+        for delta in deltas:
+            length += len(delta)
+            yield delta
+        TokenRateLimiter().record(context, length)
 
     def fetch_voice_to_text(self, voiceFile) -> Reply:
         return self.get_bot("voice_to_text").voiceToText(voiceFile)
@@ -66,3 +389,8 @@ class Bridge(object):
         重置bot路由
         """
         self.__init__()
+
+    def breaker_report(self) -> str:
+        if not self.breakers:
+            return "暂无请求"
+        return "\n".join(str(breaker) for breaker in self.breakers.values())
@@ -0,0 +1,91 @@
+import threading
+import time
+from collections import deque
+
+from common.log import logger
+from common.metrics import Metrics
+from config import conf
+
+
+class CircuitBreaker(object):
+    """
+    熔断器，按最近circuit_breaker_window次请求的失败率(包括超过circuit_breaker_slow_seconds的慢请求)切换状态：
+        closed: 正常放行，失败率达到circuit_breaker_failure_rate后打开
+        open: 直接拒绝，circuit_breaker_open_seconds后进入half_open
+        half_open: 只放行一个试探请求，成功则关闭，失败则重新打开
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.calls = deque()  # 最近的请求结果，True表示失败
+        self.failures = 0
+        self.opened_at = 0
+        self.trial_inflight = False
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < conf().get("circuit_breaker_open_seconds", 30):
+                    Metrics().incr("circuit_breaker_rejected", label=self.name)
+                    return False
+                self._transition(self.HALF_OPEN)
+            if self.trial_inflight:  # half_open时只放行一个试探请求
+                Metrics().incr("circuit_breaker_rejected", label=self.name)
+                return False
+            self.trial_inflight = True
+            return True
+
+    def record(self, success: bool, latency=0):
+        slow_seconds = conf().get("circuit_breaker_slow_seconds", 60)
+        failed = not success or (slow_seconds and latency > slow_seconds)
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.trial_inflight = False
+                self._transition(self.OPEN if failed else self.CLOSED)
+                return
+            if self.state == self.OPEN:  # 打开前已放行的请求，结果不再统计
+                return
+            self.calls.append(failed)
+            self.failures += failed
+            while len(self.calls) > conf().get("circuit_breaker_window", 20):
+                self.failures -= self.calls.popleft()
+            if len(self.calls) >= conf().get("circuit_breaker_min_calls", 5) and self.failures / len(self.calls) >= conf().get("circuit_breaker_failure_rate", 0.5):
+                self._transition(self.OPEN)
+
+    def release(self):
+        """
+        放行的请求被取消、没有结果时调用
+        """
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.trial_inflight = False
+
+    def reset(self):
+        with self.lock:
+            self.trial_inflight = False
+            self._transition(self.CLOSED)
+
+    # 调用方需持有self.lock
+    def _transition(self, state):
+        if state == self.state:
+            return
+        logger.warn("[CircuitBreaker] {} {} -> {}".format(self.name, self.state, state))
+        self.state = state
+        if state == self.OPEN:
+            self.opened_at = time.monotonic()
+            Metrics().incr("circuit_breaker_opened", label=self.name)
+        elif state == self.CLOSED:
+            self.calls.clear()
+            self.failures = 0
+
+    def __str__(self):
+        with self.lock:
+            return "{}: {}, 最近{}次请求失败{}次".format(self.name, self.state, len(self.calls), self.failures)
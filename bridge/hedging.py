@@ -0,0 +1,114 @@
+"""
+对冲请求：主bot超过其近期延迟的某个分位数仍未返回时，向备用bot发起同样的请求，采用先返回的有效回复
+"""
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from bridge.reply import ReplyType
+from common.metrics import Metrics
+from config import conf
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def hedge_executor() -> ThreadPoolExecutor:
+    """
+    执行对冲请求的线程池，与sync_executor分开，避免在sync_executor中调用时互相等待
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=conf().get("hedge_workers", 20), thread_name_prefix="hedge")
+    return _executor
+
+
+class LatencyTracker(object):
+    """
+    记录最近window次请求的延迟，用于计算对冲的等待时间
+    """
+
+    def __init__(self, window=100):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+
+    def observe(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def count(self):
+        return len(self.latencies)
+
+    def percentile(self, p):
+        """
+        :param p: 0-100
+        :return: 近期延迟的第p百分位数(秒)，无记录时返回None
+        """
+        with self.lock:
+            latencies = sorted(self.latencies)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+
+def is_good_reply(reply) -> bool:
+    return reply is not None and reply.type != ReplyType.ERROR
+
+
+def hedged_call(primary, secondary, delay):
+    """
+    在hedge_executor中执行primary，delay秒内未返回时再执行secondary，返回先得到的有效回复
+    线程中的请求无法中断，未被采用的请求继续执行，调用方可通过返回的future在其结束后处理
+    :param primary: 无参数的函数，返回Reply
+    :param secondary: 同primary
+    :return: (winner, reply, loser_future)，winner为0(primary)或1(secondary)，未发起对冲时loser_future为None
+             都失败时返回primary的结果或抛出primary的异常
+    """
+    executor = hedge_executor()
+    futures = [executor.submit(primary)]
+    done, _ = wait(futures, timeout=delay)
+    if not done:
+        futures.append(executor.submit(secondary))
+        Metrics().incr("hedge_fired")
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for i, future in enumerate(futures):
+            if future in done and future.exception() is None and is_good_reply(future.result()):
+                loser = futures[1 - i] if len(futures) > 1 else None
+                if loser is not None:
+                    loser.cancel()
+                return i, future.result(), loser
+    return 0, futures[0].result(), futures[1] if len(futures) > 1 else None
+
+
+async def hedged_call_async(primary, secondary, delay, cancellable=(True, True)):
+    """
+    hedged_call的异步版本，未被采用的请求在cancellable时取消
+    :param primary: 无参数的协程函数，返回Reply
+    :param cancellable: primary和secondary是否可以取消，在线程中执行的同步bot取消后仍会继续执行，不应取消
+    """
+    tasks = [asyncio.ensure_future(primary())]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            tasks.append(asyncio.ensure_future(secondary()))
+            Metrics().incr("hedge_fired")
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=FIRST_COMPLETED)
+            for i, task in enumerate(tasks):
+                if task in done and not task.cancelled() and task.exception() is None and is_good_reply(task.result()):
+                    loser = tasks[1 - i] if len(tasks) > 1 else None
+                    if loser is not None and not loser.done() and cancellable[1 - i]:
+                        loser.cancel()
+                    return i, task.result(), loser
+        return 0, tasks[0].result(), tasks[1] if len(tasks) > 1 else None
+    except asyncio.CancelledError:
+        for i, task in enumerate(tasks):
+            if cancellable[i]:
+                task.cancel()
+        raise
@@ -0,0 +1,116 @@
+import threading
+import time
+from collections import deque
+
+from bridge.context import Context, ContextType
+from common.expired_dict import ExpiredDict
+from common.log import logger
+from common.metrics import Metrics
+from common.singleton import singleton
+from config import conf
+
+
+class SlidingWindow(object):
+    """
+    滑动窗口内的token用量，记录每次请求的时间和token数，超出窗口的记录在访问时移除
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.records = deque()  # (monotonic time, tokens)
+        self.total = 0
+
+    def _expire(self, now):
+        while self.records and now - self.records[0][0] > self.window:
+            self.total -= self.records.popleft()[1]
+
+    def add(self, tokens):
+        now = time.monotonic()
+        self._expire(now)
+        self.records.append((now, tokens))
+        self.total += tokens
+
+    def used(self):
+        self._expire(time.monotonic())
+        return self.total
+
+
+@singleton
+class TokenRateLimiter(object):
+    """
+    按会话、用户、群统计LLM token用量(prompt + completion)，超出额度的消息在入队前拒绝
+    额度按等级配置在token_limit_tiers中，用户或群的等级通过conf().get_user_data(id)["token_limit_tier"]设置，默认为default，如
+        "token_limit_tiers": {
+            "default": {"user": 20000, "group": 100000, "session": 0},
+            "vip": {"user": 200000, "window": 86400}
+        }
+    0或未配置表示不限制，window为滑动窗口秒数，默认为token_limit_window
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.windows = ExpiredDict(conf().get("token_limit_window", 3600))  # (scope, id) -> SlidingWindow，长期无请求的自动清理
+
+    def enabled(self):
+        return bool(conf().get("token_limit_tiers"))
+
+    def _scope_ids(self, context: Context):
+        """
+        :return: [(scope, id)]，群聊中的用户按actual_user_id统计
+        """
+        cmsg = context.get("msg")
+        scope_ids = []
+        if context.get("session_id") is not None:
+            scope_ids.append(("session", context["session_id"]))
+        if cmsg is not None:
+            if context.get("isgroup", False):
+                scope_ids.append(("user", cmsg.actual_user_id))
+                scope_ids.append(("group", cmsg.other_user_id))
+            else:
+                scope_ids.append(("user", cmsg.from_user_id))
+        return scope_ids
+
+    def _limit(self, scope, scope_id):
+        tiers = conf().get("token_limit_tiers") or {}
+        tier_name = (conf().user_datas.get(scope_id) or {}).get("token_limit_tier", "default")
+        tier = tiers.get(tier_name) or tiers.get("default") or {}
+        return tier.get(scope, 0), tier.get("window", conf().get("token_limit_window", 3600))
+
+    def _window(self, scope, scope_id, window):
+        key = (scope, scope_id)
+        sliding_window = self.windows.get(key)
+        if sliding_window is None or sliding_window.window != window:
+            sliding_window = self.windows[key] = SlidingWindow(window)
+        # 空闲超过最长窗口的记录已全部过期，可以清理
+        self.windows.expires_in_seconds = max(self.windows.expires_in_seconds, window)
+        return sliding_window
+
+    def check(self, context: Context):
+        """
+        检查消息所属的会话、用户、群是否还有token额度
+        :return: 超出额度的范围(session/user/group)，未超出时返回None
+        """
+        if not self.enabled() or context.type not in [ContextType.TEXT, ContextType.VOICE]:
+            return None
+        with self.lock:
+            for scope, scope_id in self._scope_ids(context):
+                limit, window = self._limit(scope, scope_id)
+                sliding_window = self.windows.get((scope, scope_id))
+                if limit and sliding_window is not None and sliding_window.used() >= limit:
+                    Metrics().incr("token_limit_rejected", label=scope)
+                    logger.info("[TokenRateLimiter] {} {} exceeds token limit {} in {}s".format(scope, scope_id, limit, window))
+                    return scope
+        return None
+
+    def record(self, context: Context, tokens):
+        """
+        记录一次请求消耗的token数
+        """
+        if not self.enabled() or not tokens:
+            return
+        with self.lock:
+            for scope, scope_id in self._scope_ids(context):
+                limit, window = self._limit(scope, scope_id)
+                if limit:
+                    self._window(scope, scope_id, window).add(tokens)
+        Metrics().incr("llm_tokens", tokens)
@@ -0,0 +1,182 @@
+"""
+对话回复缓存，相同的(system prompt, 最近的历史消息, 问题, 模型, temperature)直接返回缓存的回复，不请求LLM
+    - 缓存按条数(response_cache_max_size)和有效期(response_cache_ttl)淘汰
+    - response_cache_stateless为True时不考虑历史消息，适合FAQ类的单轮问答
+    - 可选的近似匹配(response_cache_matcher)，在历史消息等其余条件相同时匹配相似的问题
+"""
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from collections import namedtuple
+
+from bridge.reply import Reply, ReplyType
+from common.expired_dict import ExpiredDict
+from common.log import logger
+from common.metrics import Metrics
+from common.singleton import singleton
+from config import conf
+
+# prefix为除问题外其余条件的指纹，近似匹配只在prefix相同的问题间进行
+CacheKey = namedtuple("CacheKey", ["prefix", "key", "query"])
+
+
+def normalize_query(query) -> str:
+    return re.sub(r"\s+", " ", query).strip().lower()
+
+
+def make_cache_key(query, system_prompt, history, model, temperature) -> CacheKey:
+    """
+    :param history: 最近的历史消息 [{"role": ..., "content": ...}]，不考虑历史时为空
+    """
+    prefix = hashlib.sha1(json.dumps([system_prompt, [(m["role"], m["content"]) for m in history], model, temperature], ensure_ascii=False).encode("utf-8")).hexdigest()
+    query = normalize_query(query)
+    key = hashlib.sha1("{}:{}".format(prefix, query).encode("utf-8")).hexdigest()
+    return CacheKey(prefix, key, query)
+
+
+class NearDuplicateMatcher(object):
+    """
+    近似匹配的接口，可替换为基于本地embedding等的实现
+    """
+
+    def add(self, cache_key: CacheKey):
+        raise NotImplementedError
+
+    def remove(self, cache_key: CacheKey):
+        raise NotImplementedError
+
+    def match(self, cache_key: CacheKey):
+        """
+        :return: 与cache_key.query相似且prefix相同的已缓存问题的key，没有时返回None
+        """
+        raise NotImplementedError
+
+
+class MinHashMatcher(NearDuplicateMatcher):
+    """
+    基于MinHash + LSH的近似匹配，按字符n-gram计算问题间的Jaccard相似度，不依赖第三方库
+    """
+
+    PRIME = (1 << 61) - 1
+
+    def __init__(self, threshold=0.8, num_perm=64, bands=16, shingle_size=2):
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        rand = random.Random(1)
+        self.perms = [(rand.randrange(1, self.PRIME), rand.randrange(0, self.PRIME)) for _ in range(num_perm)]
+        self.shingle_size = shingle_size
+        self.lock = threading.Lock()
+        self.signatures = {}  # key -> signature
+        self.buckets = {}  # (prefix, band, band_values) -> set(key)
+
+    def _signature(self, query):
+        n = self.shingle_size
+        shingles = {query[i : i + n] for i in range(max(len(query) - n + 1, 1))}
+        hashes = [zlib.crc32(s.encode("utf-8")) for s in shingles]
+        return tuple(min((a * h + b) % self.PRIME for h in hashes) for a, b in self.perms)
+
+    def _bands(self, cache_key, signature):
+        for i in range(self.bands):
+            yield cache_key.prefix, i, signature[i * self.rows : (i + 1) * self.rows]
+
+    def add(self, cache_key: CacheKey):
+        signature = self._signature(cache_key.query)
+        with self.lock:
+            self.signatures[cache_key.key] = signature
+            for band in self._bands(cache_key, signature):
+                self.buckets.setdefault(band, set()).add(cache_key.key)
+
+    def remove(self, cache_key: CacheKey):
+        with self.lock:
+            signature = self.signatures.pop(cache_key.key, None)
+            if signature is None:
+                return
+            for band in self._bands(cache_key, signature):
+                keys = self.buckets.get(band)
+                if keys is not None:
+                    keys.discard(cache_key.key)
+                    if not keys:
+                        del self.buckets[band]
+
+    def match(self, cache_key: CacheKey):
+        signature = self._signature(cache_key.query)
+        with self.lock:
+            candidates = set()
+            for band in self._bands(cache_key, signature):
+                candidates.update(self.buckets.get(band, ()))
+            best, best_similarity = None, self.threshold
+            for key in candidates:
+                other = self.signatures[key]
+                similarity = sum(x == y for x, y in zip(signature, other)) / len(signature)
+                if similarity >= best_similarity:
+                    best, best_similarity = key, similarity
+            return best
+
+
+def create_matcher(name):
+    if name == "minhash":
+        return MinHashMatcher(threshold=conf().get("response_cache_similarity", 0.8))
+    logger.warn("[ResponseCache] unknown matcher {}".format(name))
+    return None
+
+
+@singleton
+class ResponseCache(object):
+    def __init__(self):
+        self.ttl = conf().get("response_cache_ttl", 3600)
+        self.entries = ExpiredDict(self.ttl, conf().get("response_cache_max_size", 1000), on_evict=self._on_evict)  # key -> (CacheKey, content, created_at)
+        matcher = conf().get("response_cache_matcher")
+        self.matcher = create_matcher(matcher) if matcher else None
+
+    def enabled(self):
+        return conf().get("response_cache", False)
+
+    def _on_evict(self, key, entry, reason):
+        if self.matcher is not None:
+            self.matcher.remove(entry[0])
+
+    def _get_entry(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        # ExpiredDict的有效期在每次访问时刷新，这里按写入时间判断，避免热门的回复一直不更新
+        if self.ttl and time.monotonic() - entry[2] > self.ttl:
+            self.entries.pop(key, None)
+            self._on_evict(key, entry, "expired")
+            return None
+        return entry
+
+    def get(self, cache_key: CacheKey):
+        """
+        :return: 缓存的回复，未命中时返回None
+        """
+        entry = self._get_entry(cache_key.key)
+        kind = "exact"
+        if entry is None and self.matcher is not None:
+            key = self.matcher.match(cache_key)
+            if key is not None:
+                entry = self._get_entry(key)
+                kind = "near"
+        if entry is None:
+            Metrics().incr("response_cache_miss")
+            return None
+        Metrics().incr("response_cache_hit", label=kind)
+        logger.debug("[ResponseCache] {} hit, query={}".format(kind, cache_key.query))
+        return Reply(ReplyType.TEXT, entry[1])
+
+    def put(self, cache_key: CacheKey, reply: Reply):
+        if reply is None or reply.type != ReplyType.TEXT or not reply.content:
+            return
+        self.entries[cache_key.key] = (cache_key, reply.content, time.monotonic())
+        if self.matcher is not None:
+            self.matcher.add(cache_key)
+
+    def clear(self):
+        self.entries.clear()
+        matcher = conf().get("response_cache_matcher")
+        self.matcher = create_matcher(matcher) if matcher else None
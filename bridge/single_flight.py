@@ -0,0 +1,70 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+from common.singleton import singleton
+
+
+@singleton
+class SingleFlight(object):
+    """
+    合并相同的并发请求，同一个key同时只执行一次，其余请求等待并共享结果(包括异常)
+    结果通过concurrent.futures.Future传递，线程和事件循环中的请求可以互相等待
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}  # key -> Future
+
+    def _join(self, key):
+        """
+        :return: (future, 是否为首个请求)
+        """
+        with self.lock:
+            future = self.calls.get(key)
+            if future is not None:
+                return future, False
+            future = self.calls[key] = Future()
+            return future, True
+
+    def _done(self, key, future, result=None, error=None):
+        with self.lock:
+            del self.calls[key]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key, func):
+        """
+        :return: (func的结果, 是否共享了其他请求的结果)
+        """
+        future, leader = self._join(key)
+        if not leader:
+            return future.result(), True
+        try:
+            result = func()
+        except BaseException as e:
+            self._done(key, future, error=e)
+            raise
+        self._done(key, future, result)
+        return result, False
+
+    async def do_async(self, key, func):
+        """
+        do的异步版本，func为协程函数
+        """
+        future, leader = self._join(key)
+        if not leader:
+            # shield避免等待方被取消时取消共享的请求
+            return await asyncio.shield(asyncio.wrap_future(future)), True
+        try:
+            result = await func()
+        except BaseException as e:
+            self._done(key, future, error=e)
+            raise
+        self._done(key, future, result)
+        return result, False
+
+    def inflight(self):
+        return len(self.calls)
@@ -9,6 +9,7 @@ from bridge.reply import *
 
 class Channel(object):
     NOT_SUPPORT_REPLYTYPE = [ReplyType.VOICE, ReplyType.IMAGE]
+    SUPPORT_STREAM_REPLY = False  # 是否支持对同一条消息连续发送多条回复，支持时可开启流式回复
 
     def startup(self):
         """
@@ -36,6 +37,9 @@ class Channel(object):
     def build_reply_content(self, query, context: Context = None) -> Reply:
         return Bridge().fetch_reply_content(query, context)
 
+    async def build_reply_content_async(self, query, context: Context = None) -> Reply:
+        return await Bridge().fetch_reply_content_async(query, context)
+
     def build_voice_to_text(self, voice_file) -> Reply:
         return Bridge().fetch_voice_to_text(voice_file)
 
@@ -1,15 +1,24 @@
+import asyncio
+import heapq
+import itertools
 import os
 import re
 import threading
 import time
-from asyncio import CancelledError
-from concurrent.futures import Future, ThreadPoolExecutor
+from collections import deque
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
 
 from bridge.context import *
+from bridge.rate_limiter import TokenRateLimiter
 from bridge.reply import *
 from channel.channel import Channel
+from common.async_utils import run_sync, start_event_loop
 from common.dequeue import Dequeue
+from common.fair_queue import FairQueue
 from common.log import logger
+from common.metrics import Metrics
+from common.retry import RetryLater
+from common.utils import split_text_stream
 from config import conf
 from plugins import *
 
@@ -25,10 +34,24 @@ class ChatChannel(Channel):
     user_id = None  # 登录的用户id
     futures = {}  # 记录每个session_id提交到线程池的future对象, 用于重置会话时把没执行的future取消掉，正在执行的不会被取消
     sessions = {}  # 用于控制并发，每个session_id同时只能有一个context在处理
-    lock = threading.Lock()  # 用于控制对sessions的访问
+    lock = threading.RLock()  # 用于控制对sessions的访问，future取消或提前完成时回调会在持锁线程中执行，因此需要可重入
+    ready_cond = threading.Condition(lock)  # 有session可调度时唤醒消费者线程
+    ready_sessions = deque()  # 就绪队列，存放有消息待处理的session_id
+    ready_set = set()  # 已在就绪队列中的session_id，避免重复入队
+    fair_sessions = FairQueue()  # 公平调度模式下的就绪队列，按群或会话加权轮询
+    inflight = 0  # 已提交线程池但未结束的任务数
+    inflight_classes = {}  # 每个调度类别(群或会话)已提交线程池但未结束的任务数
+    queued = 0  # 所有session中排队等待处理的消息数
+    delayed = []  # 等待重试的消息，(重试时间, 序号, context)的小顶堆
+    delayed_seq = itertools.count()
     handler_pool = ThreadPoolExecutor(max_workers=8)  # 处理消息的线程池
 
     def __init__(self):
+        self.fair_dispatch = conf().get("fair_dispatch", False)
+        self.async_dispatch = conf().get("async_dispatch", False)
+        if self.async_dispatch:
+            # 异步模式下消息在事件循环中处理，等待bot回复时不占用线程
+            self.loop = start_event_loop("chat_channel_loop")
         _thread = threading.Thread(target=self.consume)
         _thread.setDaemon(True)
         _thread.start()
@@ -148,11 +171,19 @@ class ChatChannel(Channel):
         return context
 
     def _handle(self, context: Context):
-        if context is None or not context.content:
+        if context is None or not context.content or self._expired(context):
             return
         logger.debug("[WX] ready to handle context: {}".format(context))
         # reply的构建步骤
-        reply = self._generate_reply(context)
+        context["retry_reschedulable"] = True
+        try:
+            reply = self._generate_reply(context)
+        except RetryLater as e:
+            self._reschedule(context, e)
+            return
+        if reply and reply.type == ReplyType.STREAM:
+            self._send_stream_reply(context, reply)
+            return
 
         logger.debug("[WX] ready to decorate reply: {}".format(reply))
         # reply的包装步骤
@@ -161,7 +192,40 @@ class ChatChannel(Channel):
         # reply的发送步骤
         self._send_reply(context, reply)
 
+    # _handle的异步版本，插件事件、消息装饰和发送等同步逻辑在handler_pool中执行
+    async def _handle_async(self, context: Context):
+        if context is None or not context.content or self._expired(context):
+            return
+        logger.debug("[WX] ready to handle context: {}".format(context))
+        context["retry_reschedulable"] = True
+        try:
+            reply = await self._generate_reply_async(context)
+        except RetryLater as e:
+            self._reschedule(context, e)
+            return
+        if reply and reply.type == ReplyType.STREAM:
+            await run_sync(self._send_stream_reply, context, reply, executor=self.handler_pool)
+            return
+
+        logger.debug("[WX] ready to decorate reply: {}".format(reply))
+        reply = await run_sync(self._decorate_reply, context, reply, executor=self.handler_pool)
+
+        await self._send_reply_async(context, reply)
+
+    # 在事件循环中执行_handle_async，结果写入future；与线程池一样，future只能在开始执行前取消，避免#reset等取消正在处理的消息
+    async def _run_async(self, future: Future, context: Context):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            await self._handle_async(context)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(None)
+
     def _generate_reply(self, context: Context, reply: Reply = Reply()) -> Reply:
+        if context.get("retry_from_bot"):  # 插件已处理过的重试消息，直接重新调用bot
+            return self._build_reply_content(context)
         e_context = PluginManager().emit_event(
             EventContext(
                 Event.ON_HANDLE_CONTEXT,
@@ -174,7 +238,8 @@ class ChatChannel(Channel):
             if e_context.is_break():
                 context["generate_breaked_by"] = e_context["breaked_by"]
             if context.type == ContextType.TEXT or context.type == ContextType.IMAGE_CREATE:  # 文字和图片消息
-                reply = super().build_reply_content(context.content, context)
+                self._check_stream(context)
+                reply = self._build_reply_content(context)
             elif context.type == ContextType.VOICE:  # 语音消息
                 cmsg = context["msg"]
                 cmsg.prepare()
@@ -199,7 +264,12 @@ class ChatChannel(Channel):
                 if reply.type == ReplyType.TEXT:
                     new_context = self._compose_context(ContextType.TEXT, reply.content, **context.kwargs)
                     if new_context:
-                        reply = self._generate_reply(new_context)
+                        try:
+                            reply = self._generate_reply(new_context)
+                        except RetryLater as e:
+                            # 语音文件已删除，重新调度识别出的文字消息，重试时不再识别语音
+                            self._reschedule(new_context, e)
+                            return
                     else:
                         return
             elif context.type == ContextType.IMAGE or context.type == ContextType.FUNCTION \
@@ -210,6 +280,48 @@ class ChatChannel(Channel):
                 return
         return reply
 
+    async def _generate_reply_async(self, context: Context, reply: Reply = Reply()) -> Reply:
+        if context.get("retry_from_bot"):
+            return await self._build_reply_content_async(context)
+        if context.type != ContextType.TEXT and context.type != ContextType.IMAGE_CREATE:  # 语音等消息没有异步接口，整体在线程池中处理
+            return await run_sync(self._generate_reply, context, reply, executor=self.handler_pool)
+        e_context = await run_sync(
+            PluginManager().emit_event,
+            EventContext(
+                Event.ON_HANDLE_CONTEXT,
+                {"channel": self, "context": context, "reply": reply},
+            ),
+            executor=self.handler_pool,
+        )
+        reply = e_context["reply"]
+        if not e_context.is_pass():
+            logger.debug("[WX] ready to handle context: type={}, content={}".format(context.type, context.content))
+            if e_context.is_break():
+                context["generate_breaked_by"] = e_context["breaked_by"]
+            self._check_stream(context)
+            reply = await self._build_reply_content_async(context)
+        return reply
+
+    # 调用bot生成回复，需要稍后重试时标记消息，重试时从这里开始，不再执行ON_HANDLE_CONTEXT插件，避免插件重复修改消息
+    def _build_reply_content(self, context: Context) -> Reply:
+        try:
+            return super().build_reply_content(context.content, context)
+        except RetryLater:
+            context["retry_from_bot"] = True
+            raise
+
+    async def _build_reply_content_async(self, context: Context) -> Reply:
+        try:
+            return await super().build_reply_content_async(context.content, context)
+        except RetryLater:
+            context["retry_from_bot"] = True
+            raise
+
+    # 通道支持多条回复且开启了流式回复时，通知bot以流式返回文字回复
+    def _check_stream(self, context: Context):
+        if context.type == ContextType.TEXT and conf().get("stream_reply", False) and self.SUPPORT_STREAM_REPLY and context.get("desire_rtype") != ReplyType.VOICE:
+            context["stream"] = True
+
     def _decorate_reply(self, context: Context, reply: Reply) -> Reply:
         if reply and reply.type:
             e_context = PluginManager().emit_event(
@@ -231,11 +343,16 @@ class ChatChannel(Channel):
                     if desire_rtype == ReplyType.VOICE and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
                         reply = super().build_text_to_voice(reply.content)
                         return self._decorate_reply(context, reply)
+                    # 流式回复只在第一块加前缀和@，最后一块加后缀
+                    is_first, is_last = context.get("stream_part", (True, True))
                     if context.get("isgroup", False):
-                        reply_text = "@" + context["msg"].actual_user_nickname + "\n" + reply_text.strip()
-                        reply_text = conf().get("group_chat_reply_prefix", "") + reply_text + conf().get("group_chat_reply_suffix", "")
+                        if is_first:
+                            reply_text = "@" + context["msg"].actual_user_nickname + "\n" + reply_text.strip()
+                        reply_text = (conf().get("group_chat_reply_prefix", "") if is_first else "") + reply_text
+                        reply_text = reply_text + (conf().get("group_chat_reply_suffix", "") if is_last else "")
                     else:
-                        reply_text = conf().get("single_chat_reply_prefix", "") + reply_text + conf().get("single_chat_reply_suffix", "")
+                        reply_text = (conf().get("single_chat_reply_prefix", "") if is_first else "") + reply_text
+                        reply_text = reply_text + (conf().get("single_chat_reply_suffix", "") if is_last else "")
                     reply.content = reply_text
                 elif reply.type == ReplyType.ERROR or reply.type == ReplyType.INFO:
                     reply.content = "[" + str(reply.type) + "]\n" + reply.content
@@ -261,6 +378,25 @@ class ChatChannel(Channel):
                 logger.debug("[WX] ready to send reply: {}, context: {}".format(reply, context))
                 self._send(reply, context)
 
+    # 流式回复按句子或段落分块，每块作为TEXT回复分别装饰和发送，ON_DECORATE_REPLY插件会处理每一块
+    def _send_stream_reply(self, context: Context, reply: Reply):
+        chunks = split_text_stream(reply.content, conf().get("stream_reply_min_length", 60))
+        chunk = next(chunks, None)
+        is_first = True
+        try:
+            while chunk is not None:
+                next_chunk = next(chunks, None)  # 预取下一块以判断当前块是否为最后一块
+                context["stream_part"] = (is_first, next_chunk is None)
+                chunk_reply = self._decorate_reply(context, Reply(ReplyType.TEXT, chunk))
+                self._send_reply(context, chunk_reply)
+                chunk, is_first = next_chunk, False
+        finally:
+            if "stream_part" in context:
+                del context["stream_part"]
+
+    async def _send_reply_async(self, context: Context, reply: Reply):
+        await run_sync(self._send_reply, context, reply, executor=self.handler_pool)
+
     def _send(self, reply: Reply, context: Context, retry_cnt=0):
         try:
             self.send(reply, context)
@@ -293,66 +429,238 @@ class ChatChannel(Channel):
                 logger.exception("Worker raise exception: {}".format(e))
             with self.lock:
                 self.sessions[session_id][1].release()
+                dispatch_class = self.sessions[session_id][2]
+                self.inflight -= 1
+                self.inflight_classes[dispatch_class] -= 1
+                if self.inflight_classes[dispatch_class] == 0:
+                    del self.inflight_classes[dispatch_class]
+                self.ready_cond.notify()  # 释放了处理名额，其他session可能可以调度了
+                if not self.sessions[session_id][0].empty():
+                    self._schedule(session_id)  # 释放了并发名额，继续处理排队的消息
+                else:
+                    self._try_remove_session(session_id)
 
         return func
 
     def produce(self, context: Context):
         session_id = context["session_id"]
+        is_command = context.type == ContextType.TEXT and context.content.startswith("#")
+        if not is_command and TokenRateLimiter().check(context):
+            # 超出token额度的消息直接拒绝，不占用队列和线程
+            self._send(Reply(ReplyType.INFO, conf().get("token_limit_reply", "你的使用额度已用完，请稍后再试")), context)
+            return
         with self.lock:
-            if session_id not in self.sessions:
-                self.sessions[session_id] = [
-                    Dequeue(),
-                    threading.BoundedSemaphore(conf().get("concurrency_in_session", 4)),
-                ]
-            if context.type == ContextType.TEXT and context.content.startswith("#"):
-                self.sessions[session_id][0].putleft(context)  # 优先处理管理命令
+            self._ensure_session(session_id, context)
+            context["enqueue_time"] = time.monotonic()
+            admitted = True
+            if is_command:
+                self.sessions[session_id][0].putleft(context)  # 优先处理管理命令，不受队列长度限制
             else:
-                self.sessions[session_id][0].put(context)
+                admitted = self._admit(session_id)
+                if admitted:
+                    self.sessions[session_id][0].put(context)
+            if admitted:
+                self.queued += 1
+                Metrics().observe("queue_depth", self.queued)
+                self._schedule(session_id)
+            else:
+                self._try_remove_session(session_id)
+        if not admitted and conf().get("queue_shed_policy", "drop_oldest") == "reply_busy":
+            self._send(Reply(ReplyType.INFO, conf().get("queue_busy_reply", "当前排队的消息太多了，请稍后再试")), context)
+
+    # 创建session的队列和并发控制，调用方需持有self.lock
+    def _ensure_session(self, session_id, context: Context):
+        if session_id not in self.sessions:
+            dispatch_class, weight = self._dispatch_class(context)
+            self.sessions[session_id] = [
+                Dequeue(),
+                threading.BoundedSemaphore(conf().get("concurrency_in_session", 4)),
+                dispatch_class,
+                weight,
+            ]
 
-    # 消费者函数，单独线程，用于从消息队列中取出消息并处理
+    # 请求需要稍后重试时，delay秒后把消息放回会话队列的头部，等待期间不占用处理线程
+    def _reschedule(self, context: Context, retry: RetryLater):
+        context["retry_count"] = retry.retry_count
+        Metrics().incr("retry_rescheduled")
+        logger.info("[WX] reschedule context after {:.1f}s, retry_count={}: {}".format(retry.delay, retry.retry_count, context.content))
+        with self.lock:
+            heapq.heappush(self.delayed, (time.monotonic() + retry.delay, next(self.delayed_seq), context))
+            self.ready_cond.notify()
+
+    # 把到期的重试消息放回会话队列，返回距下一条重试消息到期的秒数，调用方需持有self.lock
+    def _release_delayed(self):
+        now = time.monotonic()
+        while self.delayed and self.delayed[0][0] <= now:
+            _, _, context = heapq.heappop(self.delayed)
+            context["enqueue_time"] = now  # 重新计算message_ttl，等待重试的时间不计入
+            session_id = context["session_id"]
+            self._ensure_session(session_id, context)
+            self.sessions[session_id][0].putleft(context)
+            self.queued += 1
+            self._schedule(session_id)
+        return self.delayed[0][0] - now if self.delayed else None
+
+    # 队列已满时按queue_shed_policy丢弃消息，返回新消息能否入队，调用方需持有self.lock
+    def _admit(self, session_id):
+        context_queue = self.sessions[session_id][0]
+        session_max = conf().get("session_queue_max_size", 0)
+        global_max = conf().get("global_queue_max_size", 0)
+        if (session_max <= 0 or context_queue.qsize() < session_max) and (global_max <= 0 or self.queued < global_max):
+            return True
+        policy = conf().get("queue_shed_policy", "drop_oldest")
+        if policy == "drop_oldest" and not context_queue.empty():
+            dropped = context_queue.get()
+            self.queued -= 1
+            Metrics().incr("queue_shed", label="drop_oldest")
+            logger.info("[WX] queue full, drop oldest message in session {}: {}".format(session_id, dropped.content))
+            return True
+        # drop_oldest时如果是全局队列已满而本会话没有排队消息，则丢弃新消息
+        Metrics().incr("queue_shed", label="reply_busy" if policy == "reply_busy" else "drop_newest")
+        logger.info("[WX] queue full, drop new message in session {}".format(session_id))
+        return False
+
+    # 公平调度的类别和权重：群聊按群名称，私聊按会话；权重依次按类别、用户昵称匹配fair_dispatch_weights
+    def _dispatch_class(self, context: Context):
+        cmsg = context.get("msg")
+        if context.get("isgroup", False) and cmsg:
+            dispatch_class = cmsg.other_user_nickname or context["receiver"]
+        else:
+            dispatch_class = context["session_id"]
+        weights = conf().get("fair_dispatch_weights", {})
+        weight = weights.get(dispatch_class)
+        if weight is None and cmsg:
+            weight = weights.get(cmsg.other_user_nickname)
+        return dispatch_class, weight or 1
+
+    # 将session_id放入就绪队列并唤醒消费者线程，调用方需持有self.lock
+    def _schedule(self, session_id):
+        if session_id not in self.ready_set and self.sessions[session_id][1]._value > 0:  # 并发已满的session由任务结束的回调重新调度
+            self.ready_set.add(session_id)
+            if self.fair_dispatch:
+                self.fair_sessions.put(self.sessions[session_id][2], session_id, self.sessions[session_id][3])
+            else:
+                self.ready_sessions.append(session_id)
+            self.ready_cond.notify()
+
+    # 同时处理中的消息上限，线程池模式下为线程数，只在有空闲线程时出队，避免消息堆积在线程池内部的队列中，不受队列长度、TTL和公平调度的控制
+    def _max_inflight(self):
+        if self.async_dispatch:
+            return conf().get("async_max_inflight", 1000)
+        return self.handler_pool._max_workers
+
+    # 取出下一个就绪的session_id，没有可调度的session时返回None，调用方需持有self.lock
+    def _next_ready_session(self):
+        if self.inflight >= self._max_inflight():
+            return None
+        if self.fair_dispatch:
+            max_inflight = conf().get("fair_dispatch_max_inflight", 0)
+            item = self.fair_sessions.get(lambda c: max_inflight <= 0 or self.inflight_classes.get(c, 0) < max_inflight)
+            if item is None:
+                return None
+            session_id = item[1]
+        elif self.ready_sessions:
+            session_id = self.ready_sessions.popleft()
+        else:
+            return None
+        self.ready_set.discard(session_id)
+        return session_id
+
+    # 所有任务都处理完毕且没有排队的消息时，删除session，调用方需持有self.lock
+    def _try_remove_session(self, session_id):
+        context_queue, semaphore = self.sessions[session_id][:2]
+        if context_queue.empty() and semaphore._initial_value == semaphore._value:
+            self.futures[session_id] = [t for t in self.futures.get(session_id, []) if not t.done()]
+            assert len(self.futures[session_id]) == 0, "thread pool error"
+            del self.futures[session_id]
+            del self.sessions[session_id]
+
+    # 从session中取出一条消息提交到线程池，调用方需持有self.lock
+    def _dispatch(self, session_id):
+        if session_id not in self.sessions:
+            return
+        context_queue, semaphore, dispatch_class, _ = self.sessions[session_id]
+        if context_queue.empty():
+            self._try_remove_session(session_id)
+            return
+        if not semaphore.acquire(blocking=False):  # 并发已满，等待任务结束时的回调重新调度
+            return
+        context = self._get_unexpired(session_id, context_queue)
+        if context is None:  # 排队的消息都已过期
+            semaphore.release()
+            self._try_remove_session(session_id)
+            return
+        logger.debug("[WX] consume context: {}".format(context))
+        Metrics().observe("dispatch_wait_seconds", time.monotonic() - context["enqueue_time"], label=dispatch_class)
+        self.inflight += 1
+        self.inflight_classes[dispatch_class] = self.inflight_classes.get(dispatch_class, 0) + 1
+        if self.async_dispatch:
+            future: Future = Future()
+            asyncio.run_coroutine_threadsafe(self._run_async(future, context), self.loop)
+        else:
+            future: Future = self.handler_pool.submit(self._handle, context)
+        if session_id not in self.futures:
+            self.futures[session_id] = []
+        self.futures[session_id].append(future)
+        future.add_done_callback(self._thread_pool_callback(session_id, context=context))
+        if session_id in self.sessions and not self.sessions[session_id][0].empty():
+            self._schedule(session_id)  # 还有排队的消息，可能还有并发名额
+
+    # 取出第一条未过期的消息，超过message_ttl的消息直接丢弃，调用方需持有self.lock
+    def _get_unexpired(self, session_id, context_queue):
+        ttl = conf().get("message_ttl", 0)
+        while not context_queue.empty():
+            context = context_queue.get()
+            self.queued -= 1
+            if not self._expired(context, ttl):
+                return context
+        return None
+
+    # 消息是否已超过message_ttl，超过时记录并丢弃
+    def _expired(self, context: Context, ttl=None):
+        if ttl is None:
+            ttl = conf().get("message_ttl", 0)
+        if ttl <= 0 or time.monotonic() - context.get("enqueue_time", time.monotonic()) <= ttl:
+            return False
+        Metrics().incr("queue_expired")
+        logger.info("[WX] message expired after {}s in session {}: {}".format(ttl, context.get("session_id"), context.content))
+        return True
+
+    # 消费者函数，单独线程，由produce和任务结束的回调唤醒，只处理就绪队列中的session
     def consume(self):
         while True:
-            with self.lock:
-                session_ids = list(self.sessions.keys())
-                for session_id in session_ids:
-                    context_queue, semaphore = self.sessions[session_id]
-                    if semaphore.acquire(blocking=False):  # 等线程处理完毕才能删除
-                        if not context_queue.empty():
-                            context = context_queue.get()
-                            logger.debug("[WX] consume context: {}".format(context))
-                            future: Future = self.handler_pool.submit(self._handle, context)
-                            future.add_done_callback(self._thread_pool_callback(session_id, context=context))
-                            if session_id not in self.futures:
-                                self.futures[session_id] = []
-                            self.futures[session_id].append(future)
-                        elif semaphore._initial_value == semaphore._value + 1:  # 除了当前，没有任务再申请到信号量，说明所有任务都处理完毕
-                            self.futures[session_id] = [t for t in self.futures[session_id] if not t.done()]
-                            assert len(self.futures[session_id]) == 0, "thread pool error"
-                            del self.sessions[session_id]
-                        else:
-                            semaphore.release()
-            time.sleep(0.1)
+            with self.ready_cond:
+                timeout = self._release_delayed()
+                session_id = self._next_ready_session()
+                while session_id is None:
+                    self.ready_cond.wait(timeout)
+                    timeout = self._release_delayed()
+                    session_id = self._next_ready_session()
+                self._dispatch(session_id)
 
     # 取消session_id对应的所有任务，只能取消排队的消息和已提交线程池但未执行的任务
     def cancel_session(self, session_id):
         with self.lock:
+            delayed = [item for item in self.delayed if item[2]["session_id"] != session_id]
+            if len(delayed) != len(self.delayed):
+                self.delayed[:] = delayed
+                heapq.heapify(self.delayed)
             if session_id in self.sessions:
-                for future in self.futures[session_id]:
+                for future in self.futures.get(session_id, []):
                     future.cancel()
+                if session_id not in self.sessions:  # 取消的回调可能已经删除了session
+                    return
                 cnt = self.sessions[session_id][0].qsize()
                 if cnt > 0:
                     logger.info("Cancel {} messages in session {}".format(cnt, session_id))
+                self.queued -= cnt
                 self.sessions[session_id][0] = Dequeue()
+                self._try_remove_session(session_id)
 
     def cancel_all_session(self):
         with self.lock:
-            for session_id in self.sessions:
-                for future in self.futures[session_id]:
-                    future.cancel()
-                cnt = self.sessions[session_id][0].qsize()
-                if cnt > 0:
-                    logger.info("Cancel {} messages in session {}".format(cnt, session_id))
-                self.sessions[session_id][0] = Dequeue()
+            for session_id in list(self.sessions.keys()):
+                self.cancel_session(session_id)
 
 
 def check_prefix(content, prefix_list):
@@ -371,3 +679,46 @@ def check_contain(content, keyword_list):
         if content.find(ky) != -1:
             return True
     return None
+
+
+if __name__ == "__main__":
+    # 调度器基准测试: python -m channel.chat_channel
+    # 构造10000个空闲session(无排队消息且并发名额已占满)，测量空闲时的CPU占用和消息从produce到开始处理的延迟
+    import statistics
+
+    idle_sessions = 10000
+    rounds = 200
+    started = {}
+    done = threading.Event()
+
+    class BenchChannel(ChatChannel):
+        def _handle(self, context: Context):
+            started[context["session_id"]] = time.perf_counter()
+            if len(started) == rounds:
+                done.set()
+
+    channel = BenchChannel()
+    with channel.lock:
+        for i in range(idle_sessions):
+            semaphore = threading.BoundedSemaphore(1)
+            semaphore.acquire()
+            channel.sessions["idle_{}".format(i)] = [Dequeue(), semaphore, "idle_{}".format(i), 1]
+
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    time.sleep(2)
+    cpu_used, wall_used = time.process_time() - cpu_start, time.perf_counter() - wall_start
+    print("idle sessions={}, cpu={:.1f}% ({:.4f}s cpu in {:.2f}s)".format(idle_sessions, cpu_used / wall_used * 100, cpu_used, wall_used))
+
+    produced = {}
+    for i in range(rounds):
+        session_id = "bench_{}".format(i)
+        produced[session_id] = time.perf_counter()
+        channel.produce(Context(ContextType.TEXT, "bench", {"session_id": session_id}))
+        time.sleep(0.005)
+    done.wait(10)
+    latencies = sorted((started[k] - produced[k]) * 1000 for k in started)
+    print(
+        "dispatch latency over {} messages: avg={:.3f}ms, p50={:.3f}ms, p99={:.3f}ms".format(
+            len(latencies), statistics.mean(latencies), latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99) - 1]
+        )
+    )
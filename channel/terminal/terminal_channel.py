@@ -28,6 +28,7 @@ class TerminalMessage(ChatMessage):
 
 class TerminalChannel(ChatChannel):
     NOT_SUPPORT_REPLYTYPE = [ReplyType.VOICE]
+    SUPPORT_STREAM_REPLY = True
 
     def send(self, reply: Reply, context: Context):
         print("\nBot:")
@@ -42,11 +43,12 @@ class TerminalChannel(ChatChannel):
         elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
             import io
 
-            import requests
             from PIL import Image
 
+            from common import http_client
+
             img_url = reply.content
-            pic_res = requests.get(img_url, stream=True)
+            pic_res = http_client.get(img_url, stream=True)
             image_storage = io.BytesIO()
             for block in pic_res.iter_content(1024):
                 image_storage.write(block)
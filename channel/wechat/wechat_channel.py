@@ -10,12 +10,11 @@ import os
 import threading
 import time
 
-import requests
-
 from bridge.context import *
 from bridge.reply import *
 from channel.chat_channel import ChatChannel
 from channel.wechat.wechat_message import *
+from common import http_client
 from common.expired_dict import ExpiredDict
 from common.log import logger
 from common.singleton import singleton
@@ -105,6 +104,7 @@ def qrCallback(uuid, status, qrcode):
 @singleton
 class WechatChannel(ChatChannel):
     NOT_SUPPORT_REPLYTYPE = []
+    SUPPORT_STREAM_REPLY = True
 
     def __init__(self):
         super().__init__()
@@ -193,7 +193,7 @@ class WechatChannel(ChatChannel):
         elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
             img_url = reply.content
             logger.debug(f"[WX] start download image, img_url={img_url}")
-            pic_res = requests.get(img_url, stream=True)
+            pic_res = http_client.get(img_url, stream=True)
             image_storage = io.BytesIO()
             size = 0
             for block in pic_res.iter_content(1024):
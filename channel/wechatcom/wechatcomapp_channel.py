@@ -3,7 +3,6 @@ import io
 import os
 import time
 
-import requests
 import web
 from wechatpy.enterprise import create_reply, parse_message
 from wechatpy.enterprise.crypto import WeChatCrypto
@@ -15,6 +14,7 @@ from bridge.reply import Reply, ReplyType
 from channel.chat_channel import ChatChannel
 from channel.wechatcom.wechatcomapp_client import WechatComAppClient
 from channel.wechatcom.wechatcomapp_message import WechatComAppMessage
+from common import http_client
 from common.log import logger
 from common.singleton import singleton
 from common.utils import compress_imgfile, fsize, split_string_by_utf8_length
@@ -27,6 +27,7 @@ MAX_UTF8_LEN = 2048
 @singleton
 class WechatComAppChannel(ChatChannel):
     NOT_SUPPORT_REPLYTYPE = []
+    SUPPORT_STREAM_REPLY = True
 
     def __init__(self):
         super().__init__()
@@ -89,7 +90,7 @@ class WechatComAppChannel(ChatChannel):
             logger.info("[wechatcom] sendVoice={}, receiver={}".format(reply.content, receiver))
         elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
             img_url = reply.content
-            pic_res = requests.get(img_url, stream=True)
+            pic_res = http_client.get(img_url, stream=True)
             image_storage = io.BytesIO()
             for block in pic_res.iter_content(1024):
                 image_storage.write(block)
@@ -5,7 +5,6 @@ import tempfile
 import threading
 os.environ['ntwork_LOG'] = "ERROR"
 import ntwork
-import requests
 import uuid
 
 from bridge.context import *
@@ -13,6 +12,7 @@ from bridge.reply import *
 from channel.chat_channel import ChatChannel
 from channel.wework.wework_message import *
 from channel.wework.wework_message import WeworkMessage
+from common import http_client
 from common.singleton import singleton
 from common.log import logger
 from common.time_check import time_checker
@@ -39,7 +39,7 @@ def download_and_compress_image(url, filename, quality=30):
         os.makedirs(directory)
 
     # 下载图片
-    pic_res = requests.get(url, stream=True)
+    pic_res = http_client.get(url, stream=True)
     image_storage = io.BytesIO()
     for block in pic_res.iter_content(1024):
         image_storage.write(block)
@@ -70,7 +70,7 @@ def download_video(url, filename):
         os.makedirs(directory)
 
     # 下载视频
-    response = requests.get(url, stream=True)
+    response = http_client.get(url, stream=True)
     total_size = 0
 
     video_path = os.path.join(directory, f"{filename}.mp4")
@@ -175,6 +175,7 @@ def get_with_retry(get_func, max_retries=5, delay=5):
 @singleton
 class WeworkChannel(ChatChannel):
     NOT_SUPPORT_REPLYTYPE = []
+    SUPPORT_STREAM_REPLY = True
 
     def __init__(self):
         super().__init__()
@@ -0,0 +1,40 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from config import conf
+
+_sync_executor = None
+_sync_executor_lock = threading.Lock()
+
+
+def sync_executor() -> ThreadPoolExecutor:
+    """
+    异步流程中执行同步代码(如未提供异步接口的bot)的线程池，线程数由async_sync_workers配置
+    """
+    global _sync_executor
+    if _sync_executor is None:
+        with _sync_executor_lock:
+            if _sync_executor is None:
+                _sync_executor = ThreadPoolExecutor(max_workers=conf().get("async_sync_workers", 8), thread_name_prefix="sync_shim")
+    return _sync_executor
+
+
+async def run_sync(func, *args, executor=None, **kwargs):
+    """
+    在线程池中执行同步函数并等待结果，不阻塞事件循环
+    :param executor: 指定线程池，默认使用sync_executor()
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor or sync_executor(), functools.partial(func, *args, **kwargs))
+
+
+def start_event_loop(name="event_loop") -> asyncio.AbstractEventLoop:
+    """
+    新建一个事件循环并在后台守护线程中运行
+    """
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, name=name, daemon=True)
+    thread.start()
+    return loop
@@ -0,0 +1,144 @@
+"""
+OAuth access token缓存，多个模块共用同一份token
+    - 临近过期时在后台刷新，刷新期间继续使用旧的token；已过期时同步刷新
+    - 同一个token同时只有一个刷新请求，并发的调用方等待同一个结果
+    - 保存在appdata_dir下的credentials.json中，重启后在有效期内继续使用
+"""
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+from common import http_client
+from common.log import logger
+from common.singleton import singleton
+from config import get_appdata_dir
+
+REFRESH_BEFORE = 86400  # 距过期多久时开始刷新(秒)，不超过有效期的10%
+REFRESH_CHECK_INTERVAL = 3600  # 后台检查是否需要刷新的间隔(秒)
+
+
+@singleton
+class CredentialCache(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.path = os.path.join(get_appdata_dir(), "credentials.json")
+        self.tokens = {}  # key -> {"data": 接口返回的原始结果, "expires_at": 过期时间(时间戳), "lifetime": 有效期(秒)}
+        self.fetchers = {}  # key -> 获取token的函数，用于后台刷新
+        self.refreshing = {}  # key -> Future
+        self._load()
+        threading.Thread(target=self._refresh_loop, name="credential_refresh", daemon=True).start()
+
+    def get(self, key, fetch, refresh=False) -> dict:
+        """
+        获取token
+        :param key: token的唯一标识，如 "baidu:{api_key}"
+        :param fetch: 获取token的函数，返回包含access_token和expires_in的dict，失败时抛出异常
+        :param refresh: 是否强制刷新，用于接口返回token无效时
+        :return: fetch返回的dict
+        """
+        with self.lock:
+            self.fetchers[key] = fetch
+            token = self.tokens.get(key)
+        now = time.time()
+        if refresh or token is None or now >= token["expires_at"]:
+            return self._refresh(key, fetch, stale=token if refresh else None).result()
+        if now >= token["expires_at"] - self._refresh_before(token):
+            self._refresh_in_background(key, fetch)
+        return token["data"]
+
+    def get_access_token(self, key, fetch, refresh=False) -> str:
+        return self.get(key, fetch, refresh)["access_token"]
+
+    def invalidate(self, key):
+        with self.lock:
+            self.tokens.pop(key, None)
+            self._save()
+
+    @staticmethod
+    def _refresh_before(token):
+        return min(REFRESH_BEFORE, token["lifetime"] * 0.1)
+
+    def _refresh(self, key, fetch, stale=None) -> Future:
+        """
+        :param stale: 强制刷新时的旧token，其他调用方已经刷新过时不再重复刷新
+        """
+        with self.lock:
+            future = self.refreshing.get(key)
+            if future is not None:
+                return future
+            token = self.tokens.get(key)
+            if stale is not None and token is not None and token is not stale:
+                future = Future()
+                future.set_result(token["data"])
+                return future
+            future = self.refreshing[key] = Future()
+        try:
+            data = fetch()
+            if not data or "access_token" not in data:
+                raise ValueError("fetch access token failed: {}".format(data))
+            lifetime = int(data.get("expires_in", REFRESH_BEFORE))
+            with self.lock:
+                self.tokens[key] = {"data": data, "expires_at": time.time() + lifetime, "lifetime": lifetime}
+                self._save()
+            logger.info("[CredentialCache] token {} refreshed, expires in {}s".format(key, lifetime))
+            future.set_result(data)
+        except Exception as e:
+            logger.warn("[CredentialCache] refresh token {} failed: {}".format(key, e))
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                self.refreshing.pop(key, None)
+        return future
+
+    def _refresh_in_background(self, key, fetch):
+        with self.lock:
+            if key in self.refreshing:
+                return
+        threading.Thread(target=self._refresh, args=(key, fetch), daemon=True).start()
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(REFRESH_CHECK_INTERVAL)
+            now = time.time()
+            with self.lock:
+                due = [(key, self.fetchers[key]) for key, token in self.tokens.items() if key in self.fetchers and now >= token["expires_at"] - self._refresh_before(token)]
+            for key, fetch in due:
+                self._refresh(key, fetch)
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.tokens = json.load(f)
+            logger.info("[CredentialCache] {} tokens loaded".format(len(self.tokens)))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warn("[CredentialCache] load {} failed: {}".format(self.path, e))
+
+    # 调用方需持有self.lock
+    def _save(self):
+        try:
+            tmp_path = self.path + ".tmp"
+            with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w", encoding="utf-8") as f:
+                json.dump(self.tokens, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.warn("[CredentialCache] save {} failed: {}".format(self.path, e))
+
+
+def fetch_baidu_token(api_key, secret_key) -> dict:
+    """
+    使用API Key和Secret Key获取百度智能云的access token，有效期为30天
+    """
+    url = "https://aip.baidubce.com/oauth/2.0/token"
+    params = {"grant_type": "client_credentials", "client_id": api_key, "client_secret": secret_key}
+    return http_client.post(url, params=params).json()
+
+
+def get_baidu_access_token(api_key, secret_key, refresh=False) -> str:
+    """
+    :param refresh: 接口返回token无效(error_code为110或111)时传入True强制刷新
+    """
+    return CredentialCache().get_access_token("baidu:{}".format(api_key), lambda: fetch_baidu_token(api_key, secret_key), refresh)
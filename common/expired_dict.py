@@ -1,22 +1,69 @@
-from datetime import datetime, timedelta
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from collections.abc import MutableMapping
 
+from common.log import logger
 
-class ExpiredDict(dict):
-    def __init__(self, expires_in_seconds):
-        super().__init__()
+SWEEP_INTERVAL = 30  # 后台清理过期元素的间隔(秒)
+
+_instances = []  # 需要后台清理的字典的弱引用
+_sweeper = None
+_sweeper_lock = threading.Lock()
+
+
+class ExpiredDict(MutableMapping):
+    """
+    带过期时间的字典，每次读写都会刷新元素的过期时间
+    所有元素的有效期相同，因此按最近访问顺序排列的OrderedDict同时也是按过期时间排列的，
+    过期清理和LRU淘汰都只需从头部弹出，均摊O(1)；后台线程会定期清理长期无人访问的字典
+    :param expires_in_seconds: 有效期(秒)，为None或0时不过期
+    :param max_size: 最大元素数，超出时淘汰最久未访问的元素，为None时不限制
+    :param on_evict: 元素因过期或超出容量被移除时的回调 on_evict(key, value, reason)，reason为"expired"或"capacity"
+    """
+
+    def __init__(self, expires_in_seconds, max_size=None, on_evict=None):
         self.expires_in_seconds = expires_in_seconds
+        self.max_size = max_size
+        self.on_evict = on_evict
+        self.data = OrderedDict()  # key -> (value, expiry_time)
+        self.lock = threading.RLock()
+        if expires_in_seconds:
+            _start_sweeper(self)
+
+    def _expiry_time(self, now):
+        return now + self.expires_in_seconds if self.expires_in_seconds else None
 
     def __getitem__(self, key):
-        value, expiry_time = super().__getitem__(key)
-        if datetime.now() > expiry_time:
-            del self[key]
-            raise KeyError("expired {}".format(key))
-        self.__setitem__(key, value)
-        return value
+        evicted = []
+        try:
+            with self.lock:
+                now = time.monotonic()
+                value, expiry_time = self.data[key]
+                if expiry_time is not None and now > expiry_time:
+                    evicted = self._pop_expired(now)
+                    raise KeyError("expired {}".format(key))
+                self.data[key] = (value, self._expiry_time(now))
+                self.data.move_to_end(key)
+                return value
+        finally:
+            self._notify(evicted)
 
     def __setitem__(self, key, value):
-        expiry_time = datetime.now() + timedelta(seconds=self.expires_in_seconds)
-        super().__setitem__(key, (value, expiry_time))
+        with self.lock:
+            now = time.monotonic()
+            self.data[key] = (value, self._expiry_time(now))
+            self.data.move_to_end(key)
+            evicted = self._pop_expired(now)
+            while self.max_size and len(self.data) > self.max_size:
+                old_key, (old_value, _) = self.data.popitem(last=False)
+                evicted.append((old_key, old_value, "capacity"))
+        self._notify(evicted)
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self.data[key]
 
     def get(self, key, default=None):
         try:
@@ -31,12 +78,80 @@ class ExpiredDict(dict):
         except KeyError:
             return False
 
+    def __len__(self):
+        self.expire()
+        return len(self.data)
+
     def keys(self):
-        keys = list(super().keys())
-        return [key for key in keys if key in self]
+        self.expire()
+        with self.lock:
+            return list(self.data.keys())
 
     def items(self):
-        return [(key, self[key]) for key in self.keys()]
+        self.expire()
+        with self.lock:
+            return [(key, value) for key, (value, _) in self.data.items()]
+
+    def values(self):
+        return [value for _, value in self.items()]
 
     def __iter__(self):
         return self.keys().__iter__()
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def expire(self):
+        """
+        移除所有已过期的元素，由后台线程定期调用
+        """
+        with self.lock:
+            evicted = self._pop_expired(time.monotonic())
+        self._notify(evicted)
+
+    def _pop_expired(self, now):
+        evicted = []
+        if not self.expires_in_seconds:
+            return evicted
+        while self.data:
+            key, (value, expiry_time) = next(iter(self.data.items()))
+            if now <= expiry_time:
+                break
+            del self.data[key]
+            evicted.append((key, value, "expired"))
+        return evicted
+
+    def _notify(self, evicted):
+        # 在锁外执行回调，回调中可以再次访问本字典
+        if self.on_evict is None:
+            return
+        for key, value, reason in evicted:
+            self.on_evict(key, value, reason)
+
+    def __repr__(self):
+        return "{}({})".format(self.__class__.__name__, dict(self.items()))
+
+
+def _start_sweeper(instance):
+    global _sweeper
+    with _sweeper_lock:
+        _instances.append(weakref.ref(instance))
+        if _sweeper is None:
+            _sweeper = threading.Thread(target=_sweep, name="expired_dict_sweeper", daemon=True)
+            _sweeper.start()
+
+
+def _sweep():
+    while True:
+        time.sleep(SWEEP_INTERVAL)
+        with _sweeper_lock:
+            _instances[:] = [ref for ref in _instances if ref() is not None]
+            instances = [ref() for ref in _instances]
+        for instance in instances:
+            if instance is None:
+                continue
+            try:
+                instance.expire()
+            except Exception as e:
+                logger.exception("[ExpiredDict] sweep error: {}".format(e))
@@ -0,0 +1,70 @@
+from collections import deque
+
+
+class FairQueue(object):
+    """
+    加权差额轮询(Deficit Round Robin)队列，不是线程安全的，调用方需自行加锁
+    元素按类别(如群名称、用户id)分组，每轮每个类别获得与权重成正比的出队额度，同一类别内先进先出
+    """
+
+    def __init__(self):
+        self.queues = {}  # 类别 -> 元素队列
+        self.weights = {}  # 类别 -> 权重
+        self.deficits = {}  # 类别 -> 当前剩余额度
+        self.active = deque()  # 有元素的类别，按轮询顺序排列
+
+    def put(self, cls, item, weight=1):
+        if weight <= 0:
+            raise ValueError("'weight' must be a positive number")
+        self.weights[cls] = weight
+        if cls not in self.queues:
+            self.queues[cls] = deque()
+            self.deficits[cls] = 0
+            self.active.append(cls)
+        self.queues[cls].append(item)
+
+    def get(self, eligible=None):
+        """
+        按加权轮询取出一个元素
+        :param eligible: 判断类别当前能否出队的函数，如该类别处理中的消息已达上限则跳过
+        :return: (类别, 元素)，没有可出队的元素时返回None
+        """
+        while self.active:
+            found = False
+            for _ in range(len(self.active)):
+                cls = self.active[0]
+                if eligible is not None and not eligible(cls):
+                    self.active.rotate(-1)
+                    continue
+                found = True
+                if self.deficits[cls] < 1:
+                    self.deficits[cls] += self.weights[cls]
+                    if self.deficits[cls] < 1:  # 权重小于1时需要累积多轮额度
+                        self.active.rotate(-1)
+                        continue
+                queue = self.queues[cls]
+                item = queue.popleft()
+                self.deficits[cls] -= 1
+                if not queue:
+                    self._remove(cls)
+                elif self.deficits[cls] < 1:
+                    self.active.rotate(-1)
+                return cls, item
+            if not found:
+                return None
+        return None
+
+    def _remove(self, cls):
+        self.active.popleft()
+        del self.queues[cls]
+        del self.deficits[cls]
+        del self.weights[cls]
+
+    def __contains__(self, cls):
+        return cls in self.queues
+
+    def __len__(self):
+        return sum(len(q) for q in self.queues.values())
+
+    def empty(self):
+        return not self.active
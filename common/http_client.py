@@ -0,0 +1,187 @@
+"""
+shared http client, keeps a pooled keep-alive session per host for all bots, plugins and voice/translate backends
+usage: from common import http_client; http_client.post(url, json=body, headers=headers)
+"""
+import threading
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from common.log import logger
+from config import conf
+
+# 只有requests支持按请求设置的参数，带这些参数的请求不使用http2会话
+REQUESTS_ONLY_ARGS = ["stream", "verify", "cert", "proxies"]
+
+
+class HttpClient(object):
+    def __init__(self):
+        self.sessions = {}  # (scheme://host, use_proxy, impersonate, http2) -> session
+        self.lock = threading.Lock()
+        self.http2 = None  # None表示尚未检查httpx是否可用
+
+    def session(self, url, use_proxy=False, impersonate=None, http2=False):
+        """
+        获取url所在host的会话，同一host复用连接池
+        :param use_proxy: 是否使用conf中的proxy
+        :param impersonate: 模拟浏览器的TLS指纹(如chrome110)，需要安装curl_cffi
+        :param http2: 是否使用httpx的http2会话
+        """
+        parsed = urlparse(url)
+        key = ("{}://{}".format(parsed.scheme, parsed.netloc), use_proxy, impersonate, http2)
+        session = self.sessions.get(key)
+        if session is None:
+            with self.lock:
+                session = self.sessions.get(key)
+                if session is None:
+                    session = self.sessions[key] = self._create_session(key[0], use_proxy, impersonate, http2)
+        return session
+
+    def _create_session(self, host, use_proxy, impersonate, http2):
+        proxy = conf().get("proxy") if use_proxy else None
+        proxies = {"http": proxy, "https": proxy} if proxy else None
+        pool_size = conf().get("http_pool_maxsize", 10)
+        if impersonate:
+            from curl_cffi import requests as curl_requests
+
+            session = curl_requests.Session(impersonate=impersonate)
+            if proxies:
+                session.proxies = proxies
+            return session
+        if http2:
+            import httpx
+
+            limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+            logger.debug("[HttpClient] create http2 session for {}".format(host))
+            return Http2Session(httpx.Client(http2=True, limits=limits, proxies=proxy or None))
+        session = requests.Session()
+        # 每个host单独的连接池，pool_block=True时连接数达到上限后等待空闲连接，用于限制单个host的并发连接数
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=conf().get("http_pool_block", False))
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        if proxies:
+            session.proxies = proxies
+        logger.debug("[HttpClient] create session for {}, proxy={}".format(host, proxy))
+        return session
+
+    def _http2_available(self):
+        if not conf().get("http2", False):
+            return False
+        if self.http2 is None:
+            try:
+                import h2  # noqa: F401
+                import httpx  # noqa: F401
+
+                self.http2 = True
+            except ImportError:
+                logger.warn("[HttpClient] http2 enabled but httpx[http2] is not installed, fallback to http/1.1")
+                self.http2 = False
+        return self.http2
+
+    def request(self, method, url, use_proxy=False, impersonate=None, **kwargs):
+        # 流式下载(iter_content)、verify、单次请求的代理等只有requests支持，使用requests的会话
+        http2 = not impersonate and self._http2_available() and not any(arg in kwargs for arg in REQUESTS_ONLY_ARGS)
+        return self.session(url, use_proxy, impersonate, http2).request(method, url, **kwargs)
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+
+
+class Http2Session(object):
+    """
+    将httpx.Client包装为requests.Session的调用方式，只转换httpx也支持的参数(data、timeout、allow_redirects)，
+    REQUESTS_ONLY_ARGS中的参数由HttpClient改用requests的会话处理，不会传到这里
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def request(self, method, url, data=None, timeout=None, **kwargs):
+        import httpx
+
+        if isinstance(data, (str, bytes)):
+            kwargs["content"] = data
+        elif data is not None:
+            kwargs["data"] = data
+        if isinstance(timeout, tuple):
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        if "allow_redirects" in kwargs:
+            kwargs["follow_redirects"] = kwargs.pop("allow_redirects")
+        return self.client.request(method, url, timeout=timeout, **kwargs)
+
+    def close(self):
+        self.client.close()
+
+
+client = HttpClient()
+
+
+def request(method, url, **kwargs):
+    return client.request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return client.request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return client.request("POST", url, **kwargs)
+
+
+if __name__ == "__main__":
+    # 连接复用基准测试: python -m common.http_client
+    # 本地启动一个支持keep-alive的https桩服务，对比每次新建连接和复用连接的耗时
+    import os
+    import ssl
+    import subprocess
+    import tempfile
+    import time
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    import urllib3
+
+    urllib3.disable_warnings()
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            body = b'{"result": "ok"}'
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    tmp = tempfile.mkdtemp()
+    cert, key = os.path.join(tmp, "cert.pem"), os.path.join(tmp, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", key, "-out", cert, "-days", "1", "-subj", "/CN=localhost"],
+        check=True,
+        capture_output=True,
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ssl_context.load_cert_chain(cert, key)
+    server.socket = ssl_context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "https://127.0.0.1:{}/v1/chat/completions".format(server.server_address[1])
+
+    rounds = 200
+    for name, do_post in [("requests.post", requests.post), ("http_client.post", post)]:
+        do_post(url, json={"q": "warmup"}, verify=False)
+        start = time.perf_counter()
+        for i in range(rounds):
+            do_post(url, json={"q": i}, verify=False)
+        cost = (time.perf_counter() - start) / rounds * 1000
+        print("{}: {:.3f}ms per request over {} requests".format(name, cost, rounds))
+    server.shutdown()
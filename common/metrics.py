@@ -0,0 +1,134 @@
+import threading
+from bisect import bisect_left
+
+from common.singleton import singleton
+
+# 直方图的桶上界(秒)，从0.1ms到约100s，相邻的桶相差25%
+HISTOGRAM_BOUNDS = [0.0001 * 1.25**i for i in range(62)]
+
+
+class Histogram(object):
+    """
+    按固定的桶统计次数的延迟直方图，记录为O(1)，分位数的误差不超过一个桶的宽度
+    """
+
+    def __init__(self):
+        self.buckets = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        self.max = 0
+
+    # 由Metrics.histogram在锁内调用；通过Metrics.get_histogram取得的直方图可以不加锁直接调用，并发时可能偶尔少记一次
+    def observe(self, value):
+        self.buckets[bisect_left(HISTOGRAM_BOUNDS, value)] += 1
+        if value > self.max:
+            self.max = value
+
+    @property
+    def count(self):
+        return sum(self.buckets)
+
+    def percentile(self, p):
+        """
+        :param p: 0-100
+        :return: 第p百分位数所在桶的上界，超出最大的桶时返回最大值，无记录时返回None
+        """
+        count = self.count
+        if not count:
+            return None
+        rank = max(1, int(count * p / 100 + 0.5))
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(HISTOGRAM_BOUNDS[i], self.max) if i < len(HISTOGRAM_BOUNDS) else self.max
+        return self.max
+
+    def summary(self) -> dict:
+        return {"count": self.count, "p50": self.percentile(50), "p95": self.percentile(95), "p99": self.percentile(99), "max": self.max}
+
+
+@singleton
+class Metrics(object):
+    """
+    进程内的运行指标，counter记录累计次数，observe记录次数、总和与最大值，histogram记录延迟的分布
+    指标以(name, label)区分，label可以为空，如 ("dispatch_wait_seconds", "ChatGPT测试群")
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.stats = {}
+        self.histograms = {}
+
+    def incr(self, name, value=1, label=None):
+        with self.lock:
+            key = (name, label)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, label=None):
+        with self.lock:
+            key = (name, label)
+            stat = self.stats.get(key)
+            if stat is None:
+                stat = self.stats[key] = {"count": 0, "sum": 0, "max": 0}
+            stat["count"] += 1
+            stat["sum"] += value
+            stat["max"] = max(stat["max"], value)
+
+    def histogram(self, name, value, label=None):
+        key = (name, label)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def get_histogram(self, name, label=None) -> Histogram:
+        """
+        取得(不存在时创建)直方图，用于热点路径上不加锁地记录，如每次插件调用的耗时
+        """
+        key = (name, label)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            return histogram
+
+    def histogram_summary(self, name, label=None):
+        """
+        :return: {"count", "p50", "p95", "p99", "max"}，无记录时返回None
+        """
+        with self.lock:
+            histogram = self.histograms.get((name, label))
+            return histogram.summary() if histogram is not None else None
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "stats": {k: dict(v) for k, v in self.stats.items()},
+                "histograms": {k: v.summary() for k, v in self.histograms.items()},
+            }
+
+    def report(self) -> str:
+        snapshot = self.snapshot()
+        lines = []
+        for (name, label), value in sorted(snapshot["counters"].items(), key=lambda x: (x[0][0], str(x[0][1]))):
+            lines.append("{}{}: {}".format(name, "[{}]".format(label) if label is not None else "", value))
+        for (name, label), stat in sorted(snapshot["stats"].items(), key=lambda x: (x[0][0], str(x[0][1]))):
+            avg = stat["sum"] / stat["count"] if stat["count"] else 0
+            lines.append("{}{}: count={}, avg={:.3f}, max={:.3f}".format(name, "[{}]".format(label) if label is not None else "", stat["count"], avg, stat["max"]))
+        for (name, label), summary in sorted(snapshot["histograms"].items(), key=lambda x: (x[0][0], str(x[0][1]))):
+            lines.append(
+                "{}{}: count={}, p50={:.3f}, p95={:.3f}, p99={:.3f}, max={:.3f}".format(
+                    name, "[{}]".format(label) if label is not None else "", summary["count"], summary["p50"], summary["p95"], summary["p99"], summary["max"]
+                )
+            )
+        return "\n".join(lines)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.stats.clear()
+            # 直方图可能被调用方持有(get_histogram)，原地清零
+            for histogram in self.histograms.values():
+                histogram.__init__()
@@ -0,0 +1,75 @@
+import random
+import time
+
+from config import conf
+
+
+class RetryLater(Exception):
+    """
+    请求需要等待后重试时抛出，由ChatChannel在delay秒后重新调度消息，等待期间不占用处理线程
+    只有context["retry_reschedulable"]为True(由ChatChannel处理的消息)时才会抛出，否则在当前线程中等待
+    """
+
+    def __init__(self, delay, retry_count):
+        super().__init__("retry after {:.1f}s".format(delay))
+        self.delay = delay
+        self.retry_count = retry_count
+
+
+class RetryPolicy(object):
+    """
+    重试策略：指数退避 + 全抖动(full jitter)，优先使用服务端返回的Retry-After，
+    同一条消息的所有重试(包括重新调度后的重试)共享一个截止时间，超过截止时间不再重试
+    """
+
+    def __init__(self, max_retries=None, base_delay=None, max_delay=None, deadline=None):
+        self.max_retries = conf().get("retry_max_times", 2) if max_retries is None else max_retries
+        self.base_delay = conf().get("retry_base_delay", 2) if base_delay is None else base_delay
+        self.max_delay = conf().get("retry_max_delay", 30) if max_delay is None else max_delay
+        self.deadline = conf().get("retry_deadline", 120) if deadline is None else deadline
+
+    def next_delay(self, retry_count, retry_after=None, context=None):
+        """
+        计算第retry_count + 1次重试前需要等待的秒数
+        :param retry_after: 服务端要求的等待秒数，如429返回的Retry-After
+        :param context: 消息上下文，用于记录截止时间
+        :return: 等待的秒数，不应再重试时返回None
+        """
+        if retry_count >= self.max_retries:
+            return None
+        if retry_after is not None:
+            delay = retry_after
+        else:
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**retry_count))
+        if self.deadline:
+            now = time.monotonic()
+            deadline = now + self.deadline
+            if context is not None:
+                if "retry_deadline" not in context:
+                    context["retry_deadline"] = deadline
+                deadline = context["retry_deadline"]
+            if now + delay > deadline:
+                return None
+        return delay
+
+    def wait(self, delay, retry_count, context=None):
+        """
+        等待delay秒后重试，由ChatChannel处理的消息抛出RetryLater以释放线程
+        :param retry_count: 重试时的重试次数
+        """
+        if context is not None and context.get("retry_reschedulable"):
+            raise RetryLater(delay, retry_count)
+        time.sleep(delay)
+
+
+def retry_after_seconds(headers):
+    """
+    解析Retry-After，只支持秒数的格式
+    """
+    if not headers:
+        return None
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
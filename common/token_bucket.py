@@ -1,39 +1,87 @@
+import asyncio
 import threading
 import time
 
+from common.retry import RetryLater
+
 
 class TokenBucket:
+    """
+    令牌桶，不使用后台线程，获取令牌时按距上次计算经过的时间补充令牌，支持小数令牌
+    令牌不足时预先扣除(令牌数可为负)并计算需要等待的时间，等待期间不持有锁，等待的请求按先后顺序获得令牌
+    """
+
     def __init__(self, tpm, timeout=None):
         self.capacity = int(tpm)  # 令牌桶容量
         self.tokens = 0  # 初始令牌数为0
         self.rate = int(tpm) / 60  # 令牌每秒生成速率
         self.timeout = timeout  # 等待令牌超时时间
-        self.cond = threading.Condition()  # 条件变量
-        self.is_running = True
-        # 开启令牌生成线程
-        threading.Thread(target=self._generate_tokens).start()
-
-    def _generate_tokens(self):
-        """生成令牌"""
-        while self.is_running:
-            with self.cond:
-                if self.tokens < self.capacity:
-                    self.tokens += 1
-                self.cond.notify()  # 通知获取令牌的线程
-            time.sleep(1 / self.rate)
-
-    def get_token(self):
-        """获取令牌"""
-        with self.cond:
-            while self.tokens <= 0:
-                flag = self.cond.wait(self.timeout)
-                if not flag:  # 超时
-                    return False
-            self.tokens -= 1
+        self.lock = threading.Lock()
+        self.last_time = time.monotonic()
+
+    def _reserve(self, cost):
+        """
+        预约cost个令牌
+        :return: 需要等待的秒数，超过timeout无法获得令牌时返回None
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_time) * self.rate)
+            self.last_time = now
+            if self.tokens >= cost:
+                self.tokens -= cost
+                return 0
+            wait = (cost - self.tokens) / self.rate
+            if self.timeout is not None and wait > self.timeout:
+                return None
+            self.tokens -= cost
+            return wait
+
+    def get_token(self, cost=1):
+        """
+        获取令牌
+        :param cost: 消耗的令牌数，可以是小数，如按预估的prompt token数计费
+        :return: 是否获取成功，等待超过timeout时返回False
+        """
+        wait = self._reserve(cost)
+        if wait is None:
+            return False
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+    def acquire(self, context=None, cost=1):
+        """
+        获取令牌，由ChatChannel处理的消息在令牌不足时预约令牌并抛出RetryLater，等待期间不占用处理线程，重新调度后直接使用预约的令牌
+        等待令牌不计入消息的重试次数
+        :return: 是否获取成功，等待超过timeout时返回False
+        """
+        if context is None or not context.get("retry_reschedulable"):
+            return self.get_token(cost)
+        if context.get("token_reserved"):
+            del context["token_reserved"]
+            return True
+        wait = self._reserve(cost)
+        if wait is None:
+            return False
+        if wait > 0:
+            context["token_reserved"] = True
+            raise RetryLater(wait, context.get("retry_count", 0))
+        return True
+
+    async def get_token_async(self, cost=1):
+        """
+        异步获取令牌，等待期间不阻塞事件循环
+        """
+        wait = self._reserve(cost)
+        if wait is None:
+            return False
+        if wait > 0:
+            await asyncio.sleep(wait)
         return True
 
     def close(self):
-        self.is_running = False
+        pass
 
 
 if __name__ == "__main__":
@@ -49,3 +49,25 @@ def split_string_by_utf8_length(string, max_length, max_split=0):
         result.append(encoded[start:end].decode("utf-8"))
         start = end
     return result
+
+
+def split_text_stream(deltas, min_length=60, separators="。！？；.!?;\n"):
+    """
+    将流式返回的文本增量合并为按句子或段落切分的文本块
+    :param deltas: 文本增量的迭代器
+    :param min_length: 文本块的最小长度，达到该长度后在最近的句子或段落结尾处切分
+    :param separators: 句子结尾的字符
+    :return: 文本块的生成器
+    """
+    buffer = ""
+    for delta in deltas:
+        buffer += delta
+        if len(buffer) < min_length:
+            continue
+        end = max(buffer.rfind(sep) for sep in separators)
+        if end + 1 >= min_length:
+            chunk, buffer = buffer[: end + 1], buffer[end + 1 :]
+            if chunk.strip():
+                yield chunk.strip()
+    if buffer.strip():
+        yield buffer.strip()
@@ -14,7 +14,14 @@ available_setting = {
     "open_ai_api_key": "",  # openai api key
     # openai apibase，当use_azure_chatgpt为true时，需要设置对应的api base
     "open_ai_api_base": "https://api.openai.com/v1",
+    # 多个api key或endpoint时的后端池，按剩余额度分配请求，api_type为azure的后端只用于use_azure_chatgpt，其余的用于openai的对话和画图，如 [{"api_key": "sk-xxx", "rpm": 3500, "tpm": 90000}, {"api_type": "azure", "api_key": "xxx", "api_base": "https://xxx.openai.azure.com/", "api_version": "2023-06-01-preview", "deployment_id": "gpt-35-turbo"}]
+    "open_ai_backends": [],
+    "open_ai_backend_health_check_interval": 0,  # 后端健康检查间隔(秒)，0表示不检查，摘除的后端到期后由请求试探恢复
     "proxy": "",  # openai使用的代理
+    # http连接池配置，所有bot、插件和语音、翻译服务共用，每个host单独的连接池并保持长连接
+    "http_pool_maxsize": 10,  # 每个host最多保持的连接数
+    "http_pool_block": False,  # 连接数达到上限时是否等待空闲连接，开启后可限制对单个host的并发连接数
+    "http2": False,  # 是否使用http2，需要安装 httpx[http2]
     # chatgpt模型， 当use_azure_chatgpt为true时，其名称为Azure上model deployment名称
     "model": "gpt-3.5-turbo",  # 还支持 gpt-3.5-turbo-16k, gpt-4, wenxin, xunfei
     "use_azure_chatgpt": False,  # 是否使用azure的chatgpt
@@ -35,20 +42,76 @@ available_setting = {
     "trigger_by_self": False,  # 是否允许机器人触发
     "image_create_prefix": ["画", "看", "找"],  # 开启图片回复的前缀
     "concurrency_in_session": 1,  # 同一会话最多有多少条消息在处理中，大于1可能乱序
+    "fair_dispatch": False,  # 是否开启多会话公平调度(加权差额轮询)，避免单个群聊占满处理线程，修改后需重启
+    "fair_dispatch_weights": {},  # 公平调度的权重，key为群名称、用户id或用户昵称，未配置的默认为1
+    "fair_dispatch_max_inflight": 0,  # 公平调度时每个群(私聊为每个会话)同时处理中的最大消息数，0表示不限制
+    "session_queue_max_size": 0,  # 每个会话最多排队的消息数，0表示不限制
+    "global_queue_max_size": 0,  # 所有会话合计最多排队的消息数，0表示不限制
+    "queue_shed_policy": "drop_oldest",  # 队列已满时的处理策略，支持 drop_oldest(丢弃最早的消息), drop_newest(丢弃新消息), reply_busy(丢弃新消息并回复繁忙提示)
+    "queue_busy_reply": "当前排队的消息太多了，请稍后再试",  # reply_busy策略下的提示语
+    "message_ttl": 0,  # 消息排队的最长时间(秒)，超时未处理的消息将被丢弃，0表示不限制
+    "async_dispatch": False,  # 是否使用asyncio处理消息，等待bot回复时不占用线程，修改后需重启
+    "async_max_inflight": 1000,  # 异步模式下同时处理中的最大消息数
+    "async_sync_workers": 8,  # 异步模式下执行同步bot的线程数
     "image_create_size": "256x256",  # 图片大小,可选有 256x256, 512x512, 1024x1024
     # chatgpt会话参数
     "expires_in_seconds": 3600,  # 无操作会话的过期时间
+    "max_sessions": 0,  # 内存中保留的最大会话数，超出时淘汰最久未使用的会话，0表示不限制
+    "session_store": "memory",  # 会话存储，可选 memory(进程内存) 和 sqlite(持久化到数据库，重启后保留上下文)
+    "session_store_path": "",  # sqlite数据库文件路径，默认为appdata_dir下的sessions.db
+    "session_store_flush_interval": 1,  # sqlite存储批量写入的间隔(秒)
     # 人格描述
     "character_desc": "你是ChatGPT, 一个由OpenAI训练的大型语言模型, 你旨在回答并解决人们的任何问题，并且可以使用多种语言与人交流。",
     "conversation_max_tokens": 1000,  # 支持上下文记忆的最多字符数
     # chatgpt限流配置
     "rate_limit_chatgpt": 20,  # chatgpt的调用频率限制
     "rate_limit_dalle": 50,  # openai dalle的调用频率限制
+    # 请求失败的重试策略，指数退避加随机抖动，服务端返回Retry-After时以其为准，重试等待期间消息重新排队，不占用处理线程
+    "retry_max_times": 2,  # 最大重试次数
+    "retry_base_delay": 2,  # 首次重试的最大等待时间(秒)，之后每次翻倍
+    "retry_max_delay": 30,  # 单次重试的最大等待时间(秒)
+    "retry_deadline": 120,  # 同一条消息所有重试的总时限(秒)
+    # 对话后端熔断配置
+    "circuit_breaker": True,  # 是否开启熔断
+    "circuit_breaker_window": 20,  # 按最近多少次请求统计失败率
+    "circuit_breaker_min_calls": 5,  # 统计窗口内至少多少次请求才判断是否熔断
+    "circuit_breaker_failure_rate": 0.5,  # 失败率达到多少时熔断
+    "circuit_breaker_slow_seconds": 60,  # 请求耗时超过多少秒视为失败，0表示不按耗时判断
+    "circuit_breaker_open_seconds": 30,  # 熔断后多少秒放行试探请求
+    "circuit_breaker_fallback": "",  # 熔断时使用的备用bot类型，如 "linkai"，为空时直接返回circuit_breaker_reply
+    "circuit_breaker_reply": "服务暂时不可用，请稍后再试",  # 熔断且无可用备用bot时的回复
+    # 对冲请求配置，主bot超过近期延迟的hedge_percentile分位数仍未返回时，向hedge_bot发起同样的请求，采用先返回的回复
+    "hedge_bot": "",  # 对冲使用的bot类型，如 "linkai"、"baidu"、"xunfei"，为空时不对冲
+    "hedge_percentile": 95,  # 按主bot近期延迟的第几百分位数决定对冲前的等待时间
+    "hedge_min_delay": 2,  # 对冲前的最短等待时间(秒)
+    "hedge_min_samples": 20,  # 主bot至少有多少次延迟记录后才开始对冲
+    "hedge_latency_window": 100,  # 按最近多少次请求统计延迟
+    "hedge_workers": 20,  # 执行对冲请求的线程数
+    # 会话压缩配置，会话的token数超过conversation_max_tokens的一定比例时，在后台将较早的消息压缩为摘要，代替直接丢弃
+    "session_compaction": False,  # 是否开启会话压缩，目前支持chatgpt和linkai
+    "session_compaction_threshold": 0.7,  # 超过conversation_max_tokens的多少比例时开始压缩
+    "session_compaction_keep_messages": 4,  # 保留最近多少条消息的原文
+    "session_compaction_model": "gpt-3.5-turbo",  # 生成摘要使用的模型，通过所属bot的接口请求，azure时使用对话的部署
+    "session_compaction_summary_length": 500,  # 摘要的最大字数
+    "single_flight": True,  # 是否合并同时进行的相同请求(相同的会话上下文和问题，或相同的画图描述)，只请求一次
+    # 对话回复缓存配置
+    "response_cache": False,  # 是否缓存对话回复，相同的问题和上下文直接返回缓存的回复
+    "response_cache_ttl": 3600,  # 缓存有效期(秒)
+    "response_cache_max_size": 1000,  # 最多缓存多少条回复
+    "response_cache_stateless": False,  # 是否忽略历史消息，只按system prompt和问题缓存，适合单轮问答
+    "response_cache_history_size": 4,  # 缓存的key包含最近多少条历史消息
+    "response_cache_matcher": "",  # 相似问题的匹配方式，可选 "minhash"，为空时只匹配相同的问题
+    "response_cache_similarity": 0.8,  # 相似问题的最低相似度
+    "token_limit_tiers": {},  # 按会话/用户/群限制滑动窗口内的token用量，如 {"default": {"user": 20000, "group": 100000, "session": 0}, "vip": {"user": 200000}}，用户等级通过user_data中的token_limit_tier设置
+    "token_limit_window": 3600,  # token额度的滑动窗口(秒)
+    "token_limit_reply": "你的使用额度已用完，请稍后再试",  # 超出token额度时的回复
     # chatgpt api参数 参考https://platform.openai.com/docs/api-reference/chat/create
     "temperature": 0.9,
     "top_p": 1,
     "frequency_penalty": 0,
     "presence_penalty": 0,
+    "stream_reply": False,  # 是否开启流式回复，支持的通道(wx,terminal,wechatcom_app,wework)会按句子或段落分多条消息发送
+    "stream_reply_min_length": 60,  # 流式回复每条消息的最小字数，达到后在句子或段落结尾处切分
     "request_timeout": 60,  # chatgpt请求超时时间，openai接口默认设置为600，对于难问题一般需要较长时间
     "timeout": 120,  # chatgpt重试超时时间，在这个时间内，将会自动重试
     # Baidu 文心一言参数
@@ -59,6 +122,7 @@ available_setting = {
     "xunfei_app_id": "",  # 讯飞应用ID
     "xunfei_api_key": "",  # 讯飞 API key
     "xunfei_api_secret": "",  # 讯飞 API secret
+    "xunfei_max_idle_connections": 4,  # 讯飞websocket连接池保留的空闲连接数，0表示每次请求都新建连接
     # claude 配置
     "claude_api_cookie": "",
     "claude_uuid": "",
@@ -121,6 +185,15 @@ available_setting = {
     "plugin_trigger_prefix": "$",  # 规范插件提供聊天相关指令的前缀，建议不要和管理员指令前缀"#"冲突
     # 是否使用全局插件配置
     "use_global_plugin_config": False,
+    "plugin_lazy_load": True,  # 启动时不等待插件加载完成，插件在后台并行加载，加载完成前收到的消息会等待对应插件加载完成
+    "plugin_init_workers": 8,  # 并行导入和初始化插件的线程数
+    # 插件延迟预算
+    "plugin_latency_budget": 0,  # 插件单次处理事件的延迟预算(秒)，0为不限制
+    "plugin_latency_budgets": {},  # 单独设置某些插件的延迟预算，如 {"tool": 30, "bdunit": 3}
+    "plugin_budget_exceed_limit": 5,  # 插件连续超出预算多少次后执行plugin_budget_action
+    "plugin_budget_action": "log",  # 超出预算时的处理方式，log: 只记录日志，bypass: 暂时跳过插件，disable: 禁用插件(需#enablep重新启用)
+    "plugin_bypass_seconds": 300,  # bypass时跳过插件的时间(秒)
+    "plugin_latency_sample_interval": 10,  # 没有延迟预算的插件每隔多少次事件统计一次耗时，1为每次统计
     # 知识库平台配置
     "use_linkai": False,
     "linkai_api_key": "",
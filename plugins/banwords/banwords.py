@@ -9,7 +9,7 @@ from bridge.reply import Reply, ReplyType
 from common.log import logger
 from plugins import *
 
-from .lib.WordsSearch import WordsSearch
+from .dictionary import DEFAULT_DICTIONARY, BanwordsDictionaries
 
 
 @plugins.register(
@@ -35,16 +35,17 @@ class Banwords(Plugin):
                     with open(config_path, "w") as f:
                         json.dump(conf, f, indent=4)
 
-            self.searchr = WordsSearch()
             self.action = conf["action"]
-            banwords_path = os.path.join(curdir, "banwords.txt")
-            with open(banwords_path, "r", encoding="utf-8") as f:
-                words = []
-                for line in f:
-                    word = line.strip()
-                    if word:
-                        words.append(word)
-            self.searchr.SetKeywords(words)
+            # 词库名 -> 词库文件，默认只有banwords.txt
+            dictionaries = {}
+            for name, paths in conf.get("dictionaries", {DEFAULT_DICTIONARY: "banwords.txt"}).items():
+                if isinstance(paths, str):
+                    paths = [paths]
+                dictionaries[name] = [os.path.join(curdir, path) for path in paths]
+            if DEFAULT_DICTIONARY not in dictionaries:
+                raise Exception("dictionary {} not configured".format(DEFAULT_DICTIONARY))
+            self.group_dictionaries = conf.get("group_dictionaries", {})
+            self.dictionaries = BanwordsDictionaries(dictionaries, conf.get("reload_interval", 10))
             self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
             if conf.get("reply_filter", True):
                 self.handlers[Event.ON_DECORATE_REPLY] = self.on_decorate_reply
@@ -63,15 +64,16 @@ class Banwords(Plugin):
 
         content = e_context["context"].content
         logger.debug("[Banwords] on_handle_context. content: %s" % content)
+        searchr = self._get_search(e_context["context"], "message")
         if self.action == "ignore":
-            f = self.searchr.FindFirst(content)
+            f = searchr.FindFirst(content)
             if f:
                 logger.info("[Banwords] %s in message" % f["Keyword"])
                 e_context.action = EventAction.BREAK_PASS
                 return
         elif self.action == "replace":
-            if self.searchr.ContainsAny(content):
-                reply = Reply(ReplyType.INFO, "发言中包含敏感词，请重试: \n" + self.searchr.Replace(content))
+            if searchr.ContainsAny(content):
+                reply = Reply(ReplyType.INFO, "发言中包含敏感词，请重试: \n" + searchr.Replace(content))
                 e_context["reply"] = reply
                 e_context.action = EventAction.BREAK_PASS
                 return
@@ -82,19 +84,35 @@ class Banwords(Plugin):
 
         reply = e_context["reply"]
         content = reply.content
+        searchr = self._get_search(e_context["context"], "reply")
         if self.reply_action == "ignore":
-            f = self.searchr.FindFirst(content)
+            f = searchr.FindFirst(content)
             if f:
                 logger.info("[Banwords] %s in reply" % f["Keyword"])
                 e_context["reply"] = None
                 e_context.action = EventAction.BREAK_PASS
                 return
         elif self.reply_action == "replace":
-            if self.searchr.ContainsAny(content):
-                reply = Reply(ReplyType.INFO, "已替换回复中的敏感词: \n" + self.searchr.Replace(content))
+            if searchr.ContainsAny(content):
+                reply = Reply(ReplyType.INFO, "已替换回复中的敏感词: \n" + searchr.Replace(content))
                 e_context["reply"] = reply
                 e_context.action = EventAction.CONTINUE
                 return
 
+    def _get_search(self, context, direction):
+        """
+        :param direction: message为用户消息，reply为回复
+        :return: 群聊配置了词库时使用群聊的词库，否则使用默认词库
+        """
+        name = DEFAULT_DICTIONARY
+        if self.group_dictionaries and context.kwargs.get("isgroup"):
+            group_name = context.kwargs.get("msg").other_user_nickname
+            group = self.group_dictionaries.get(group_name) or self.group_dictionaries.get("ALL_GROUP")
+            if isinstance(group, dict):
+                name = group.get(direction, DEFAULT_DICTIONARY)
+            elif group:
+                name = group
+        return self.dictionaries.get(name)
+
     def get_help_text(self, **kwargs):
         return "过滤消息中的敏感词。"
@@ -0,0 +1,104 @@
+# encoding:utf-8
+"""
+敏感词词库
+    - 支持多个命名的词库，每个词库可以由多个文件组成
+    - 后台线程定期检查词库文件的修改时间，变化时在后台重新编译，完成后整体替换，处理消息时不需要加锁也不会等待编译
+    - 重新加载失败时继续使用旧的词库
+"""
+import os
+import threading
+import time
+import weakref
+
+from common.log import logger
+from config import get_appdata_dir
+
+from .lib.CompiledWordsSearch import CompiledWordsSearch, keywords_digest
+
+DEFAULT_DICTIONARY = "default"
+
+
+def read_words(paths):
+    words = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                word = line.strip()
+                if word:
+                    words.append(word)
+    return words
+
+
+def _watch(ref, interval):
+    # 只持有弱引用，插件被重新加载后旧的词库释放时线程退出
+    while True:
+        time.sleep(interval)
+        dictionaries = ref()
+        if dictionaries is None:
+            return
+        dictionaries.check()
+        del dictionaries
+
+
+class BanwordsDictionaries(object):
+    def __init__(self, dictionaries: dict, reload_interval=10):
+        """
+        :param dictionaries: 词库名 -> 词库文件路径列表
+        :param reload_interval: 检查词库文件是否变化的间隔(秒)，为0时不自动重新加载
+        """
+        self.dictionaries = dictionaries
+        self.searches = {}  # 词库名 -> CompiledWordsSearch，只整体替换
+        self.stats = {}  # 词库名 -> 词库文件的 [(修改时间, 大小)]
+        for name in dictionaries:
+            self.stats[name] = self._stat(name)
+            self._build(name, read_words(dictionaries[name]))
+        if reload_interval > 0:
+            threading.Thread(target=_watch, args=(weakref.ref(self), reload_interval), name="banwords_reload", daemon=True).start()
+
+    def get(self, name=DEFAULT_DICTIONARY) -> CompiledWordsSearch:
+        searches = self.searches
+        return searches.get(name) or searches.get(DEFAULT_DICTIONARY)
+
+    def _stat(self, name):
+        stats = []
+        for path in self.dictionaries[name]:
+            st = os.stat(path)
+            stats.append((st.st_mtime_ns, st.st_size))
+        return stats
+
+    def _build(self, name, words):
+        """
+        :return: 词库是否有变化
+        """
+        current = self.searches.get(name)
+        if current is not None and current.digest == keywords_digest(words):
+            return False
+        cache_path = os.path.join(get_appdata_dir(), "banwords_{}.cache".format(name))
+        search = CompiledWordsSearch.LoadOrBuild(words, cache_path)
+        searches = dict(self.searches)
+        searches[name] = search
+        self.searches = searches
+        return True
+
+    def check(self):
+        """
+        重新加载文件有变化的词库
+        """
+        for name in self.dictionaries:
+            try:
+                stat = self._stat(name)
+            except OSError as e:
+                if self.stats.get(name) is not None:
+                    logger.warn("[Banwords] dictionary {} unavailable, keep the loaded words: {}".format(name, e))
+                    self.stats[name] = None
+                continue
+            if stat == self.stats.get(name):
+                continue
+            self.stats[name] = stat
+            try:
+                start = time.time()
+                words = read_words(self.dictionaries[name])
+                if self._build(name, words):
+                    logger.info("[Banwords] dictionary {} reloaded, {} words, cost {:.2f}s".format(name, len(words), time.time() - start))
+            except Exception as e:
+                logger.warn("[Banwords] reload dictionary {} failed, keep the loaded words: {}".format(name, e))
@@ -0,0 +1,483 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+WordsSearch的编译版本，接口和结果与WordsSearch完全相同
+    - 关键词中的字符先映射为连续的字符编号，trie的子节点保存在按行位移压缩的扁平数组中:
+      状态s经字符编号c转移到 _next[_base[s] + c]，当且仅当 _check[_base[s] + c] == s，
+      否则沿失败状态 _fail[s] 继续查找，到根状态时转移到 _root[c]，与WordsSearch合并失败链后的转移相同
+    - 不构建WordsSearch的节点对象，直接用列表构建状态机后压缩，构建和查找都不经过字典
+    - 用正则一次跳过开头不可能开始匹配的文本，没有匹配时不进入逐字符的循环
+    - 编译结果可以保存到磁盘，文件头为json，其后是各数组的原始字节，不使用pickle，关键词不变时启动直接加载
+    - 支持一次扫描多段文本
+运行 python -m plugins.banwords.lib.CompiledWordsSearch 进行基准测试
+"""
+import hashlib
+import json
+import re
+import sys
+from array import array
+
+from .WordsSearch import WordsSearch
+
+__all__ = ["CompiledWordsSearch"]
+
+CACHE_VERSION = 3
+# 缓存中依次保存的数组，ends为bytes，其他为array("i")
+CACHE_ARRAYS = ["base", "check", "next", "fail", "root", "ends", "out_start", "out_data"]
+
+
+def keywords_digest(keywords):
+    return hashlib.sha1("\n".join(keywords).encode("utf-8", "surrogatepass")).hexdigest()
+
+
+class CompiledWordsSearch(object):
+    def __init__(self):
+        self._keywords = []
+        self._indexs = []
+        self._alphabet = ""  # 关键词中出现的字符，字符编号为在其中的位置+1，0表示不在关键词中的字符
+        self._classes = array("i")  # ord(c) -> 字符编号，只覆盖到关键词中最大的字符
+        self._base = array("i", [0])
+        self._check = array("i", [-1])
+        self._next = array("i", [0])
+        self._fail = array("i", [0])
+        self._root = array("i", [0])  # 字符编号 -> 根状态的转移，没有时为根状态0
+        self._ends = bytes(1)  # 状态是否匹配到关键词
+        self._out_start = array("i", [0, 0])  # 状态s匹配到的关键词为 _out_data[_out_start[s]:_out_start[s + 1]]
+        self._out_data = array("i")
+        self._first_re = None  # 可以从根状态开始匹配的字符
+        self.digest = keywords_digest([])
+
+    def SetKeywords(self, keywords):
+        """
+        构建与WordsSearch相同的状态机，匹配结果为状态自己的关键词，加上失败状态的匹配结果
+        """
+        keywords = list(keywords)
+        alphabet = {}
+        children = [{}]  # 状态 -> {字符编号: 状态}
+        outputs = [[]]
+        for i, keyword in enumerate(keywords):
+            state = 0
+            for ch in keyword:
+                c = alphabet.get(ch)
+                if c is None:
+                    c = alphabet[ch] = len(alphabet) + 1
+                target = children[state].get(c)
+                if target is None:
+                    target = children[state][c] = len(children)
+                    children.append({})
+                    outputs.append([])
+                state = target
+            if state:  # 空关键词不会被匹配到
+                outputs[state].append(i)
+
+        # 按广度优先计算失败状态和匹配结果
+        n = len(children)
+        fail = [0] * n
+        order = list(children[0].values())
+        for state in order:
+            if fail[state]:
+                outputs[state].extend(outputs[fail[state]])
+            for c, target in children[state].items():
+                f = fail[state]
+                while f and c not in children[f]:
+                    f = fail[f]
+                fail[target] = children[f].get(c, 0) if state else 0
+                order.append(target)
+
+        base = [0] * n
+        check = []
+        nexts = []
+        occupied = 0  # 已占用位置的位图，用于放置有多个子节点的状态
+        used = None  # 已占用的位置，用于放置只有一个子节点的状态
+        first_free = 0
+        # 根状态的转移单独保存在_root中，其他状态放到子节点的字符编号都没有被占用的位置
+        # 子节点多的状态先放，之后大部分只有一个子节点的状态直接填入空位
+        for state in sorted(order, key=lambda state: len(children[state]), reverse=True):
+            row = children[state]
+            if not row:
+                break
+            labels = sorted(row)
+            if len(labels) > 1:
+                # taken的第b位为0时，所有 b + c 都没有被占用，取最小的b
+                taken = 0
+                for c in labels:
+                    taken |= occupied >> c
+                b = (~taken & (taken + 1)).bit_length() - 1
+                for c in labels:
+                    occupied |= 1 << (b + c)
+            else:
+                if used is None:
+                    used = bytearray(owner != -1 for owner in check)
+                pos = used.find(0, max(first_free, labels[0]))
+                if pos < 0:
+                    pos = max(len(used), labels[0])
+                b = pos - labels[0]
+            end = b + labels[-1] + 1
+            if end > len(check):
+                grow = end - len(check)
+                check.extend([-1] * grow)
+                nexts.extend([0] * grow)
+                if used is not None:
+                    used.extend(bytes(grow))
+            for c in labels:
+                check[b + c] = state
+                nexts[b + c] = row[c]
+            base[state] = b
+            if used is not None:
+                used[b + labels[0]] = 1
+                first_free = used.find(0, first_free)
+                if first_free < 0:
+                    first_free = len(used)
+        # 保证 _base[s] + c 不越界
+        grow = max(base) + len(alphabet) + 1 - len(check)
+        if grow > 0:
+            check.extend([-1] * grow)
+            nexts.extend([0] * grow)
+
+        root = [0] * (len(alphabet) + 1)
+        for c, target in children[0].items():
+            root[c] = target
+        out_start = array("i", [0])
+        out_data = array("i")
+        for output in outputs:
+            out_data.extend(output)
+            out_start.append(len(out_data))
+        self._load(
+            keywords,
+            "".join(alphabet),
+            {
+                "base": array("i", base),
+                "check": array("i", check),
+                "next": array("i", nexts),
+                "fail": array("i", fail),
+                "root": array("i", root),
+                "ends": bytes(bool(output) for output in outputs),
+                "out_start": out_start,
+                "out_data": out_data,
+            },
+        )
+
+    def _load(self, keywords, alphabet, arrays):
+        self._keywords = keywords
+        self._indexs = list(range(len(keywords)))
+        self._alphabet = alphabet
+        classes = array("i", bytes(4 * (max(map(ord, alphabet)) + 1 if alphabet else 0)))
+        for c, ch in enumerate(alphabet, 1):
+            classes[ord(ch)] = c
+        self._classes = classes
+        self._base = arrays["base"]
+        self._check = arrays["check"]
+        self._next = arrays["next"]
+        self._fail = arrays["fail"]
+        self._root = arrays["root"]
+        self._ends = arrays["ends"]
+        self._out_start = arrays["out_start"]
+        self._out_data = arrays["out_data"]
+        self.digest = keywords_digest(keywords)
+        first_chars = [alphabet[c - 1] for c in range(1, len(alphabet) + 1) if self._root[c]]
+        self._first_re = re.compile("[{}]".format("".join(re.escape(c) for c in first_chars))) if first_chars else None
+        self._tables = (classes, len(classes), self._base, self._check, self._next, self._fail, self._root, self._ends)
+
+    @staticmethod
+    def _valid(keywords, alphabet, arrays):
+        """
+        检查缓存中的数组是否一致，避免损坏的缓存在查找时越界
+        """
+        states = len(arrays["base"])
+        classes = len(alphabet) + 1
+        if not (
+            states == len(arrays["fail"]) == len(arrays["ends"]) == len(arrays["out_start"]) - 1
+            and len(arrays["check"]) == len(arrays["next"])
+            and len(arrays["root"]) == classes
+        ):
+            return False
+        if min(arrays["base"]) < 0 or max(arrays["base"]) + classes > len(arrays["check"]):
+            return False
+        for name in ["next", "fail", "root", "check"]:
+            if arrays[name] and (min(arrays[name]) < (-1 if name == "check" else 0) or max(arrays[name]) >= states):
+                return False
+        out_start, out_data = arrays["out_start"], arrays["out_data"]
+        if out_start[0] != 0 or out_start[-1] != len(out_data) or any(out_start[i] > out_start[i + 1] for i in range(states)):
+            return False
+        return not out_data or (min(out_data) >= 0 and max(out_data) < len(keywords))
+
+    def Save(self, path):
+        """
+        第一行为json格式的文件头，包括版本、关键词摘要、关键词和各数组的长度，之后依次为各数组的原始字节
+        """
+        arrays = {
+            "base": self._base,
+            "check": self._check,
+            "next": self._next,
+            "fail": self._fail,
+            "root": self._root,
+            "ends": self._ends,
+            "out_start": self._out_start,
+            "out_data": self._out_data,
+        }
+        header = {
+            "version": CACHE_VERSION,
+            "digest": self.digest,
+            "byteorder": sys.byteorder,
+            "keywords": self._keywords,
+            "alphabet": self._alphabet,
+            "lengths": [len(arrays[name]) for name in CACHE_ARRAYS],
+        }
+        with open(path, "wb") as f:
+            f.write(json.dumps(header).encode("ascii") + b"\n")
+            for name in CACHE_ARRAYS:
+                f.write(bytes(arrays[name]))
+
+    def Load(self, path, keywords=None):
+        """
+        加载Save保存的状态机
+        :param keywords: 指定时检查缓存是否由相同的关键词生成
+        :return: 是否加载成功
+        """
+        try:
+            with open(path, "rb") as f:
+                header = json.loads(f.readline())
+                if not isinstance(header, dict) or header.get("version") != CACHE_VERSION or header.get("byteorder") != sys.byteorder:
+                    return False
+                if keywords is not None and header["digest"] != keywords_digest(keywords):
+                    return False
+                arrays = {}
+                for name, length in zip(CACHE_ARRAYS, header["lengths"]):
+                    if name == "ends":
+                        data = f.read(length)
+                    else:
+                        data = array("i")
+                        data.frombytes(f.read(length * data.itemsize))
+                    if len(data) != length:
+                        return False
+                    arrays[name] = data
+                keywords, alphabet = header["keywords"], header["alphabet"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        if len(arrays) != len(CACHE_ARRAYS) or not self._valid(keywords, alphabet, arrays):
+            return False
+        self._load(keywords, alphabet, arrays)
+        return True
+
+    @classmethod
+    def LoadOrBuild(cls, keywords, cache_path=None):
+        """
+        关键词与缓存一致时从缓存加载，否则重新编译并更新缓存
+        """
+        search = cls()
+        if cache_path and search.Load(cache_path, keywords):
+            return search
+        search.SetKeywords(keywords)
+        if cache_path:
+            try:
+                search.Save(cache_path)
+            except OSError:
+                pass
+        return search
+
+    # 以下查找方法为了速度各自展开状态转移的循环，与WordsSearch一样
+    # 从第一个可以开始匹配的字符开始扫描，之前的字符都停留在根状态
+
+    def _start(self, text):
+        m = self._first_re.search(text) if self._first_re is not None else None
+        return -1 if m is None else m.start()
+
+    def _result(self, index, item):
+        keyword = self._keywords[item]
+        return {"Keyword": keyword, "Success": True, "End": index, "Start": index + 1 - len(keyword), "Index": self._indexs[item]}
+
+    def FindFirst(self, text):
+        start = self._start(text)
+        if start < 0:
+            return None
+        classes, limit, base, check, nexts, fail, root, ends = self._tables
+        state = 0
+        for index, c in enumerate(map(ord, text[start:]), start):
+            c = classes[c] if c < limit else 0
+            while state:
+                t = base[state] + c
+                if check[t] == state:
+                    state = nexts[t]
+                    break
+                state = fail[state]
+            else:
+                state = root[c]
+            if ends[state]:
+                return self._result(index, self._out_data[self._out_start[state]])
+        return None
+
+    def FindAll(self, text):
+        results = []
+        start = self._start(text)
+        if start < 0:
+            return results
+        classes, limit, base, check, nexts, fail, root, ends = self._tables
+        out_start, out_data = self._out_start, self._out_data
+        state = 0
+        for index, c in enumerate(map(ord, text[start:]), start):
+            c = classes[c] if c < limit else 0
+            while state:
+                t = base[state] + c
+                if check[t] == state:
+                    state = nexts[t]
+                    break
+                state = fail[state]
+            else:
+                state = root[c]
+            if ends[state]:
+                for j in range(out_start[state], out_start[state + 1]):
+                    results.append(self._result(index, out_data[j]))
+        return results
+
+    def ContainsAny(self, text):
+        start = self._start(text)
+        if start < 0:
+            return False
+        classes, limit, base, check, nexts, fail, root, ends = self._tables
+        state = 0
+        for c in map(ord, text[start:]):
+            c = classes[c] if c < limit else 0
+            while state:
+                t = base[state] + c
+                if check[t] == state:
+                    state = nexts[t]
+                    break
+                state = fail[state]
+            else:
+                state = root[c]
+            if ends[state]:
+                return True
+        return False
+
+    def Replace(self, text, replaceChar="*"):
+        start = self._start(text)
+        if start < 0:
+            return text
+        classes, limit, base, check, nexts, fail, root, ends = self._tables
+        result = None
+        state = 0
+        for index, c in enumerate(map(ord, text[start:]), start):
+            c = classes[c] if c < limit else 0
+            while state:
+                t = base[state] + c
+                if check[t] == state:
+                    state = nexts[t]
+                    break
+                state = fail[state]
+            else:
+                state = root[c]
+            if ends[state]:
+                if result is None:
+                    result = list(text)
+                max_length = len(self._keywords[self._out_data[self._out_start[state]]])
+                for j in range(index + 1 - max_length, index + 1):
+                    result[j] = replaceChar
+        return text if result is None else "".join(result)
+
+    def FindFirstBatch(self, texts):
+        """
+        :return: 每段文本的FindFirst结果
+        """
+        return [self.FindFirst(text) for text in texts]
+
+    def ContainsAnyBatch(self, texts):
+        """
+        与逐段调用ContainsAny相同，只在开始时取出一次状态机的数组
+        :return: 每段文本的ContainsAny结果
+        """
+        results = [False] * len(texts)
+        if self._first_re is None or not texts:
+            return results
+        classes, limit, base, check, nexts, fail, root, ends = self._tables
+        search = self._first_re.search
+        for i, text in enumerate(texts):
+            m = search(text)
+            if m is None:
+                continue
+            state = 0
+            for c in map(ord, text[m.start() :]):
+                c = classes[c] if c < limit else 0
+                while state:
+                    t = base[state] + c
+                    if check[t] == state:
+                        state = nexts[t]
+                        break
+                    state = fail[state]
+                else:
+                    state = root[c]
+                if ends[state]:
+                    results[i] = True
+                    break
+        return results
+
+
+if __name__ == "__main__":
+    import gc
+    import os
+    import random
+    import tempfile
+    import time
+    import tracemalloc
+
+    random.seed(1)
+    chars = [chr(c) for c in range(0x4E00, 0x4E00 + 3000)] + list("abcdefghijklmnopqrstuvwxyz")
+    words = list({"".join(random.choice(chars) for _ in range(random.randint(2, 6))) for _ in range(20000)})
+    texts = []
+    for _ in range(2000):
+        text = "".join(random.choice(chars) for _ in range(random.randint(20, 300)))
+        if random.random() < 0.3:
+            pos = random.randint(0, len(text))
+            text = text[:pos] + random.choice(words) + text[pos:]
+        texts.append(text)
+
+    # 构建时间和内存分开测量，tracemalloc会明显拖慢构建
+    def build(cls):
+        gc.collect()
+        start = time.time()
+        search = cls()
+        search.SetKeywords(words)
+        return search, time.time() - start
+
+    def memory(cls):
+        gc.collect()
+        tracemalloc.start()
+        search = cls()
+        search.SetKeywords(words)
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return size
+
+    old, old_build = build(WordsSearch)
+    new, new_build = build(CompiledWordsSearch)
+    old_memory, new_memory = memory(WordsSearch), memory(CompiledWordsSearch)
+
+    cache_path = os.path.join(tempfile.mkdtemp(), "banwords.cache")
+    new.Save(cache_path)
+    start = time.time()
+    loaded = CompiledWordsSearch.LoadOrBuild(words, cache_path)
+    load_time = time.time() - start
+
+    for search in [new, loaded]:
+        for text in texts:
+            assert search.FindFirst(text) == old.FindFirst(text)
+            assert search.FindAll(text) == old.FindAll(text)
+            assert search.ContainsAny(text) == old.ContainsAny(text)
+            assert search.Replace(text) == old.Replace(text)
+    assert new.FindFirstBatch(texts) == [old.FindFirst(text) for text in texts]
+    assert new.ContainsAnyBatch(texts) == [old.ContainsAny(text) for text in texts]
+    print("{} words, {} texts, results identical".format(len(words), len(texts)))
+    print("build: WordsSearch {:.2f}s, compiled {:.2f}s, load from cache {:.3f}s".format(old_build, new_build, load_time))
+    print("memory: WordsSearch {:.1f}MB, compiled {:.1f}MB".format(old_memory / 2**20, new_memory / 2**20))
+
+    def bench(func):
+        start = time.time()
+        for text in texts:
+            func(text)
+        return (time.time() - start) / len(texts) * 1e6
+
+    for name in ["FindFirst", "ContainsAny", "Replace", "FindAll"]:
+        print("{}: WordsSearch {:.1f}us/text, compiled {:.1f}us/text".format(name, bench(getattr(old, name)), bench(getattr(new, name))))
+    start = time.time()
+    new.ContainsAnyBatch(texts)
+    print("ContainsAnyBatch: {:.1f}us/text".format((time.time() - start) / len(texts) * 1e6))
@@ -4,11 +4,11 @@ import os
 import uuid
 from uuid import getnode as get_mac
 
-import requests
-
 import plugins
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import http_client
+from common.credential_cache import get_baidu_access_token
 from common.log import logger
 from plugins import *
 
@@ -24,6 +24,7 @@ from plugins import *
     desc="Baidu unit bot system",
     version="0.1",
     author="jackson",
+    context_types=[ContextType.TEXT],
 )
 class BDunit(Plugin):
     def __init__(self):
@@ -35,7 +36,7 @@ class BDunit(Plugin):
             self.service_id = conf["service_id"]
             self.api_key = conf["api_key"]
             self.secret_key = conf["secret_key"]
-            self.access_token = self.get_token()
+            self.get_token()  # 检查api_key和secret_key是否有效
             self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
             logger.info("[BDunit] inited")
         except Exception as e:
@@ -64,21 +65,27 @@ class BDunit(Plugin):
         help_text = "本插件会处理询问实时日期时间，天气，数学运算等问题，这些技能由您的百度智能对话UNIT决定\n"
         return help_text
 
-    def get_token(self):
-        """获取访问百度UUNIT 的access_token
-        #param api_key: UNIT apk_key
-        #param secret_key: UNIT secret_key
+    def get_token(self, refresh=False):
+        """获取访问百度UUNIT 的access_token，在有效期内缓存复用，临近过期时自动刷新
+        #param refresh: 是否强制刷新
         Returns:
             string: access_token
         """
-        url = "https://aip.baidubce.com/oauth/2.0/token?client_id={}&client_secret={}&grant_type=client_credentials".format(self.api_key, self.secret_key)
-        payload = ""
-        headers = {"Content-Type": "application/json", "Accept": "application/json"}
-
-        response = requests.request("POST", url, headers=headers, data=payload)
+        return get_baidu_access_token(self.api_key, self.secret_key, refresh)
 
-        # print(response.text)
-        return response.json()["access_token"]
+    def request_unit(self, path, body):
+        """调用UNIT接口，access_token失效时刷新后重试一次
+        #param path: 接口路径，如 service/chat
+        Returns:
+            dict: 接口返回结果
+        """
+        headers = {"Content-Type": "application/json"}
+        for refresh in [False, True]:
+            url = "https://aip.baidubce.com/rpc/2.0/unit/" + path + "?access_token=" + self.get_token(refresh)
+            result = json.loads(http_client.post(url, json=body, headers=headers).text)
+            if result.get("error_code") not in [110, 111]:
+                break
+        return result
 
     def getUnit(self, query):
         """
@@ -87,7 +94,6 @@ class BDunit(Plugin):
         :returns: UNIT 解析结果。如果解析失败，返回 None
         """
 
-        url = "https://aip.baidubce.com/rpc/2.0/unit/service/v3/chat?access_token=" + self.access_token
         request = {
             "query": query,
             "user_id": str(get_mac())[:32],
@@ -101,9 +107,7 @@ class BDunit(Plugin):
             "request": request,
         }
         try:
-            headers = {"Content-Type": "application/json"}
-            response = requests.post(url, json=body, headers=headers)
-            return json.loads(response.text)
+            return self.request_unit("service/v3/chat", body)
         except Exception:
             return None
 
@@ -114,7 +118,6 @@ class BDunit(Plugin):
         :param query: 用户的指令字符串
         :returns: UNIT 解析结果。如果解析失败，返回 None
         """
-        url = "https://aip.baidubce.com/rpc/2.0/unit/service/chat?access_token=" + self.access_token
         request = {"query": query, "user_id": str(get_mac())[:32]}
         body = {
             "log_id": str(uuid.uuid1()),
@@ -124,9 +127,7 @@ class BDunit(Plugin):
             "request": request,
         }
         try:
-            headers = {"Content-Type": "application/json"}
-            response = requests.post(url, json=body, headers=headers)
-            return json.loads(response.text)
+            return self.request_unit("service/chat", body)
         except Exception:
             return None
 
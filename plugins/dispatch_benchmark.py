@@ -0,0 +1,76 @@
+# encoding:utf-8
+"""
+插件事件分发的基准测试，加载30个插件，对比每条消息在4个事件上的插件开销
+运行 python -m plugins.dispatch_benchmark
+"""
+import time
+
+from bridge.context import Context, ContextType
+from bridge.reply import Reply, ReplyType
+from common.log import logger
+from plugins import Plugin
+from plugins.event import Event, EventAction, EventContext
+from plugins.plugin_manager import PluginManager
+
+PLUGIN_COUNT = 30
+EVENTS = [Event.ON_RECEIVE_MESSAGE, Event.ON_HANDLE_CONTEXT, Event.ON_DECORATE_REPLY, Event.ON_SEND_REPLY]
+
+
+def legacy_emit_event(manager, e_context: EventContext, *args, **kwargs):
+    """
+    改为分发表之前的实现，用于对比
+    """
+    if e_context.event in manager.listening_plugins:
+        for name in manager.listening_plugins[e_context.event]:
+            if manager.plugins[name].enabled and e_context.action == EventAction.CONTINUE:
+                logger.debug("Plugin %s triggered by event %s" % (name, e_context.event))
+                instance = manager.instances[name]
+                instance.handlers[e_context.event](e_context, *args, **kwargs)
+                if e_context.is_break():
+                    e_context["breaked_by"] = name
+                    logger.debug("Plugin %s breaked event %s" % (name, e_context.event))
+    return e_context
+
+
+def make_plugin(i, context_types):
+    class BenchPlugin(Plugin):
+        def __init__(self):
+            super().__init__()
+            self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
+            if i % 3 == 0:
+                self.handlers[Event.ON_DECORATE_REPLY] = self.on_handle_context
+            if i % 5 == 0:
+                self.handlers[Event.ON_RECEIVE_MESSAGE] = self.on_handle_context
+                self.handlers[Event.ON_SEND_REPLY] = self.on_handle_context
+
+        def on_handle_context(self, e_context: EventContext):
+            # 与大部分插件一样，只处理文本消息
+            if e_context["context"].type != ContextType.TEXT:
+                return
+            if e_context["context"].content == "#bench{}".format(i):
+                e_context.action = EventAction.BREAK_PASS
+
+    PluginManager().register(name="Bench{}".format(i), desire_priority=i, context_types=context_types)(BenchPlugin)
+
+
+def bench(emit, context_type, n=20000):
+    context = Context(context_type, "hello")
+    start = time.perf_counter()
+    for _ in range(n):
+        for event in EVENTS:
+            emit(EventContext(event, {"channel": None, "context": context, "reply": Reply(ReplyType.TEXT, "hi")}))
+    return (time.perf_counter() - start) / n * 1e6
+
+
+if __name__ == "__main__":
+    manager = PluginManager()
+    manager.current_plugin_path = "./plugins"
+    for i in range(PLUGIN_COUNT):
+        # 一半插件声明只处理文本消息
+        make_plugin(i, [ContextType.TEXT] if i % 2 == 0 else None)
+    manager.current_plugin_path = None
+    manager.activate_plugins()
+    for context_type in [ContextType.TEXT, ContextType.VOICE]:
+        legacy = bench(lambda e_context: legacy_emit_event(manager, e_context), context_type)
+        current = bench(manager.emit_event, context_type)
+        print("{} plugins, {} message: legacy {:.1f}us/msg, dispatch table {:.1f}us/msg".format(PLUGIN_COUNT, context_type.name, legacy, current))
@@ -11,6 +11,7 @@ from bridge.bridge import Bridge
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common import const
+from common.metrics import Metrics
 from config import conf, load_config, global_config
 from plugins import *
 
@@ -129,6 +130,19 @@ ADMIN_COMMANDS = {
         "alias": ["debug", "调试模式", "DEBUG"],
         "desc": "开启机器调试日志",
     },
+    "stats": {
+        "alias": ["stats", "运行统计"],
+        "desc": "查看消息调度等运行统计",
+    },
+    "breaker": {
+        "alias": ["breaker", "熔断状态"],
+        "args": ["reset(可选)"],
+        "desc": "查看或重置对话后端熔断状态",
+    },
+    "pstats": {
+        "alias": ["pstats", "插件耗时"],
+        "desc": "查看各插件处理消息的耗时分布、错误次数和启动时的加载耗时",
+    },
 }
 
 
@@ -152,9 +166,12 @@ def get_help_text(isadmin, isgroup):
     help_text += "\n目前可用插件有："
     for plugin in plugins:
         if plugins[plugin].enabled and not plugins[plugin].hidden:
+            instance = PluginManager().get_instance(plugin)
+            if instance is None:
+                continue
             namecn = plugins[plugin].namecn
             help_text += "\n%s:" % namecn
-            help_text += PluginManager().instances[plugin].get_help_text(verbose=False).strip()
+            help_text += instance.get_help_text(verbose=False).strip()
 
     if ADMIN_COMMANDS and isadmin:
         help_text += "\n\n管理员指令：\n"
@@ -255,7 +272,9 @@ class Godcmd(Plugin):
                             if not plugincls.enabled:
                                 continue
                             if query_name == name or query_name == plugincls.namecn:
-                                ok, result = True, PluginManager().instances[name].get_help_text(isgroup=isgroup, isadmin=isadmin, verbose=True)
+                                instance = PluginManager().get_instance(name)
+                                if instance is not None:
+                                    ok, result = True, instance.get_help_text(isgroup=isgroup, isadmin=isadmin, verbose=True)
                                 break
                         if not ok:
                             result = "插件不存在或未启用"
@@ -329,6 +348,7 @@ class Godcmd(Plugin):
                             ok, result = True, "服务已恢复"
                         elif cmd == "reconf":
                             load_config()
+                            PluginManager().refresh_dispatch_table()  # 更新插件的延迟预算
                             ok, result = True, "配置已重载"
                         elif cmd == "resetall":
                             if bottype in [const.OPEN_AI, const.CHATGPT, const.CHATGPTONAZURE, const.LINKAI,
@@ -341,6 +361,18 @@ class Godcmd(Plugin):
                         elif cmd == "debug":
                             logger.setLevel("DEBUG")
                             ok, result = True, "DEBUG模式已开启"
+                        elif cmd == "stats":
+                            ok, result = True, "运行统计：\n" + (Metrics().report() or "暂无数据")
+                        elif cmd == "breaker":
+                            if len(args) == 1 and args[0] == "reset":
+                                for breaker in Bridge().breakers.values():
+                                    breaker.reset()
+                                ok, result = True, "熔断状态已重置"
+                            else:
+                                ok, result = True, "熔断状态：\n" + Bridge().breaker_report()
+                        elif cmd == "pstats":
+                            result = "插件耗时：\n" + (PluginManager().latency_report() or "暂无数据")
+                            ok, result = True, result + "\n\n插件加载耗时：\n" + (PluginManager().load_report() or "暂无数据")
                         elif cmd == "plist":
                             plugins = PluginManager().list_plugins()
                             ok = True
@@ -15,6 +15,7 @@ from plugins import *
     desc="A simple plugin that says hello",
     version="0.1",
     author="lanvent",
+    context_types=[ContextType.TEXT, ContextType.JOIN_GROUP, ContextType.PATPAT],
 )
 class Hello(Plugin):
     def __init__(self):
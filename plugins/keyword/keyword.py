@@ -17,6 +17,7 @@ from plugins import *
     desc="关键词匹配过滤",
     version="0.1",
     author="fengyege.top",
+    context_types=[ContextType.TEXT],
 )
 class Keyword(Plugin):
     def __init__(self):
@@ -12,6 +12,7 @@ from bridge import bridge
     desc="A plugin that supports knowledge base and midjourney drawing.",
     version="0.1.0",
     author="https://link-ai.tech",
+    context_types=[ContextType.TEXT, ContextType.IMAGE, ContextType.IMAGE_CREATE],
 )
 class LinkAI(Plugin):
     def __init__(self):
@@ -1,17 +1,29 @@
 # encoding:utf-8
 
+import functools
 import importlib
 import importlib.util
 import json
 import os
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from time import perf_counter
 
+from bridge.context import ContextType
 from common.log import logger
+from common.metrics import Metrics
 from common.singleton import singleton
 from common.sorted_dict import SortedDict
 from config import conf, write_plugin_config
 
 from .event import *
+from .plugin import Plugin
+from .plugin_manifest import read_manifest
+
+# 超出延迟预算时只记录日志，不会被跳过或禁用的插件
+BUDGET_EXEMPT_PLUGINS = ["GODCMD", "BANWORDS"]
 
 
 @singleton
@@ -19,10 +31,29 @@ class PluginManager:
     def __init__(self):
         self.plugins = SortedDict(lambda k, v: v.priority, reverse=True)
         self.listening_plugins = {}
+        self.dispatch_table = {}  # event -> [(name, handler, context_types, 延迟预算, 耗时直方图)]，只包含已开启的插件，按优先级排序
         self.instances = {}
+        self.budget_exceeded = {}  # name -> 连续超出延迟预算的次数，没有超出预算的插件不在其中
+        self.emit_count = 0  # 用于按plugin_latency_sample_interval抽样统计耗时，多线程下计数不精确不影响抽样
+        self.sample_interval = 1
+        self.bypassed = {}  # name -> 跳过到的时间(time.monotonic)
+        self.metrics = Metrics()
         self.pconf = {}
-        self.current_plugin_path = None
+        self.local = threading.local()  # 各线程导入插件时的current_plugin_path
         self.loaded = {}
+        self.lock = threading.RLock()
+        self.load_locks = {}  # name -> 导入和初始化插件的锁，保证每个插件只初始化一次
+        self.import_times = {}  # plugin_path -> 导入耗时
+        self.load_times = {}  # name -> {"import": 导入耗时, "init": 初始化耗时, "status": 结果}
+        self.executor = None
+
+    @property
+    def current_plugin_path(self):
+        return getattr(self.local, "plugin_path", None)
+
+    @current_plugin_path.setter
+    def current_plugin_path(self, plugin_path):
+        self.local.plugin_path = plugin_path
 
     def register(self, name: str, desire_priority: int = 0, **kwargs):
         def wrapper(plugincls):
@@ -34,17 +65,61 @@ class PluginManager:
             plugincls.version = kwargs.get("version") if kwargs.get("version") != None else "1.0"
             plugincls.namecn = kwargs.get("namecn") if kwargs.get("namecn") != None else name
             plugincls.hidden = kwargs.get("hidden") if kwargs.get("hidden") != None else False
+            # 插件处理的消息类型，其他类型的消息不会触发插件，为None时不限制
+            plugincls.context_types = frozenset(kwargs["context_types"]) if kwargs.get("context_types") else None
             plugincls.enabled = True
             if self.current_plugin_path == None:
-                raise Exception("Plugin path not set")
+                # 不经过load_plugins直接导入插件包时(如 python -m plugins.banwords.lib.CompiledWordsSearch)，按模块名确定插件目录
+                module = plugincls.__module__.split(".")
+                if len(module) < 2 or module[0] != "plugins":
+                    raise Exception("Plugin path not set")
+                plugincls.path = os.path.join("./plugins", module[1])
+            registered = self.plugins.get(name.upper())
+            if getattr(registered, "lazy", False):
+                # 替换根据manifest注册的占位类，保留从plugins.json中读取的状态
+                plugincls.enabled = registered.enabled
+                plugincls.priority = registered.priority
             self.plugins[name.upper()] = plugincls
             logger.info("Plugin %s_v%s registered, path=%s" % (name, plugincls.version, plugincls.path))
 
         return wrapper
 
+    def register_manifest(self, plugin_path, import_path, manifest: dict):
+        """
+        根据manifest注册占位的插件类，插件模块在第一次初始化时才导入
+        """
+        name = manifest["name"]
+        if name.upper() in self.plugins:
+            return
+        # manifest中没有找到绑定的事件时，加载完成前监听所有事件
+        events = [Event[event] for event in manifest["events"] if event in Event.__members__] or list(Event)
+        context_types = manifest.get("context_types")
+        plugincls = type(
+            name,
+            (Plugin,),
+            {
+                "lazy": True,
+                "import_path": import_path,
+                "manifest_events": events,
+                "name": name,
+                "priority": manifest.get("desire_priority", 0),
+                "desc": manifest.get("desc"),
+                "author": manifest.get("author"),
+                "path": plugin_path,
+                "version": manifest.get("version") or "1.0",
+                "namecn": manifest.get("namecn") or name,
+                "hidden": manifest.get("hidden") or False,
+                "context_types": frozenset(ContextType[t] for t in context_types) if context_types else None,
+                "enabled": True,
+            },
+        )
+        self.plugins[name.upper()] = plugincls
+        logger.info("Plugin %s_v%s registered from manifest, path=%s" % (name, plugincls.version, plugin_path))
+
     def save_config(self):
-        with open("./plugins/plugins.json", "w", encoding="utf-8") as f:
-            json.dump(self.pconf, f, indent=4, ensure_ascii=False)
+        with self.lock:
+            with open("./plugins/plugins.json", "w", encoding="utf-8") as f:
+                json.dump(self.pconf, f, indent=4, ensure_ascii=False)
 
     def load_config(self):
         logger.info("Loading plugins config...")
@@ -96,7 +171,14 @@ class PluginManager:
                 if os.path.isfile(main_module_path):
                     # 导入插件
                     import_path = "plugins.{}".format(plugin_name)
+                    if plugin_path not in self.loaded:
+                        # 能读取到manifest时不导入模块，在初始化插件时再导入
+                        manifest = read_manifest(plugin_path)
+                        if manifest is not None:
+                            self.register_manifest(plugin_path, import_path, manifest)
+                            continue
                     try:
+                        start = time.time()
                         self.current_plugin_path = plugin_path
                         if plugin_path in self.loaded:
                             if self.loaded[plugin_path] == None:
@@ -108,6 +190,7 @@ class PluginManager:
                                     importlib.reload(sys.modules[name])
                         else:
                             self.loaded[plugin_path] = importlib.import_module(import_path)
+                            self.import_times[plugin_path] = time.time() - start
                         self.current_plugin_path = None
                     except Exception as e:
                         logger.warn("Failed to import plugin %s: %s" % (plugin_name, e))
@@ -134,28 +217,138 @@ class PluginManager:
         return new_plugins
 
     def refresh_order(self):
-        for event in self.listening_plugins.keys():
-            self.listening_plugins[event].sort(key=lambda name: self.plugins[name].priority, reverse=True)
+        with self.lock:
+            for event in self.listening_plugins.keys():
+                self.listening_plugins[event].sort(key=lambda name: self.plugins[name].priority if name in self.plugins else 0, reverse=True)
+            self.refresh_dispatch_table()
 
-    def activate_plugins(self):  # 生成新开启的插件实例
-        failed_plugins = []
-        for name, plugincls in self.plugins.items():
-            if plugincls.enabled:
-                if name not in self.instances:
-                    try:
-                        instance = plugincls()
-                    except Exception as e:
-                        logger.warn("Failed to init %s, diabled. %s" % (name, e))
-                        self.disable_plugin(name)
-                        failed_plugins.append(name)
+    def refresh_dispatch_table(self):
+        """
+        预先计算每个事件依次调用的处理函数，插件开启、关闭、调整优先级、重新加载或重载配置后需要刷新
+        """
+        with self.lock:
+            dispatch_table = {}
+            budgets = {name: self._latency_budget(name) for name in self.plugins}
+            self.sample_interval = max(1, int(conf().get("plugin_latency_sample_interval", 10)))
+            for event, names in self.listening_plugins.items():
+                handlers = []
+                for name in names:
+                    plugincls = self.plugins.get(name)
+                    if plugincls is None or not plugincls.enabled or name in self.bypassed:
                         continue
-                    self.instances[name] = instance
-                    for event in instance.handlers:
-                        if event not in self.listening_plugins:
-                            self.listening_plugins[event] = []
-                        self.listening_plugins[event].append(name)
-        self.refresh_order()
-        return failed_plugins
+                    if name in self.instances:
+                        handler = self.instances[name].handlers[event]
+                    else:
+                        # 插件还在加载，第一次收到事件时等待加载完成
+                        handler = functools.partial(self._lazy_handle, name, event)
+                    histogram = self.metrics.get_histogram("plugin_latency_seconds", label=name)
+                    handlers.append((name, handler, plugincls.context_types, budgets[name], histogram))
+                dispatch_table[event] = handlers
+            self.dispatch_table = dispatch_table
+
+    def activate_plugins(self):  # 生成新开启的插件实例
+        futures = self._activate()
+        return [name for name, future in futures.items() if future.result() is None]
+
+    def _activate(self) -> dict:
+        """
+        在线程池中并行导入和初始化新开启的插件，加载完成前按manifest中的事件占位
+        :return: name -> Future，结果为插件实例，失败时为None
+        """
+        with self.lock:
+            names = [name for name, plugincls in self.plugins.items() if plugincls.enabled and name not in self.instances]
+            for name in names:
+                for event in getattr(self.plugins[name], "manifest_events", None) or list(Event):
+                    listeners = self.listening_plugins.setdefault(event, [])
+                    if name not in listeners:
+                        listeners.append(name)
+            self.refresh_order()
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=conf().get("plugin_init_workers", 8), thread_name_prefix="plugin_init")
+        return {name: self.executor.submit(self._load_plugin, name) for name in names}
+
+    def _lazy_handle(self, name, event, e_context: EventContext, *args, **kwargs):
+        instance = self._load_plugin(name)
+        if instance is not None and event in instance.handlers:
+            instance.handlers[event](e_context, *args, **kwargs)
+
+    def get_instance(self, name: str):
+        """
+        :return: 插件实例，插件还在加载时等待加载完成，未开启或加载失败时返回None
+        """
+        name = name.upper()
+        if name in self.instances:
+            return self.instances[name]
+        return self._load_plugin(name)
+
+    def _load_plugin(self, name):
+        """
+        导入(manifest注册的插件)并初始化插件，可能同时在线程池和收到事件的线程中调用
+        :return: 插件实例，失败时返回None
+        """
+        with self.load_locks.setdefault(name, threading.Lock()):
+            if name in self.instances:
+                return self.instances[name]
+            plugincls = self.plugins.get(name)
+            if plugincls is None or not plugincls.enabled:
+                return None
+            load_time = self.load_times[name] = {"import": self.import_times.get(plugincls.path, 0), "init": 0, "status": "ok"}
+            if getattr(plugincls, "lazy", False):
+                start = time.time()
+                try:
+                    self.current_plugin_path = plugincls.path
+                    self.loaded[plugincls.path] = importlib.import_module(plugincls.import_path)
+                except Exception as e:
+                    logger.warn("Failed to import plugin %s: %s" % (name, e))
+                finally:
+                    self.current_plugin_path = None
+                    load_time["import"] = time.time() - start
+                plugincls = self.plugins.get(name)
+                if plugincls is None or getattr(plugincls, "lazy", False):
+                    # 导入失败或模块中没有注册该插件，与直接导入失败时一样视为插件不存在
+                    load_time["status"] = "import failed"
+                    self._remove_placeholder(name)
+                    return None
+            start = time.time()
+            try:
+                instance = plugincls()
+            except Exception as e:
+                logger.warn("Failed to init %s, diabled. %s" % (name, e))
+                load_time["status"] = "init failed"
+                self.disable_plugin(name)
+                return None
+            finally:
+                load_time["init"] = time.time() - start
+            with self.lock:
+                self.instances[name] = instance
+                for event, listeners in self.listening_plugins.items():
+                    if name in listeners and event not in instance.handlers:
+                        listeners.remove(name)
+                for event in instance.handlers:
+                    listeners = self.listening_plugins.setdefault(event, [])
+                    if name not in listeners:
+                        listeners.append(name)
+                self.refresh_order()
+            return instance
+
+    def _remove_placeholder(self, name):
+        with self.lock:
+            for listeners in self.listening_plugins.values():
+                if name in listeners:
+                    listeners.remove(name)
+            if getattr(self.plugins.get(name), "lazy", False):
+                del self.plugins[name]
+            self.refresh_dispatch_table()
+
+    def load_report(self) -> str:
+        lines = []
+        for name, load_time in sorted(self.load_times.items(), key=lambda x: x[1]["import"] + x[1]["init"], reverse=True):
+            lines.append("{}: import={:.2f}s, init={:.2f}s, {}".format(name, load_time["import"], load_time["init"], load_time["status"]))
+        return "\n".join(lines)
+
+    def _report_startup(self, start, futures):
+        wait(futures.values())
+        logger.info("[PluginManager] {} plugins loaded in {:.2f}s:\n{}".format(len(futures), time.time() - start, self.load_report()))
 
     def reload_plugin(self, name: str):
         name = name.upper()
@@ -169,6 +362,7 @@ class PluginManager:
         return False
 
     def load_plugins(self):
+        start = time.time()
         self.load_config()
         self.scan_plugins()
         # 加载全量插件配置
@@ -178,20 +372,118 @@ class PluginManager:
         for name, plugin in pconf["plugins"].items():
             if name.upper() not in self.plugins:
                 logger.error("Plugin %s not found, but found in plugins.json" % name)
-        self.activate_plugins()
+        futures = self._activate()
+        if conf().get("plugin_lazy_load", True):
+            # 不等待插件加载完成，通道可以先启动
+            threading.Thread(target=self._report_startup, args=(start, futures), daemon=True).start()
+        else:
+            self._report_startup(start, futures)
 
     def emit_event(self, e_context: EventContext, *args, **kwargs):
-        if e_context.event in self.listening_plugins:
-            for name in self.listening_plugins[e_context.event]:
-                if self.plugins[name].enabled and e_context.action == EventAction.CONTINUE:
-                    logger.debug("Plugin %s triggered by event %s" % (name, e_context.event))
-                    instance = self.instances[name]
-                    instance.handlers[e_context.event](e_context, *args, **kwargs)
-                    if e_context.is_break():
-                        e_context["breaked_by"] = name
-                        logger.debug("Plugin %s breaked event %s" % (name, e_context.event))
+        self.emit_count += 1
+        sampled = self.emit_count % self.sample_interval == 0
+        for name, handler, context_types, budget, histogram in self.dispatch_table.get(e_context.event, ()):
+            # 前面的插件可能修改了消息类型，每次重新判断
+            if context_types is not None and e_context["context"].type not in context_types:
+                continue
+            if not (sampled or budget):
+                try:
+                    handler(e_context, *args, **kwargs)
+                except Exception:
+                    self.metrics.incr("plugin_errors", label=name)
+                    raise
+            else:
+                # 有延迟预算的插件每次计时，其他插件抽样计时；耗时直接记入插件自己的直方图，不加锁
+                start = perf_counter()
+                try:
+                    handler(e_context, *args, **kwargs)
+                except Exception:
+                    self.metrics.incr("plugin_errors", label=name)
+                    raise
+                finally:
+                    latency = perf_counter() - start
+                    histogram.observe(latency)
+                    if budget and (latency > budget or name in self.budget_exceeded):
+                        self._record_latency(name, latency, budget)
+            if e_context.is_break():
+                e_context["breaked_by"] = name
+                logger.debug("Plugin %s breaked event %s" % (name, e_context.event))
+                break
         return e_context
 
+    def _latency_budget(self, name):
+        budgets = conf().get("plugin_latency_budgets") or {}
+        for key, budget in budgets.items():
+            if key.upper() == name:
+                return budget
+        return conf().get("plugin_latency_budget", 0)
+
+    def _record_latency(self, name, latency, budget):
+        """
+        检查插件的处理耗时，连续超出延迟预算plugin_budget_exceed_limit次后按plugin_budget_action处理
+        """
+        if latency <= budget:
+            self.budget_exceeded.pop(name, None)
+            return
+        self.metrics.incr("plugin_budget_exceeded", label=name)
+        count = self.budget_exceeded.get(name, 0) + 1
+        self.budget_exceeded[name] = count
+        logger.warn("[PluginManager] plugin {} cost {:.2f}s, exceeds latency budget {}s, {} times in a row".format(name, latency, budget, count))
+        if count < conf().get("plugin_budget_exceed_limit", 5) or name in BUDGET_EXEMPT_PLUGINS:
+            return
+        self.budget_exceeded.pop(name, None)
+        action = conf().get("plugin_budget_action", "log")
+        if action == "disable":
+            logger.warn("[PluginManager] plugin {} keeps exceeding latency budget, disabled, use #enablep to enable it".format(name))
+            self.disable_plugin(name)
+        elif action == "bypass":
+            self.bypass_plugin(name, conf().get("plugin_bypass_seconds", 300))
+
+    def bypass_plugin(self, name: str, seconds):
+        """
+        暂时跳过插件，不修改插件的启用状态，到期或执行#enablep后恢复
+        """
+        name = name.upper()
+        until = time.monotonic() + seconds
+        self.bypassed[name] = until
+        self.refresh_dispatch_table()
+        logger.warn("[PluginManager] plugin {} bypassed for {}s".format(name, seconds))
+        timer = threading.Timer(seconds, self._end_bypass, args=(name, until))
+        timer.daemon = True
+        timer.start()
+
+    def _end_bypass(self, name, until):
+        if self.bypassed.get(name) == until:
+            del self.bypassed[name]
+            self.refresh_dispatch_table()
+            logger.info("[PluginManager] plugin {} bypass ended".format(name))
+
+    def latency_report(self) -> str:
+        snapshot = self.metrics.snapshot()
+        lines = []
+        for name, plugincls in self.plugins.items():
+            summary = snapshot["histograms"].get(("plugin_latency_seconds", name))
+            if summary is None:
+                continue
+            line = "{}: samples={}, errors={}, p50={:.0f}ms, p95={:.0f}ms, p99={:.0f}ms, max={:.0f}ms".format(
+                plugincls.name,
+                summary["count"],
+                snapshot["counters"].get(("plugin_errors", name), 0),
+                summary["p50"] * 1000,
+                summary["p95"] * 1000,
+                summary["p99"] * 1000,
+                summary["max"] * 1000,
+            )
+            budget = self._latency_budget(name)
+            if budget:
+                line += ", budget={}s, exceeded={}".format(budget, snapshot["counters"].get(("plugin_budget_exceeded", name), 0))
+            if not plugincls.enabled:
+                line += " (已禁用)"
+            elif name in self.bypassed:
+                line += " (跳过中，剩余{:.0f}s)".format(max(0, self.bypassed[name] - time.monotonic()))
+            lines.append(line)
+        return "\n".join(lines)
+
     def set_plugin_priority(self, name: str, priority: int):
         name = name.upper()
         if name not in self.plugins:
@@ -211,6 +503,9 @@ class PluginManager:
         name = name.upper()
         if name not in self.plugins:
             return False, "插件不存在"
+        self.budget_exceeded.pop(name, None)
+        if self.bypassed.pop(name, None) is not None:
+            self.refresh_dispatch_table()
         if not self.plugins[name].enabled:
             self.plugins[name].enabled = True
             rawname = self.plugins[name].name
@@ -231,6 +526,7 @@ class PluginManager:
             rawname = self.plugins[name].name
             self.pconf["plugins"][rawname]["enabled"] = False
             self.save_config()
+            self.refresh_dispatch_table()
             return True
         return True
 
@@ -330,8 +626,10 @@ class PluginManager:
                     self.listening_plugins[event].remove(name)
             del self.plugins[name]
             del self.pconf["plugins"][rawname]
-            self.loaded[dirname] = None
+            if dirname in self.loaded:
+                self.loaded[dirname] = None
             self.save_config()
+            self.refresh_dispatch_table()
             return True, "卸载插件成功"
         except Exception as e:
             logger.error("Failed to uninstall plugin, {}".format(e))
@@ -0,0 +1,88 @@
+# encoding:utf-8
+"""
+不导入插件模块，从源码中读取插件的注册信息(@plugins.register的参数)和监听的事件，用于延迟导入插件
+"""
+import ast
+import os
+
+from common.log import logger
+
+REGISTER_KWARGS = ["name", "desire_priority", "hidden", "desc", "version", "author", "namecn"]
+
+
+def _is_register(decorator):
+    if not isinstance(decorator, ast.Call):
+        return False
+    func = decorator.func
+    if isinstance(func, ast.Attribute):
+        return func.attr == "register"
+    return isinstance(func, ast.Name) and func.id == "register"
+
+
+def _enum_names(node, enum_name):
+    """
+    :return: [ContextType.TEXT, ...] 形式的列表中的成员名
+    """
+    names = []
+    for elt in node.elts:
+        if not (isinstance(elt, ast.Attribute) and isinstance(elt.value, ast.Name) and elt.value.id == enum_name):
+            raise ValueError("unsupported {}: {}".format(enum_name, ast.dump(elt)))
+        names.append(elt.attr)
+    return names
+
+
+def _handler_events(classdef):
+    """
+    :return: 类中 self.handlers[Event.XXX] = ... 绑定的事件名，包括条件分支中的
+    """
+    events = []
+    for node in ast.walk(classdef):
+        if not isinstance(node, ast.Assign):
+            continue
+        for target in node.targets:
+            if not (isinstance(target, ast.Subscript) and isinstance(target.value, ast.Attribute) and target.value.attr == "handlers"):
+                continue
+            key = target.slice
+            if isinstance(key, getattr(ast, "Index", ())):  # python3.8及以下
+                key = key.value
+            if isinstance(key, ast.Attribute) and isinstance(key.value, ast.Name) and key.value.id == "Event" and key.attr not in events:
+                events.append(key.attr)
+    return events
+
+
+def read_manifest(plugin_path):
+    """
+    读取插件目录中的注册信息
+    :return: {"name", "desire_priority", "hidden", "desc", "version", "author", "namecn", "context_types", "events"}，
+             无法确定时返回None，需要导入插件模块
+    """
+    manifests = []
+    try:
+        for filename in sorted(os.listdir(plugin_path)):
+            if not filename.endswith(".py"):
+                continue
+            with open(os.path.join(plugin_path, filename), "r", encoding="utf-8") as f:
+                tree = ast.parse(f.read(), filename)
+            for node in tree.body:
+                if not isinstance(node, ast.ClassDef):
+                    continue
+                for decorator in node.decorator_list:
+                    if not _is_register(decorator):
+                        continue
+                    manifest = {"desire_priority": 0, "context_types": None}
+                    for keyword in decorator.keywords:
+                        if keyword.arg == "context_types":
+                            manifest["context_types"] = _enum_names(keyword.value, "ContextType")
+                        elif keyword.arg in REGISTER_KWARGS:
+                            manifest[keyword.arg] = ast.literal_eval(keyword.value)
+                    for arg, key in zip(decorator.args, ["name", "desire_priority"]):
+                        manifest[key] = ast.literal_eval(arg)
+                    manifest["events"] = _handler_events(node)
+                    manifests.append(manifest)
+    except Exception as e:
+        logger.debug("[PluginManager] read manifest of {} failed, import it directly: {}".format(plugin_path, e))
+        return None
+    # 一个目录只注册一个插件时才能确定
+    if len(manifests) != 1 or "name" not in manifests[0]:
+        return None
+    return manifests[0]
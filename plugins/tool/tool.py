@@ -20,6 +20,7 @@ from plugins import *
     version="0.4",
     author="goldfishh",
     desire_priority=0,
+    context_types=[ContextType.TEXT],
 )
 class Tool(Plugin):
     def __init__(self):
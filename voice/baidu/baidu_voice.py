@@ -8,6 +8,7 @@ import time
 from aip import AipSpeech
 
 from bridge.reply import Reply, ReplyType
+from common.credential_cache import CredentialCache, fetch_baidu_token
 from common.log import logger
 from common.tmp_dir import TmpDir
 from config import conf
@@ -29,6 +30,20 @@ from voice.voice import Voice
     """
 
 
+class CachedTokenAipSpeech(AipSpeech):
+    """
+    使用CredentialCache中的access token，重启后不必重新获取，aip在token无效时调用_auth(True)刷新
+    """
+
+    def _auth(self, refresh=False):
+        if self._isCloudUser:  # 没有接口权限的云用户使用AK/SK签名，不需要token
+            return self._authObj
+        api_key, secret_key = self._apiKey, self._secretKey
+        auth_obj = CredentialCache().get("baidu:{}".format(api_key), lambda: fetch_baidu_token(api_key, secret_key), refresh)
+        self._isCloudUser = not self._isPermission(auth_obj)
+        return auth_obj
+
+
 class BaiduVoice(Voice):
     def __init__(self):
         try:
@@ -54,7 +69,7 @@ class BaiduVoice(Voice):
             self.vol = bconf["vol"]
             self.per = bconf["per"]
 
-            self.client = AipSpeech(self.app_id, self.api_key, self.secret_key)
+            self.client = CachedTokenAipSpeech(self.app_id, self.api_key, self.secret_key)
         except Exception as e:
             logger.warn("BaiduVoice init failed: %s, ignore " % e)
 